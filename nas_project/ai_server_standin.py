@@ -0,0 +1,71 @@
+"""Stand-in for the AI server on the LAN PC, for development and tests.
+
+Serves the same /embed and /summarize protocols. Embeddings are
+deterministic feature hashes: texts sharing words get similar vectors,
+which is enough to exercise semantic search without a model. Summaries
+are the leading sentences of the text, up to `max_tokens` words.
+
+    python ai_server_standin.py [--port 8000]
+
+and point EMBEDDING_API_URL and AI_SUMMARIZE_URL at http://127.0.0.1:8000.
+"""
+import re
+import math
+import hashlib
+import argparse
+from flask import Flask, request, jsonify
+
+DIM = 384
+WORD = re.compile(r'\w+', re.UNICODE)
+SENTENCE = re.compile(r'(?<=[.!?])\s+')
+
+app = Flask(__name__)
+
+
+def features(text):
+    """Words and word pairs of a text, lowercased"""
+    words = WORD.findall(text.lower())
+    return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+
+def embed(text):
+    vector = [0.0] * DIM
+    for feature in features(text):
+        digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], 'little') % DIM
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+@app.route('/embed', methods=['POST'])
+def embed_texts():
+    texts = (request.get_json(silent=True) or {}).get('texts')
+    if not isinstance(texts, list):
+        return jsonify({'error': 'Expected {"texts": [...]}'}), 400
+    return jsonify({'model': f'standin-hash-{DIM}', 'embeddings': [embed(str(text)) for text in texts]})
+
+
+@app.route('/summarize', methods=['POST'])
+def summarize():
+    data = request.get_json(silent=True) or {}
+    text = str(data.get('text', ''))
+    # Drop the instruction line the NAS puts in front of the text
+    body = text.split(':\n', 1)[1] if ':\n' in text.split('\n', 1)[0] + '\n' else text
+    budget = int(data.get('max_tokens') or 300)
+    summary = []
+    for sentence in SENTENCE.split(' '.join(body.split())):
+        words = len(sentence.split())
+        if summary and words > budget:
+            break
+        summary.append(sentence)
+        budget -= words
+    return jsonify({'summary': ' '.join(summary)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -56,17 +56,26 @@ def create_app():
         check_and_update_tables()
         initialize_system_tags()
 
+        from app.utils.search import ensure_search_index
+        ensure_search_index()
+
         # Register blueprints
         from app.routes.auth import auth_bp
         from app.routes.admin import admin_bp
         from app.routes.files import files_bp
+        from app.routes.uploads import uploads_bp
+        from app.routes.media import media_bp
         from app.routes.groups import groups_bp
         from app.routes.ai_dashboard import ai_bp
+        from app.routes.search import search_bp
 
         app.register_blueprint(auth_bp, name='auth')
         app.register_blueprint(admin_bp, name='admin')
         app.register_blueprint(files_bp, name='files')
+        app.register_blueprint(uploads_bp, name='uploads')
+        app.register_blueprint(media_bp, name='media')
         app.register_blueprint(groups_bp, name='groups')
+        app.register_blueprint(search_bp, name='search')
 
         @app.route('/')
         def index():
@@ -81,6 +90,8 @@ def create_app():
                 "script-src 'self' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com 'unsafe-inline' https://www.google.com; "
                 "style-src 'self' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com 'unsafe-inline'; "
                 "img-src 'self' data:; "
+                "media-src 'self' blob:; "
+                "worker-src 'self' blob:; "
                 "font-src 'self' https://cdnjs.cloudflare.com; "
                 "connect-src 'self';"
 
@@ -94,7 +105,8 @@ def create_app():
     @app.context_processor
     def add_utility_functions():
         from app.config import Config
-        return {'format_size': Config.format_size}
+        from app.utils.derivatives import derivative_url
+        return {'format_size': Config.format_size, 'derivative_url': derivative_url}
 
     app.register_blueprint(ai_bp)
 
@@ -26,8 +26,61 @@ class Config:
     UPLOAD_FOLDER = 'PATH TO YOUR STORAGE' 
     MAX_CONTENT_LENGTH = 21474836480  # 20GB for maximum single file size
     
+    # Deduplicating blob store: identical uploads are stored once under
+    # UPLOAD_FOLDER/blobs and shared by reference (quota stays per user)
+    STORAGE_DEDUP = False
+    BLOB_GC_GRACE = 3600  # Seconds an unreferenced blob is kept before it is reclaimed
+    BLOB_GC_BATCH = 100  # Blobs reclaimed per garbage collection pass
+    
+    # Sub-file dedup: large uploads are split into content-defined chunks
+    # (rolling hash) and each unique chunk is stored once in a pack file
+    STORAGE_CHUNK_DEDUP = False
+    CHUNK_DEDUP_MIN_SIZE = 64 * 1024 * 1024  # Smaller files use whole-file dedup only
+    CDC_MIN_CHUNK = 256 * 1024
+    CDC_AVG_CHUNK = 1024 * 1024  # Rounded down to a power of two
+    CDC_MAX_CHUNK = 4 * 1024 * 1024
+    CHUNK_PACK_SIZE = 256 * 1024 * 1024  # Packs are sealed once they reach this size
+    CHUNK_PACK_COMPACT_RATIO = 0.5  # Share of dead bytes at which the GC rewrites a pack
+    
+    # Storage pool: extra volumes (e.g. USB disks) new files are spread over.
+    # UPLOAD_FOLDER is always the 'default' volume and keeps the blob/chunk
+    # stores and upload scratch space. capacity (bytes) and weight are optional:
+    # STORAGE_VOLUMES = [{'name': 'usb1', 'path': '/mnt/usb1/nas', 'capacity': 2 * 1024 ** 4, 'weight': 1.0}]
+    STORAGE_VOLUMES = []
+    DEFAULT_VOLUME_CAPACITY = None  # Optional cap for the default volume
+    DEFAULT_VOLUME_WEIGHT = 1.0
+    VOLUME_SAMPLE_INTERVAL = 15  # Seconds free space samples are reused for placement
+    REBALANCE_INTERVAL = 600  # Seconds between rebalancer passes, 0 disables it
+    REBALANCE_THRESHOLD = 0.10  # Rebalance when volume fill levels differ by more than this
+    REBALANCE_BANDWIDTH = 20 * 1024 * 1024  # Bytes per second copied by the rebalancer
+    REBALANCE_BATCH_BYTES = 10 * 1024 * 1024 * 1024  # Bytes moved per pass
+    REBALANCE_GRACE = 60  # Seconds an old copy stays readable after a file was moved
+    
+    # Download offload: behind nginx, Flask checks access and logs the
+    # download, then answers with X-Accel-Redirect so nginx sends the bytes
+    ACCEL_REDIRECT = True
+    ACCEL_REDIRECT_PREFIX = '/_protected'  # Internal nginx locations, one per storage volume
+    MAX_BYTE_RANGES = 64  # More ranges than this in one request get the whole file
+    DOWNLOAD_SESSION_TTL = 120  # Seconds follow-up range requests of a download skip the access check and log
+    DOWNLOAD_SESSION_MAX = 10000  # Download sessions remembered per worker
+    
+    # Bandwidth shaping (token buckets, rates in bytes per second, 0 = unlimited).
+    # Admins can change these at runtime from /admin/qos.
+    QOS_ENABLED = False
+    QOS_GLOBAL_DOWNLOAD_RATE = 0
+    QOS_GLOBAL_UPLOAD_RATE = 0
+    QOS_USER_DOWNLOAD_RATE = 0
+    QOS_USER_UPLOAD_RATE = 0
+    QOS_INTERACTIVE_RESERVE = 0.3  # Share of every rate bulk transfers cannot use
+    QOS_INTERACTIVE_MAX = 8 * 1024 * 1024  # Range requests up to this size count as interactive
+    QOS_BURST_SECONDS = 1.0  # Bucket capacity, in seconds of the rate
+    QOS_WORKER_PROCESSES = 1  # Web server processes; buckets are per process, so each gets a share
+    
     # Upload Optimization
     UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB upload chunks
+    UPLOAD_PARALLEL_CHUNKS = 4  # Chunks of one file a client may send at the same time
+    UPLOAD_SESSION_TTL = 24 * 3600  # Abandoned resumable uploads are discarded after 24h
+    UPLOAD_STREAM_BUFFER = 1024 * 1024  # Read/write buffer for streamed uploads
     REQUEST_TIMEOUT = 3600  # 1 hour timeout for large uploads
     SERVER_TIMEOUT = 3600   # Server-side timeout
 
@@ -70,6 +123,10 @@ class Config:
     DEFAULT_STORAGE_LIMIT = 50 * 1024 * 1024 * 1024  # 50GB in bytes
     WARNING_THRESHOLD = 0.75  # 75% - Show warning
     CRITICAL_THRESHOLD = 0.90  # 90% - Show critical warning
+    DISK_FREE_MARGIN = 512 * 1024 * 1024  # Uploads are refused if they would leave less than this free
+    STORAGE_RECONCILE_INTERVAL = 300  # Seconds between reconciler batches (0 disables the thread)
+    STORAGE_RECONCILE_BATCH = 20  # Users recomputed per batch
+    STORAGE_RECONCILE_FILE_PAGE = 500  # File rows stat'ed per query while checking the disk
     
     # Security Headers
     SECURITY_HEADERS = {
@@ -98,14 +155,105 @@ class Config:
     # Video Streaming
     CHUNK_SIZE = 1024 * 1024  # 1MB chunks for video streaming
     
+    # Adaptive streaming: HLS renditions are transcoded segment by segment
+    # when first played and cached under UPLOAD_FOLDER/hls
+    HLS_RENDITIONS = [
+        {'name': '1080p', 'height': 1080, 'video_bitrate': 5000000, 'audio_bitrate': 192000},
+        {'name': '720p', 'height': 720, 'video_bitrate': 2800000, 'audio_bitrate': 128000},
+        {'name': '480p', 'height': 480, 'video_bitrate': 1200000, 'audio_bitrate': 128000},
+        {'name': '360p', 'height': 360, 'video_bitrate': 700000, 'audio_bitrate': 96000},
+    ]
+    HLS_SEGMENT_SECONDS = 6
+    HLS_PREFETCH_SEGMENTS = 3  # Segments transcoded ahead of the one being played
+    HLS_WORKERS = 1  # Concurrent ffmpeg processes; one keeps a Pi responsive
+    HLS_PRESET = 'veryfast'
+    HLS_SEGMENT_TIMEOUT = 120  # Seconds a segment may take to transcode
+    HLS_CACHE_BUDGET = 20 * 1024 * 1024 * 1024  # Least recently played segments are evicted past this
+    
+    # Uploaded MP4/MOV files with the moov atom at the end are remuxed
+    # (stream copy) so playback can start without fetching the tail first
+    FASTSTART_ENABLED = True
+    FASTSTART_EXTENSIONS = {'mp4', 'm4v', 'mov'}
+    
+    # Duration, resolution, codecs and EXIF of media files are probed once,
+    # after upload, and kept in the media_info table
+    MEDIA_INFO_ON_UPLOAD = True
+    
+    # Hover-to-scrub previews: one frame every SPRITE_INTERVAL seconds, packed
+    # into sprite sheets with a WebVTT index, stored next to the video
+    SPRITE_ENABLED = True
+    SPRITE_MIN_DURATION = 60  # Seconds; shorter videos are scrubbed by playing them
+    SPRITE_INTERVAL = 10  # Seconds between frames, stretched to stay under SPRITE_MAX_FRAMES
+    SPRITE_MAX_FRAMES = 600
+    SPRITE_WIDTH = 160  # Frame width in pixels; height follows the aspect ratio
+    SPRITE_COLUMNS = 10
+    SPRITE_ROWS = 10
+    SPRITE_FORMAT = 'jpg'  # or 'webp' when ffmpeg is built with libwebp
+    SPRITE_TIMEOUT = 900  # Seconds the ffmpeg pass may take
+    
     # Preview Settings
     MAX_PREVIEW_SIZE = 10 * 1024 * 1024  # 10MB max for preview
     THUMBNAIL_SIZE = (200, 200)  # Thumbnail dimensions
     
+    # Resized image derivatives (longest side in pixels), cached under
+    # UPLOAD_FOLDER/derivatives and evicted least recently used
+    DERIVATIVE_SIZES = (64, 256, 1024, 2048)
+    DERIVATIVE_PREGENERATE = (256,)  # Made right after upload, for listings
+    DERIVATIVE_QUALITY = 80
+    DERIVATIVE_CACHE_BUDGET = 2 * 1024 * 1024 * 1024
+    
+    # PDF pages rendered to images for the preview viewer
+    PDF_PAGE_DPIS = (48, 96, 150, 200)
+    PDF_MAX_PAGE_PIXELS = 16 * 1024 * 1024  # Oversized pages are rendered at a lower DPI
+    PDF_MAX_OPEN_DOCUMENTS = 8  # Parsed documents kept open between page requests
+    PDF_PAGE_CACHE_BUDGET = 1024 * 1024 * 1024
+    
+    # Text extracted from documents for summaries and search, gzipped under
+    # UPLOAD_FOLDER/text_cache and keyed by content hash
+    TEXT_EXTRACT_MAX_CHARS = 5 * 1000 * 1000  # Longer documents are cut off here
+    TEXT_CACHE_BUDGET = 512 * 1024 * 1024
+    
+    # Full-text search (SQLite FTS5) over names, tags and document text
+    SEARCH_MAX_CONTENT_CHARS = 200 * 1000  # Text indexed per document
+    SEARCH_RESULTS_LIMIT = 50
+    
+    # Summaries from the AI server on the LAN PC. Text longer than
+    # SUMMARY_CHUNK_CHARS is summarised in parts, at most SUMMARY_WORKERS
+    # at a time, and the parts' summaries combined; finished parts are
+    # cached so a retry only asks for the missing ones.
+    AI_SUMMARIZE_URL = "http://192.168.1.23:8000/summarize"  # <- zamenjaj z IP tvojega PC-ja
+    SUMMARY_CHUNK_CHARS = 12000
+    SUMMARY_WORKERS = 2
+    SUMMARY_TIMEOUT = 90  # Seconds per request to the AI server
+    SUMMARY_PARTIAL_TOKENS = 300  # Length of each part's summary
+    SUMMARY_CACHE_BUDGET = 64 * 1024 * 1024
+    
+    # Semantic search: document chunks embedded by the AI server and kept
+    # per user as a float32 matrix under UPLOAD_FOLDER/embeddings. An empty
+    # URL turns it off; it also needs NumPy.
+    EMBEDDING_API_URL = "http://192.168.1.23:8000/embed"
+    EMBEDDING_BATCH_SIZE = 32  # Chunks per request to the AI server
+    EMBEDDING_TIMEOUT = 60
+    EMBEDDING_CHUNK_CHARS = 1500
+    EMBEDDING_CHUNK_OVERLAP = 200  # Shared by consecutive pieces of a long paragraph
+    EMBEDDING_MAX_CHUNKS = 400  # Per file; the rest of a long document is not embedded
+    EMBEDDING_IVF_MIN_VECTORS = 50000  # From here on a user's matrix is partitioned
+    EMBEDDING_IVF_PROBES = 8  # Partitions scanned per query
+    
     # Performance Settings for Raspberry Pi
     MAX_WORKERS = 2  # Limit number of worker processes
     THREAD_POOL_SIZE = 8  # Thread pool size for async operations
     
+    # Preview and media jobs run on MAX_WORKERS threads; with more than one,
+    # a worker is kept for jobs a page is waiting on, and the others run
+    # niced. At most THREAD_POOL_SIZE requests wait on jobs at once.
+    JOB_POLL_INTERVAL = 2  # Seconds between checks for jobs queued by other processes
+    JOB_MAX_ATTEMPTS = 3
+    JOB_HEARTBEAT_INTERVAL = 60  # Seconds between a worker's liveness updates of its running jobs
+    JOB_STALE_AFTER = 300  # Seconds without a heartbeat before a running job is assumed to have died with its process
+    JOB_BACKGROUND_NICE = 10  # Added niceness of background workers, inherited by ffmpeg
+    JOB_WAIT_TIMEOUT = 30  # Seconds a request waits on a job before answering 503
+    
     # Print storage path on startup for verification
     print(f"Storage path is set to: {UPLOAD_FOLDER}")
     
@@ -126,6 +274,10 @@ class Config:
         os.makedirs(temp_dir, exist_ok=True)
         os.chmod(temp_dir, 0o777)  # Full permissions for temporary storage
         print(f"Created/verified temp directory at: {temp_dir}")
+        
+        for volume in Config.STORAGE_VOLUMES:
+            os.makedirs(volume['path'], exist_ok=True)
+            print(f"Created/verified storage volume {volume['name']} at: {volume['path']}")
 
     @staticmethod
     def get_user_storage_path(user_id):
@@ -2,6 +2,7 @@ from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from app import db
+import json
 import logging
 import sqlite3
 from flask import current_app
@@ -23,6 +24,7 @@ class User(UserMixin, db.Model):
     # Storage
     storage_limit = db.Column(db.BigInteger)
     storage_used = db.Column(db.BigInteger)
+    storage_reserved = db.Column(db.BigInteger, default=0)  # Admitted uploads still in flight
     
     # Status
     is_admin = db.Column(db.Boolean)
@@ -66,7 +68,7 @@ class User(UserMixin, db.Model):
     def can_upload(self, file_size):
         if not self.storage_limit:
             return True
-        return self.storage_used + file_size <= self.storage_limit
+        return (self.storage_used or 0) + (self.storage_reserved or 0) + file_size <= self.storage_limit
 
 
 
@@ -110,8 +112,14 @@ class File(db.Model):
     file_type = db.Column(db.String(50))
     file_size = db.Column(db.BigInteger)
     category = db.Column(db.String(50))
-    path = db.Column(db.String(512), nullable=False, unique=True)
+    # Not unique: deduplicated files share the path of their blob
+    path = db.Column(db.String(512), nullable=False, index=True)
     is_public = db.Column(db.Boolean)
+    sha256 = db.Column(db.String(64), index=True)  # Content hash, computed while uploading
+    mime_type = db.Column(db.String(100))  # Sniffed from the first bytes of the upload
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'), index=True)  # Set when stored as a shared blob
+    is_chunked = db.Column(db.Boolean, default=False)  # Body lives in the chunk store, see FileChunk
+    volume = db.Column(db.String(50), default='default', index=True)  # Storage pool volume holding the body, see Config.STORAGE_VOLUMES
     
     # Timestamps
     uploaded_at = db.Column(db.DateTime)
@@ -162,6 +170,151 @@ class File(db.Model):
         return self.filename.lower().endswith(('.zip', '.rar', '.7z', '.tar.gz', '.tar'))
 
 
+class Blob(db.Model):
+    """Content-addressed file body shared by every File with the same SHA-256"""
+    __tablename__ = 'blob'
+    
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    path = db.Column(db.String(512), nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unreferenced_at = db.Column(db.DateTime, index=True)  # When ref_count last dropped to 0
+    
+    files = db.relationship('File', backref='blob', lazy='dynamic')
+    
+    def __repr__(self):
+        return f'<Blob {self.sha256[:12]} x{self.ref_count}>'
+
+
+class ChunkPack(db.Model):
+    """Append-only file holding many content-defined chunks back to back"""
+    __tablename__ = 'chunk_pack'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(512), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='open', index=True)  # open, writing, sealed
+    dead_bytes = db.Column(db.BigInteger, nullable=False, default=0)  # Bytes of chunks already collected
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Chunk(db.Model):
+    """A unique piece of file content, stored once in a ChunkPack"""
+    __tablename__ = 'chunk'
+    
+    sha256 = db.Column(db.String(64), primary_key=True)
+    pack_id = db.Column(db.Integer, db.ForeignKey('chunk_pack.id'), nullable=False, index=True)
+    offset = db.Column(db.BigInteger, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    unreferenced_at = db.Column(db.DateTime, index=True)
+    
+    pack = db.relationship('ChunkPack')
+
+
+class FileChunk(db.Model):
+    """Position of a chunk within a chunked File"""
+    __tablename__ = 'file_chunk'
+    
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    offset = db.Column(db.BigInteger, nullable=False)  # Offset of the chunk within the file
+    chunk_sha256 = db.Column(db.String(64), db.ForeignKey('chunk.sha256'), nullable=False, index=True)
+
+
+class MediaInfo(db.Model):
+    """Probe results for a media File, stored so pages need not run ffprobe.
+
+    `size` and `mtime` record the version of the file that was probed; a
+    row that no longer matches the file on disk is stale and re-probed.
+    """
+    __tablename__ = 'media_info'
+    
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    kind = db.Column(db.String(10))  # video, audio, image
+    format_name = db.Column(db.String(100))
+    duration = db.Column(db.Float)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    codec = db.Column(db.String(50))  # Video codec, or the image format
+    audio_codec = db.Column(db.String(50))
+    bitrate = db.Column(db.BigInteger)
+    frame_rate = db.Column(db.Float)
+    streams = db.Column(db.Text)  # JSON list of {index, type, codec, ...}
+    tags = db.Column(db.Text)  # JSON object of container tags and EXIF fields
+    error = db.Column(db.String(255))  # Set when the file could not be probed
+    probed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    file = db.relationship('File', backref=db.backref('media_info', uselist=False,
+                                                      cascade='all, delete-orphan'))
+    
+    def __repr__(self):
+        return f'<MediaInfo for file {self.file_id}>'
+    
+    @property
+    def has_audio(self):
+        return bool(self.audio_codec)
+    
+    @property
+    def duration_text(self):
+        """Duration as m:ss or h:mm:ss"""
+        minutes, seconds = divmod(int(self.duration or 0), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+    
+    def get_streams(self):
+        return json.loads(self.streams) if self.streams else []
+    
+    def get_tags(self):
+        return json.loads(self.tags) if self.tags else {}
+    
+    def summary(self):
+        """Short description for listings, e.g. '1920x1080 · h264 · 3:25'"""
+        if self.error:
+            return ''
+        parts = []
+        if self.width and self.height:
+            parts.append(f'{self.width}x{self.height}')
+        if self.codec or self.audio_codec:
+            parts.append(self.codec or self.audio_codec)
+        if self.duration:
+            parts.append(self.duration_text)
+        return ' · '.join(parts)
+    
+    def video_metadata(self):
+        """The dict VideoHandler.get_metadata() returns, or None without a video stream"""
+        if self.error or self.kind != 'video' or not self.width:
+            return None
+        return {
+            'duration': self.duration or 0.0,
+            'width': self.width,
+            'height': self.height,
+            'codec': self.codec or '',
+            'bitrate': self.bitrate or 0,
+            'size': self.size,
+            'has_audio': self.has_audio
+        }
+    
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'format': self.format_name,
+            'duration': self.duration,
+            'width': self.width,
+            'height': self.height,
+            'codec': self.codec,
+            'audio_codec': self.audio_codec,
+            'bitrate': self.bitrate,
+            'frame_rate': self.frame_rate,
+            'streams': self.get_streams(),
+            'tags': self.get_tags(),
+            'error': self.error
+        }
+
+
 class Group(db.Model):
     __tablename__ = 'group'
     
@@ -241,6 +394,154 @@ class Notification(db.Model):
         return f'<Notification for {self.user_id}>'
 
 
+class UploadSession(db.Model):
+    __tablename__ = 'upload_session'
+    
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, handed to the client
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    original_filename = db.Column(db.String(255), nullable=False)
+    category = db.Column(db.String(50))
+    tag_ids = db.Column(db.String(255))  # Comma separated Tag ids chosen at upload time
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='active')  # active, finalizing, completed, failed
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='SET NULL'))
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    user = db.relationship('User', backref=db.backref('upload_sessions', lazy='dynamic'))
+    chunks = db.relationship('UploadChunk', backref='session', lazy='dynamic',
+                             cascade='all, delete-orphan')
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id} for {self.original_filename}>'
+    
+    @property
+    def total_chunks(self):
+        """Number of chunks the file is split into (an empty file still has one)"""
+        if not self.total_size:
+            return 1
+        return (self.total_size + self.chunk_size - 1) // self.chunk_size
+    
+    def chunk_length(self, index):
+        """Expected byte length of chunk `index`"""
+        start = index * self.chunk_size
+        return max(0, min(self.chunk_size, self.total_size - start))
+    
+    def received_chunks(self):
+        """Sorted indexes of the chunks already stored on the server"""
+        return [c.chunk_index for c in self.chunks.order_by(UploadChunk.chunk_index)]
+    
+    def received_bytes(self):
+        return sum(c.size for c in self.chunks)
+    
+    def to_dict(self):
+        received = self.received_chunks()
+        return {
+            'upload_id': self.id,
+            'filename': self.original_filename,
+            'status': self.status,
+            'total_size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'received': received,
+            'received_offsets': [i * self.chunk_size for i in received],
+            'received_bytes': self.received_bytes(),
+            'file_id': self.file_id
+        }
+
+
+class UploadChunk(db.Model):
+    __tablename__ = 'upload_chunk'
+    
+    session_id = db.Column(db.String(32), db.ForeignKey('upload_session.id', ondelete='CASCADE'),
+                           primary_key=True)
+    chunk_index = db.Column(db.Integer, primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    checksum = db.Column(db.String(64))  # SHA-256 hex of the chunk payload
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UploadChunk {self.chunk_index} of {self.session_id}>'
+
+
+class StorageReservation(db.Model):
+    __tablename__ = 'storage_reservation'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    # Set for resumable uploads, whose reservation lives as long as the session
+    upload_session_id = db.Column(db.String(32), db.ForeignKey('upload_session.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, index=True)
+    
+    def __repr__(self):
+        return f'<StorageReservation {self.size} bytes for {self.user_id}>'
+
+
+class BackgroundJob(db.Model):
+    """Pending preview or media work for a File, kept in the database so it
+    survives restarts. Rows are deleted once their job succeeds."""
+    __tablename__ = 'background_job'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'file_id', 'args', name='uq_background_job'),
+        db.Index('ix_background_job_next', 'status', 'priority', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)  # media, probe, sprites, derivative
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), nullable=False, index=True)
+    args = db.Column(db.String(100), nullable=False, default='')  # Job specific, e.g. '256.webp'
+    priority = db.Column(db.Integer, nullable=False, default=10)  # Lower runs first
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # Refreshed by the worker running the job
+    
+    def __repr__(self):
+        return f'<BackgroundJob {self.kind} for file {self.file_id}>'
+
+
+class EmbeddingChunk(db.Model):
+    """A chunk of a File's extracted text and the row holding its embedding
+    in the owner's vector file (see utils.embeddings). Rows of deleted or
+    re-embedded chunks stay in the vector file until it is compacted."""
+    __tablename__ = 'embedding_chunk'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'row', name='uq_embedding_chunk_row'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), nullable=False, index=True)
+    row = db.Column(db.Integer, nullable=False)
+    chunk = db.Column(db.Integer, nullable=False)  # Position of the chunk in the file
+    version = db.Column(db.String(40), nullable=False)  # Text version the chunk was cut from
+    excerpt = db.Column(db.String(300))  # Start of the chunk, shown with results
+    
+    def __repr__(self):
+        return f'<EmbeddingChunk {self.chunk} of file {self.file_id}>'
+
+
+# (table, column, SQL type) for columns added to existing tables;
+# db.create_all() only creates missing tables, not missing columns
+ADDED_COLUMNS = [
+    ('file', 'sha256', 'VARCHAR(64)'),
+    ('file', 'mime_type', 'VARCHAR(100)'),
+    ('user', 'storage_reserved', 'BIGINT DEFAULT 0'),
+    ('file', 'blob_sha256', 'VARCHAR(64)'),
+    ('file', 'is_chunked', 'BOOLEAN DEFAULT 0'),
+    ('file', 'volume', "VARCHAR(50) DEFAULT 'default'"),
+    ('background_job', 'heartbeat_at', 'DATETIME'),
+]
+
+
 def check_and_update_tables():
     """Check and update database tables if needed
     This function is called during app initialization to ensure all tables exist and
@@ -262,6 +563,26 @@ def check_and_update_tables():
         tables = cursor.fetchall()
         logging.info(f"Database tables: {[table[0] for table in tables]}")
         
+        # Add columns introduced after a table was first created
+        for table, column, ddl in ADDED_COLUMNS:
+            cursor.execute(f'PRAGMA table_info("{table}")')
+            existing = [col[1] for col in cursor.fetchall()]
+            if existing and column not in existing:
+                logging.info(f"Adding column {table}.{column}")
+                cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}')
+        conn.commit()
+        
+        # Databases created before the blob store still have UNIQUE(file.path),
+        # which deduplicated files cannot satisfy; migrate_db.py removes it
+        cursor.execute('PRAGMA index_list("file")')
+        for index in cursor.fetchall():
+            if index[2] and index[3] == 'u':
+                cursor.execute(f'PRAGMA index_info("{index[1]}")')
+                if [col[2] for col in cursor.fetchall()] == ['path'] \
+                        and current_app.config.get('STORAGE_DEDUP'):
+                    logging.error("STORAGE_DEDUP disabled: file.path is still UNIQUE, run migrate_db.py")
+                    current_app.config['STORAGE_DEDUP'] = False
+        
         conn.close()
         logging.info("Database structure check completed")
         
@@ -1,10 +1,13 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required, current_user
 from app.models import db, User, ActivityLog, StorageRequest, File
+from app.utils.storage import release_user_files
+from app.utils.volumes import get_pool
 from datetime import datetime
 from functools import wraps
 import os
 import shutil
+import json
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -145,12 +148,14 @@ def delete_user(user_id):
         return redirect(url_for('admin.manage_users'))
 
     try:
-        user_storage_path = os.path.join('storage', 'users', str(user.id))
-        if os.path.exists(user_storage_path):
-            shutil.rmtree(user_storage_path)
+        for volume in get_pool().volumes:
+            user_storage_path = os.path.join(volume.path, str(user.id))
+            if os.path.exists(user_storage_path):
+                shutil.rmtree(user_storage_path)
         ActivityLog.query.filter_by(user_id=user.id).delete()
         StorageRequest.query.filter_by(user_id=user.id).delete()
         StorageRequest.query.filter_by(responded_by=user.id).delete()
+        release_user_files(user.id)
         File.query.filter_by(user_id=user.id).delete()
         user.groups = []
         log = ActivityLog(user_id=current_user.id, action='user_deletion',
@@ -218,3 +223,161 @@ def user_detail(user_id):
 
     user = User.query.get_or_404(user_id)
     return render_template('admin/user_detail.html', user=user)
+
+@admin_bp.route('/storage/reconcile', methods=['GET', 'POST'])
+@admin_required
+def reconcile_storage():
+    """GET: last drift report per user. POST: reconcile one user (user_id) or everyone now."""
+    from app.utils.reconcile import reconcile_user, last_reports
+
+    if request.method == 'POST':
+        if current_user.is_demo:
+            return jsonify({'error': "Demo user can't reconcile storage."}), 403
+        user_id = request.form.get('user_id', type=int)
+        user_ids = [user_id] if user_id else [u.id for u in User.query.with_entities(User.id)]
+        reports = [reconcile_user(uid) for uid in user_ids]
+        log = ActivityLog(user_id=current_user.id, action='storage_reconcile',
+                          details=f'Reconciled storage for {len(user_ids)} user(s)',
+                          ip_address=get_client_ip(), timestamp=datetime.utcnow())
+        db.session.add(log)
+        db.session.commit()
+        return jsonify({'reports': [r for r in reports if r]})
+
+    return jsonify({'reports': list(last_reports.values())})
+
+@admin_bp.route('/storage/dedup')
+@admin_required
+def dedup_report():
+    """Logical vs. physical bytes and dedup ratio for every user"""
+    from app.utils.chunk_store import dedup_stats
+
+    return jsonify({'users': [dedup_stats(uid) for (uid,) in User.query.with_entities(User.id)]})
+
+@admin_bp.route('/storage/volumes')
+@admin_required
+def storage_volumes():
+    """Capacity, free space and fill level of every volume in the storage pool"""
+    return jsonify({'volumes': get_pool().stats()})
+
+@admin_bp.route('/qos', methods=['GET', 'POST'])
+@admin_required
+def qos_settings():
+    """GET: QoS settings and live transfer rates. POST: change settings and per-user rates.
+
+    POST takes JSON like {"settings": {"QOS_ENABLED": true, "QOS_USER_DOWNLOAD_RATE": 5242880},
+    "user_rates": {"3": {"download": 1048576, "upload": null}}}; rates are bytes per second,
+    0 means unlimited and null removes a user's override.
+    """
+    from app.utils.qos import get_qos, SETTINGS
+
+    qos = get_qos()
+    if request.method == 'POST':
+        if current_user.is_demo:
+            return jsonify({'error': "Demo user can't change QoS settings."}), 403
+        data = request.get_json(silent=True) or {}
+        settings = data.get('settings') or {}
+        user_rates = data.get('user_rates') or {}
+        try:
+            for key, value in settings.items():
+                if key not in SETTINGS:
+                    raise ValueError(f'Unknown setting {key}')
+                if key == 'QOS_ENABLED':
+                    settings[key] = bool(value)
+                elif key == 'QOS_INTERACTIVE_RESERVE':
+                    settings[key] = float(value)
+                    if not 0 <= settings[key] < 1:
+                        raise ValueError('QOS_INTERACTIVE_RESERVE must be at least 0 and below 1')
+                else:
+                    settings[key] = int(value)
+                    if settings[key] < 0:
+                        raise ValueError(f'{key} must not be negative')
+            for user_id, rates in user_rates.items():
+                if not User.query.get(int(user_id)):
+                    raise ValueError(f'Unknown user {user_id}')
+                for direction, rate in rates.items():
+                    if rate is not None and int(rate) < 0:
+                        raise ValueError('Rates must not be negative')
+                    rates[direction] = None if rate is None else int(rate)
+        except (TypeError, ValueError, AttributeError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        qos.update(settings, user_rates)
+        log = ActivityLog(user_id=current_user.id, action='qos_update',
+                          details=f'Updated QoS settings: {json.dumps(data)}',
+                          ip_address=get_client_ip(), timestamp=datetime.utcnow())
+        db.session.add(log)
+        db.session.commit()
+
+    return jsonify(qos.stats())
+
+@admin_bp.route('/media/hls')
+@admin_required
+def hls_status():
+    """HLS transcode queue depth and segment cache usage"""
+    from app.utils.hls import get_transcoder
+
+    return jsonify(get_transcoder().stats())
+
+
+@admin_bp.route('/media/derivatives')
+@admin_required
+def derivative_status():
+    """Disk usage of the resized image cache against its budget"""
+    from app.utils.derivatives import get_derivatives
+
+    return jsonify(get_derivatives().stats())
+
+
+@admin_bp.route('/media/pdf')
+@admin_required
+def pdf_page_status():
+    """Disk usage of the rendered PDF page cache, and the documents held open"""
+    from app.utils.pdf_pages import get_pdf_pages
+
+    return jsonify(get_pdf_pages().stats())
+
+
+@admin_bp.route('/media/text')
+@admin_required
+def text_cache_status():
+    """Disk usage of the extracted document text cache against its budget"""
+    from app.utils.text_extract import get_text_cache
+
+    return jsonify(get_text_cache().stats())
+
+
+@admin_bp.route('/media/embeddings')
+@admin_required
+def embedding_status():
+    """Embedded chunk count and the semantic search state held in memory"""
+    from app.utils.embeddings import get_embeddings
+
+    return jsonify(get_embeddings().stats())
+
+
+@admin_bp.route('/jobs', methods=['GET', 'POST'])
+@admin_required
+def job_queue():
+    """GET: preview/media job queue depth. POST: queue backfill jobs for
+    existing files, optionally for one user ({"user_id": 3})."""
+    from app.utils.background import get_queue
+    from app.utils.media_jobs import backfill
+
+    queue = get_queue()
+    if request.method == 'POST':
+        if current_user.is_demo:
+            return jsonify({'error': "Demo user can't queue jobs."}), 403
+        user_id = (request.get_json(silent=True) or {}).get('user_id')
+        if user_id is not None and not User.query.get(user_id):
+            return jsonify({'error': f'Unknown user {user_id}'}), 400
+        files = backfill(user_id)
+        log = ActivityLog(user_id=current_user.id, action='job_backfill',
+                          details=f'Queued preview backfill for {files} files',
+                          ip_address=get_client_ip(), timestamp=datetime.utcnow())
+        db.session.add(log)
+        db.session.commit()
+        stats = queue.stats()
+        stats['files'] = files
+        return jsonify(stats)
+
+    return jsonify(queue.stats())
@@ -1,35 +1,21 @@
-from flask import Blueprint, render_template, request, current_app
+from flask import Blueprint, render_template, request
 from flask_login import login_required, current_user
+from app.models import File
 import os
-import requests
 
-import fitz  # PyMuPDF
-import docx  # python-docx
+from app.utils.text_extract import SUPPORTED_EXTENSIONS, file_extension, get_text_cache
+from app.utils.summarize import get_summarizer
 
 ai_bp = Blueprint('ai', __name__)
-AI_API_URL = "http://192.168.1.23:8000/summarize"
 
-SUPPORTED_EXTENSIONS = [".txt", ".pdf", ".docx"]
-
-def extract_text(filepath):
-    ext = os.path.splitext(filepath)[1].lower()
+def extract_text(file):
+    # Parsed once per document version; later requests read the text cache
     try:
-        if ext == ".txt":
-            with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-                return f.read()
-        elif ext == ".pdf":
-            text = ""
-            with fitz.open(filepath) as doc:
-                for page in doc:
-                    text += page.get_text()
-            return text
-        elif ext == ".docx":
-            doc = docx.Document(filepath)
-            return "\n".join([para.text for para in doc.paragraphs])
-        else:
-            return f"[Unsupported file type: {ext}]"
+        return get_text_cache().get_text(file)
+    except ValueError as e:
+        return f"[{str(e)}]"
     except Exception as e:
-        return f"[Error reading {ext} file: {str(e)}]"
+        return f"[Error reading {file_extension(file)} file: {str(e)}]"
 
 @ai_bp.route("/ai", methods=["GET", "POST"])
 @login_required
@@ -37,22 +23,23 @@ def ai_dashboard():
     summary = None
     error = None
     used_text = ""
-    selected_file = ""
+    selected_file = None
     all_files = []
 
-    user_dir = os.path.join(current_app.config["UPLOAD_FOLDER"], str(current_user.id))
-
-    if os.path.exists(user_dir):
-        all_files = sorted([
-            f for f in os.listdir(user_dir)
-            if os.path.isfile(os.path.join(user_dir, f)) and os.path.splitext(f)[1].lower() in SUPPORTED_EXTENSIONS
-        ])
+    # Listed from the database: deduplicated files live in the blob store,
+    # not in the user's directory. Keyed by id, since names need not be unique.
+    user_files = {
+        f.id: f
+        for f in File.query.filter_by(user_id=current_user.id).all()
+        if file_extension(f) in SUPPORTED_EXTENSIONS
+    }
+    all_files = sorted(user_files.values(), key=lambda f: (f.original_filename or f.filename).lower())
 
     if request.method == "POST":
         language = request.form.get("language", "English")
         detail = request.form.get("detail", "medium")
         mode = request.form.get("mode", "summary")
-        selected_file = request.form.get("selected_file", "")
+        selected_file = request.form.get("selected_file", type=int)
         pasted_text = request.form.get("text", "")
 
         max_tokens = {
@@ -69,26 +56,20 @@ def ai_dashboard():
         }.get(mode, "Summarize the following text")
 
         if selected_file:
-            filepath = os.path.join(user_dir, selected_file)
-            if os.path.exists(filepath):
-                used_text = extract_text(filepath)
+            file = user_files.get(selected_file)
+            if file and (file.is_chunked or os.path.exists(file.path)):
+                used_text = extract_text(file)
             else:
-                error = f"File '{selected_file}' not found."
+                error = "File not found."
         else:
             used_text = pasted_text
 
-        prompt = f"{instructions} in {language}:\n{used_text.strip()}"
-
-        try:
-            res = requests.post(AI_API_URL, json={
-                "text": prompt,
-                "max_tokens": max_tokens,
-                "language": language
-            }, timeout=90)
-            res.raise_for_status()
-            summary = res.json().get("summary", "[No output]")
-        except Exception as e:
-            error = str(e)
+        if not error:
+            try:
+                # Long texts are summarised in parts; a retry reuses the finished parts
+                summary = get_summarizer().summarize(used_text, instructions, language, max_tokens) or "[No output]"
+            except Exception as e:
+                error = str(e)
 
     return render_template("ai/dashboard.html",
         summary=summary,
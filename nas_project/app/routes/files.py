@@ -1,12 +1,32 @@
-from flask import Blueprint, render_template, request, jsonify, current_app, send_file, abort, flash, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, current_app, abort, flash, redirect, url_for
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
+from werkzeug.http import parse_options_header
 from app.models import db, File, ActivityLog, StorageRequest, Tag
+from app.utils.storage import (
+    create_file_record, adjust_storage_used, release_file, open_stored_file
+)
+from app.utils.upload_stream import UploadError, open_upload, receive_raw, receive_multipart
+from app.utils.accel import accel_enabled, accel_response
+from app.utils.ranges import guess_mimetype, send_ranged, send_stored_path
+from app.utils.download_sessions import get_download_sessions
+from app.utils.qos import get_qos
+from app.utils.hls import is_video, get_transcoder
+from app.utils.media_jobs import after_upload
+from app.utils.media_info import cached_media_info, media_info_map
+from app.utils.sprites import is_candidate as wants_sprites
+from app.utils.derivatives import get_derivatives
+from app.utils.pdf_pages import get_pdf_pages, is_candidate as is_pdf
+from app.utils.text_extract import get_text_cache, is_candidate as is_text_candidate
+from app.utils import search
+from app.utils.embeddings import get_embeddings
+from app.utils.summarize import get_summarizer
+from app.utils.quota import (
+    declared_upload_size, parse_upload_size, reserve_storage, check_admission, release_reservation,
+    cancel_reservation
+)
+from urllib.parse import unquote, urlsplit
 import os
-import mimetypes
 from datetime import datetime
-import requests
-from PyPDF2 import PdfReader
 
 files_bp = Blueprint('files', __name__, url_prefix='/files')
 
@@ -42,215 +62,196 @@ def dashboard():
     # Get all tags for tag selection
     tags = Tag.query.filter((Tag.user_id == current_user.id) | (Tag.is_system == True)).all()
     
-    return render_template('files/dashboard.html', files=files, tags=tags)
+    return render_template('files/dashboard.html', files=files, tags=tags,
+                           media_info=media_info_map(files))
+
+def upload_response(message, status_code=200, as_json=False, **extra):
+    """Answer an upload as JSON for AJAX/API clients, or flash and redirect"""
+    if as_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        key = 'message' if status_code < 400 else 'error'
+        return jsonify({key: message, **extra}), status_code
+    flash(message, 'success' if status_code < 400 else 'danger')
+    return redirect(url_for('files.dashboard'))
+
+
+def open_checked_upload(filename, size=0):
+    """Open the destination for an incoming file of `size` bytes after the extension check"""
+    if not filename:
+        raise UploadError('No selected file')
+    if not allowed_file(filename):
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        raise UploadError(f'File type not allowed: {ext}')
+    return open_upload(current_user.id, filename, size)
+
+
+def finish_upload(upload, category, tag_ids, reservation, as_json=False):
+    """Turn a fully received UploadSink into a File row.
+
+    The admission reservation is swapped for the real size in the same
+    transaction that creates the File.
+    """
+    current_app.logger.info(f"Received {upload.path}: {upload.size} bytes, sha256={upload.sha256}")
+
+    try:
+        tag_ids = [int(t) for t in tag_ids]
+    except (TypeError, ValueError):
+        tag_ids = []
+
+    try:
+        new_file = create_file_record(
+            current_user, upload.path, upload.original_filename, upload.size,
+            category=category, tag_ids=tag_ids, ip_address=request.remote_addr,
+            sha256=upload.sha256, mime_type=upload.mime_type
+        )
+        release_reservation(reservation)
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(f"Error committing upload {upload.original_filename}: {str(e)}")
+        db.session.rollback()
+        upload.abort()
+        cancel_reservation(reservation)
+        return upload_response(f'Database error: {str(e)}', 500, as_json)
+
+    after_upload(new_file)
+    return upload_response('File uploaded successfully', 200, as_json,
+                           file_id=new_file.id,
+                           filename=new_file.original_filename,
+                           size=new_file.file_size,
+                           sha256=new_file.sha256,
+                           mime_type=new_file.mime_type)
+
 
 @files_bp.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
-    # Log the request details
-    print(f"===== UPLOAD REQUEST =====")
-    print(f"User: {current_user.username} (ID: {current_user.id})")
-    print(f"Content-Type: {request.content_type}")
-    print(f"Form keys: {list(request.form.keys())}")
-    print(f"Files keys: {list(request.files.keys())}")
-    print(f"Headers: {request.headers}")
-    
-    if 'file' not in request.files:
-        print("Error: No file part in request")
-        return jsonify({'error': 'No file part'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        print("Error: No selected file - empty filename")
-        return jsonify({'error': 'No selected file'}), 400
+    """Multipart form upload.
 
-    print(f"File being uploaded: {file.filename}")
-    print(f"File content type: {file.content_type}")
-    
-    # Check if file type is allowed
-    if not allowed_file(file.filename):
-        print(f"Error: File type not allowed: {file.filename}")
-        ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
-        return jsonify({'error': f'File type not allowed: {ext}'}), 400
-    
+    The body is parsed incrementally and the file part is written straight
+    to its final path, instead of letting Werkzeug spool it to a temporary
+    file that then has to be copied again.
+    """
+    current_app.logger.info(f"Upload by {current_user.username} (ID: {current_user.id}), "
+                            f"Content-Type: {request.content_type}")
+
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        current_app.logger.warning("Upload refused: no file part in request")
+        return upload_response('No file part', 400)
+
+    # Admission: quota and disk space are checked against Content-Length
+    # before a single byte of the body is read. X-File-Size is not trusted
+    # here: the file part is capped at the reservation, and the body it
+    # comes in cannot be smaller than the part.
     try:
-        filename = secure_filename(file.filename)
-        category = request.form.get('category', 'other')
-        
-        # Get tags if any were selected
-        tag_ids = request.form.getlist('tags')
-        selected_tags = []
-        if tag_ids:
-            try:
-                selected_tags = Tag.query.filter(Tag.id.in_(tag_ids)).all()
-                print(f"Selected tags: {[tag.name for tag in selected_tags]}")
-            except Exception as e:
-                print(f"Error retrieving tags: {str(e)}")
-        
-        # Log more details
-        print(f"Attempting to upload file: {filename}, category: {category}")
-        print(f"User storage: used={current_user.storage_used}, limit={current_user.storage_limit}")
-        
-        # Create user directory if it doesn't exist
-        user_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], str(current_user.id))
-        print(f"User directory path: {user_dir}")
-        
-        # Check if directory exists and is writable
-        if not os.path.exists(user_dir):
-            print(f"Creating user directory: {user_dir}")
-            try:
-                os.makedirs(user_dir, exist_ok=True)
-                print(f"User directory created successfully")
-            except Exception as e:
-                print(f"Error creating user directory: {str(e)}")
-                return jsonify({'error': f'Could not create storage directory: {str(e)}'}), 500
-        
-        # Generate unique filename if file already exists
-        base_name, extension = os.path.splitext(filename)
-        counter = 1
-        final_filename = filename
-        while os.path.exists(os.path.join(user_dir, final_filename)):
-            final_filename = f"{base_name}_{counter}{extension}"
-            counter += 1
-        
-        # Log the final filename
-        print(f"Final filename: {final_filename}")
-        
-        # Create the full file path
-        file_path = os.path.join(user_dir, final_filename)
-        print(f"Full file path: {file_path}")
-        
-        # Save file temporarily to check size
-        temp_path = os.path.join(user_dir, f"temp_{final_filename}")
-        print(f"Saving to temporary path: {temp_path}")
-        file.save(temp_path)
-        
-        # Get file size
-        file_size = os.path.getsize(temp_path)
-        print(f"File size: {file_size} bytes")
-        
-        # Check storage limit
-        if current_user.storage_used + file_size > current_user.storage_limit:
-            print(f"Storage limit exceeded. Needed: {file_size}, Available: {current_user.storage_limit - current_user.storage_used}")
-            os.remove(temp_path)  # Remove the temporary file
-            return jsonify({'error': 'Storage limit exceeded'}), 400
-        
-        # Move from temp file to final location
-        try:
-            os.rename(temp_path, file_path)
-            print(f"File moved from temporary location to final path")
-        except Exception as e:
-            print(f"Error moving file from temp location: {str(e)}")
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            return jsonify({'error': f'Error saving file: {str(e)}'}), 500
-        
-        # Update user's storage usage
-        current_user.storage_used += file_size
-        print(f"Updated user storage: {current_user.storage_used}")
-        
-        # Get file type
-        file_type = category
-        if not file_type:
-            mime_type = mimetypes.guess_type(filename)[0]
-            if mime_type:
-                file_type = mime_type.split('/')[0]
-            else:
-                file_type = 'other'
-        
-        print(f"File type determined as: {file_type}")
-        
-        # Create file record
-        new_file = File(
-            filename=final_filename,
-            original_filename=file.filename,
-            file_type=file_type,
-            file_size=file_size,
-            category=category,
-            path=file_path,
-            user_id=current_user.id,
-            uploaded_at=datetime.utcnow(),
-            is_public=False
-        )
-        
-        print(f"File record created")
-        
-        # Add selected tags to the file
-        for tag in selected_tags:
-            new_file.tags.append(tag)
-            print(f"Added tag '{tag.name}' to file")
-        
-        # Automatically add FOLDER tag to archive files
-        if final_filename.lower().endswith(('.zip', '.rar', '.7z', '.tar.gz', '.tar')):
-            folder_tag = Tag.query.filter_by(name='FOLDER', is_system=True).first()
-            if folder_tag and folder_tag not in new_file.tags:
-                new_file.tags.append(folder_tag)
-                print(f"Added FOLDER tag automatically to archive file")
-        
-        # Log activity
-        activity = ActivityLog(
-            user_id=current_user.id,
-            action='file_upload',
-            details=f'Uploaded file: {final_filename}',
-            ip_address=request.remote_addr,
-            timestamp=datetime.utcnow()
-        )
-        
-        print(f"Activity log created")
-        
-        # Add records to database
-        db.session.add(new_file)
-        db.session.add(activity)
-        
-        # Commit transaction
-        try:
-            db.session.commit()
-            print(f"Database transaction committed successfully")
-        except Exception as e:
-            print(f"Error committing to database: {str(e)}")
-            db.session.rollback()
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            return jsonify({'error': f'Database error: {str(e)}'}), 500
-        
-        # Check if this is an AJAX request
-        is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        if is_ajax:
-            return jsonify({
-                'message': 'File uploaded successfully',
-                'file_id': new_file.id,
-                'filename': new_file.original_filename
-            }), 200
-        else:
-            # For non-AJAX requests, redirect to the dashboard
-            flash('File uploaded successfully', 'success')
-            return redirect(url_for('files.dashboard'))
-        
+        reservation = reserve_storage(current_user, declared_upload_size(request, allow_header=False))
+    except UploadError as e:
+        current_app.logger.warning(f"Upload refused: {e.message}")
+        return upload_response(e.message, e.status_code)
+
+    def open_admitted_upload(name):
+        sink = open_checked_upload(name, reservation.size)
+        sink.max_size = reservation.size
+        return sink
+
+    try:
+        stream = get_qos().upload_stream(request.stream, current_user.id)
+        fields, upload = receive_multipart(stream, options['boundary'], open_admitted_upload)
+    except UploadError as e:
+        current_app.logger.warning(f"Upload failed: {e.message}")
+        cancel_reservation(reservation)
+        return upload_response(e.message, e.status_code)
     except Exception as e:
-        # Log the full error
-        print(f"Unhandled error in upload: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        
-        # Clean up any temporary files
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            os.remove(temp_path)
-        if 'file_path' in locals() and os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # Roll back any database changes
+        current_app.logger.error(f"Unhandled error in upload: {str(e)}")
         db.session.rollback()
-        
-        is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        if is_ajax:
-            return jsonify({'error': f'Upload failed: {str(e)}'}), 500
-        else:
-            flash(f'Upload failed: {str(e)}', 'danger')
-            return redirect(url_for('files.dashboard'))
+        cancel_reservation(reservation)
+        return upload_response(f'Upload failed: {str(e)}', 500)
 
-@files_bp.route('/download/<int:file_id>')
+    if upload is None:
+        current_app.logger.warning("Upload refused: no file part in request")
+        cancel_reservation(reservation)
+        return upload_response('No file part', 400)
+
+    return finish_upload(upload, fields.get('category', 'other'), fields.getlist('tags'), reservation)
+
+
+@files_bp.route('/upload/raw', methods=['PUT', 'POST'])
 @login_required
+def upload_raw():
+    """Raw-body upload: the request body is the file itself.
+
+    The name comes from the X-File-Name header (percent-encoded) or the
+    `filename` query argument; `category` and `tags` are query arguments.
+    The size must be known up front, from Content-Length or X-File-Size.
+    """
+    filename = unquote(request.headers.get('X-File-Name', '')) or request.args.get('filename', '')
+    try:
+        size = declared_upload_size(request)
+        upload = open_checked_upload(filename, size)
+    except UploadError as e:
+        return upload_response(e.message, e.status_code, as_json=True)
+
+    try:
+        reservation = reserve_storage(current_user, size)
+    except UploadError as e:
+        upload.abort()
+        return upload_response(e.message, e.status_code, as_json=True)
+
+    try:
+        upload.max_size = size
+        receive_raw(get_qos().upload_stream(request.stream, current_user.id), upload)
+    except UploadError as e:
+        cancel_reservation(reservation)
+        return upload_response(e.message, e.status_code, as_json=True)
+    except Exception as e:
+        current_app.logger.error(f"Raw upload failed: {str(e)}")
+        db.session.rollback()
+        cancel_reservation(reservation)
+        return upload_response(f'Upload failed: {str(e)}', 500, as_json=True)
+
+    return finish_upload(upload, request.args.get('category', 'other'), request.args.getlist('tags'),
+                         reservation, as_json=True)
+
+
+@files_bp.route('/upload/admit')
+def admit_upload():
+    """Headers-only admission check, for nginx's auth_request.
+
+    The WSGI server answers Expect: 100-continue before the app runs, so
+    upload_file() and upload_raw() can only refuse once the client has
+    started sending. nginx asks here first, with the upload's headers and
+    X-Original-URI and X-Upload-Length (its Content-Length) added, and
+    refuses before it reads the body. auth_request only passes 401 and
+    403 on, so a refusal is a 403 carrying the real status and message in
+    X-Upload-Status and X-Upload-Error (see deployment/nginx.conf).
+    Anonymous requests are let through to get the usual login redirect.
+    """
+    if not current_user.is_authenticated:
+        return '', 204
+    raw = urlsplit(request.headers.get('X-Original-URI', '')).path.endswith('/upload/raw')
+    declared = (request.headers.get('X-File-Size') if raw else None) or request.headers.get('X-Upload-Length')
+    try:
+        check_admission(current_user, parse_upload_size(declared))
+    except UploadError as e:
+        current_app.logger.info(f"Upload refused before its body: {e.message}")
+        return '', 403, {'X-Upload-Status': str(e.status_code), 'X-Upload-Error': e.message}
+    return '', 204
+
+@files_bp.route('/download/<int:file_id>')
 def download_file(file_id):
+    # Range requests of a download that was already authorised and logged
+    sessions = get_download_sessions()
+    key = sessions.key(file_id)
+    cached = sessions.get(key)
+    if cached is not None:
+        try:
+            return serve_file(cached, as_attachment=True)
+        except FileNotFoundError:
+            # Deleted or moved since; look it up again
+            sessions.discard(key)
+    
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    
     file = File.query.get_or_404(file_id)
     
     # Check if user has access to file
@@ -271,10 +272,90 @@ def download_file(file_id):
     file.last_accessed = datetime.utcnow()
     db.session.commit()
     
-    return send_file(
-        file.path,
-        as_attachment=True,
-        download_name=file.original_filename
+    sessions.add(key, file)
+    try:
+        return serve_file(file, as_attachment=True)
+    except FileNotFoundError:
+        current_app.logger.error(f"File {file.id} has no body at {file.path}")
+        abort(404)
+
+@files_bp.route('/stream/<int:file_id>')
+@login_required
+def stream(file_id):
+    """Inline view of a file for the preview page (images, video, PDF)"""
+    file = File.query.get_or_404(file_id)
+    
+    if file.user_id != current_user.id:
+        abort(403)
+    
+    # Players fetch many ranges per view, so only last_accessed is updated here
+    file.last_accessed = datetime.utcnow()
+    db.session.commit()
+    
+    return serve_file(file, as_attachment=False)
+
+@files_bp.route('/preview/<int:file_id>')
+@login_required
+def preview(file_id):
+    file = File.query.get_or_404(file_id)
+    
+    if file.user_id != current_user.id:
+        abort(403)
+    
+    video = is_video(file)
+    media = cached_media_info(file)
+    return render_template('files/preview.html', file=file, is_video=video,
+                           hls_available=video and not file.is_chunked,
+                           sprites_available=media is not None and wants_sprites(file, media),
+                           pdf_viewer=is_pdf(file),
+                           media=media)
+
+def serve_file(file, as_attachment):
+    """Response with a file's body, once access has been checked and logged.
+    
+    `file` is a File or a download session's FileSnapshot.
+    
+    Behind nginx the transfer is handed off with X-Accel-Redirect; without
+    a proxy (or for chunked files, which only Flask can reassemble) the
+    range engine serves it in-process, paced by the QoS scheduler.
+    """
+    mimetype = guess_mimetype(file.mime_type, file.original_filename)
+    qos = get_qos()
+    inline = not as_attachment
+    if file.is_chunked:
+        return send_chunked_file(file, mimetype, as_attachment,
+                                 shaper=qos.download_shaper(file.user_id, file.file_size, inline))
+    
+    if accel_enabled():
+        rv = accel_response(file.path, mimetype, as_attachment, file.original_filename,
+                            limit_rate=qos.accel_rate(file.user_id, file.file_size, inline))
+        if rv is not None:
+            return rv
+    
+    return send_stored_path(file.path, mimetype, etag=file.sha256,
+                            as_attachment=as_attachment, download_name=file.original_filename,
+                            shaper=qos.download_shaper(file.user_id, file.file_size, inline))
+
+def send_chunked_file(file, mimetype, as_attachment=True, shaper=None):
+    """Range-served body of a file reassembled from the chunk store.
+    
+    The reader is seekable, so Range requests are answered by seeking to
+    the right chunk instead of streaming everything before it.
+    """
+    reader = open_stored_file(file)
+    if reader.raw.size != file.file_size:
+        # Its chunks were released since the File was looked up
+        reader.close()
+        raise FileNotFoundError(f'Chunks of file {file.id} are gone')
+    return send_ranged(
+        reader,
+        file.file_size,
+        mimetype,
+        etag=file.sha256 or f'chunked-{file.id}-{file.file_size}',
+        last_modified=file.uploaded_at,
+        as_attachment=as_attachment,
+        download_name=file.original_filename,
+        shaper=shaper
     )
 
 @files_bp.route('/delete/<int:file_id>', methods=['POST'])
@@ -293,16 +374,14 @@ def delete_file(file_id):
         return jsonify({'error': 'Permission denied'}), 403
     
     try:
-        # Delete physical file
-        if os.path.exists(file.path):
-            os.remove(file.path)
-            print(f"Deleted physical file: {file.path}")
-        else:
+        # Delete physical file, or drop its reference to a shared blob
+        if not (file.blob_sha256 or file.is_chunked) and not os.path.exists(file.path):
             print(f"Physical file not found: {file.path}")
+        release_file(file)
+        print(f"Released file: {file.path}")
         
         # Update user's storage usage
-        current_user.storage_used = max(0, current_user.storage_used - file.file_size)
-        print(f"Updated user storage: {current_user.storage_used}")
+        adjust_storage_used(file.user_id, -(file.file_size or 0))
         
         # Log deletion
         activity = ActivityLog(
@@ -317,6 +396,12 @@ def delete_file(file_id):
         # Delete database record
         db.session.delete(file)
         db.session.commit()
+        get_download_sessions().forget_file(file_id)
+        get_derivatives().forget(file_id)
+        get_pdf_pages().forget(file_id)
+        get_transcoder().forget(file_id)
+        search.remove_file(file_id)
+        get_embeddings().remove_file(file_id)
         print(f"File {file_id} deleted successfully")
         
         # Check if this is an AJAX request
@@ -368,6 +453,7 @@ def tag_file(file_id):
                 file.tags.append(tag)
         
         db.session.commit()
+        search.update_tags([file])
         
         # Log tag update
         activity = ActivityLog(
@@ -445,8 +531,10 @@ def manage_tags():
             if tag.is_system:
                 flash('Cannot delete system tags', 'danger')
             else:
+                tagged = tag.files.all()
                 db.session.delete(tag)
                 db.session.commit()
+                search.update_tags(tagged)
                 flash('Tag deleted successfully', 'success')
         
         return redirect(url_for('files.manage_tags'))
@@ -504,6 +592,13 @@ def request_storage():
     
     return redirect(url_for('auth.profile'))
 
+@files_bp.route('/dedup_stats')
+@login_required
+def dedup_stats():
+    """How much the current user's files shrink through deduplication"""
+    from app.utils.chunk_store import dedup_stats as user_dedup_stats
+    return jsonify(user_dedup_stats(current_user.id))
+
 @files_bp.route('/list')
 @login_required
 def file_list():
@@ -530,8 +625,6 @@ def file_list():
 
 
 
-AI_SUMMARIZE_API = "http://192.168.1.23:8000/summarize"  # <- zamenjaj z IP tvojega PC-ja
-
 @files_bp.route('/summarize/<int:file_id>')
 @login_required
 def summarize_file(file_id):
@@ -540,28 +633,20 @@ def summarize_file(file_id):
     if file.user_id != current_user.id:
         abort(403)
 
-    if not os.path.exists(file.path):
+    if not file.is_chunked and not os.path.exists(file.path):
         flash("File doesn't exist.", "danger")
         return redirect(url_for("files.dashboard"))
 
-    ext = os.path.splitext(file.filename)[1].lower()
-    
+    if not is_text_candidate(file):
+        flash("Summary is only possible for .txt, .pdf and .docx files", "warning")
+        return redirect(url_for("files.dashboard"))
+
     try:
-        # 🔹 Preberi besedilo glede na končnico
-        if ext == ".txt":
-            with open(file.path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
-        elif ext == ".pdf":
-            reader = PdfReader(file.path)
-            content = "\n".join(page.extract_text() or "" for page in reader.pages)
-        else:
-            flash("Summary is only possible for .txt and .pdf files", "warning")
-            return redirect(url_for("files.dashboard"))
+        # 🔹 Preberi besedilo (iz predpomnilnika, če je dokument že bil prebran)
+        content = get_text_cache().get_text(file)
 
-        # 🔹 Pošlji AI strežniku
-        res = requests.post(AI_SUMMARIZE_API, json={"text": content}, timeout=60)
-        res.raise_for_status()
-        summary = res.json().get("summary", "[Ni bilo povzetka]")
+        # 🔹 Pošlji AI strežniku (dolga besedila po delih)
+        summary = get_summarizer().summarize(content) or "[Ni bilo povzetka]"
     except Exception as e:
         summary = f"Error at geneerating a summary: {e}"
 
@@ -0,0 +1,254 @@
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from flask import Blueprint, jsonify, current_app, abort, request, redirect, url_for
+from flask_login import login_required, current_user
+from app.models import File
+from app.utils.hls import (
+    get_transcoder, cache_key, is_video, master_playlist, media_playlist, renditions_for, segment_count
+)
+from app.utils.media_info import get_media_info
+from app.utils.ranges import send_stored_path
+from app.utils.sprites import (
+    SPRITE_MIMETYPES, is_candidate as wants_sprites, is_current as sprites_current, queue_sprites
+)
+from app.utils.storage import content_version, sprite_index_path, sprite_sheet_path
+from app.utils.background import get_queue, PRIORITY_INTERACTIVE
+from app.utils.derivatives import FORMATS, get_derivatives, derivative_url, is_candidate as has_derivatives
+from app.utils.pdf_pages import get_pdf_pages, is_candidate as is_pdf
+from app.utils.qos import get_qos
+
+media_bp = Blueprint('media', __name__, url_prefix='/media')
+
+PLAYLIST_MIMETYPE = 'application/vnd.apple.mpegurl'
+
+
+def get_own_video(file_id):
+    """The current user's video and its probe data, or abort"""
+    file = File.query.get_or_404(file_id)
+    if file.user_id != current_user.id:
+        abort(403)
+    # ffmpeg needs a real, seekable path; chunked files are streamed as they are
+    if not is_video(file) or file.is_chunked:
+        abort(404)
+    info = get_media_info(file)
+    metadata = info.video_metadata() if info else None
+    if metadata is None:
+        abort(404)
+    return file, cache_key(file), metadata
+
+
+def playlist_response(text):
+    rv = current_app.response_class(text, mimetype=PLAYLIST_MIMETYPE)
+    rv.cache_control.private = True
+    rv.cache_control.no_cache = True
+    return rv
+
+
+@media_bp.route('/hls/<int:file_id>/master.m3u8')
+@login_required
+def hls_master(file_id):
+    """Master playlist offering every rendition up to the source resolution"""
+    _, _, metadata = get_own_video(file_id)
+    return playlist_response(master_playlist(metadata, current_app.config['HLS_RENDITIONS']))
+
+
+def find_rendition(metadata, name):
+    for rendition in renditions_for(metadata, current_app.config['HLS_RENDITIONS']):
+        if rendition['name'] == name:
+            return rendition
+    abort(404)
+
+
+@media_bp.route('/hls/<int:file_id>/<rendition>.m3u8')
+@login_required
+def hls_playlist(file_id, rendition):
+    _, _, metadata = get_own_video(file_id)
+    rendition = find_rendition(metadata, rendition)
+    return playlist_response(media_playlist(metadata, rendition, current_app.config['HLS_SEGMENT_SECONDS']))
+
+
+@media_bp.route('/hls/<int:file_id>/<rendition>/<int:index>.ts')
+@login_required
+def hls_segment(file_id, rendition, index):
+    """One segment, transcoded on first request and served from the cache after that"""
+    file, key, metadata = get_own_video(file_id)
+    rendition = find_rendition(metadata, rendition)
+    if index >= segment_count(metadata.get('duration') or 0, current_app.config['HLS_SEGMENT_SECONDS']):
+        abort(404)
+    transcoder = get_transcoder()
+    try:
+        path = transcoder.get_segment(file.path, key, metadata, rendition, index)
+    except FutureTimeoutError:
+        return jsonify({'error': 'Segment is still being transcoded'}), 503
+    except Exception as e:
+        current_app.logger.error(f"Could not produce segment {index} of file {file_id}: {str(e)}")
+        return jsonify({'error': 'Transcoding failed'}), 500
+
+    shaper = get_qos().download_shaper(file.user_id, 0, interactive=True)
+    try:
+        rv = send_stored_path(path, 'video/mp2t', shaper=shaper)
+    except FileNotFoundError:
+        # Evicted between the lookup and the send
+        path = transcoder.get_segment(file.path, key, metadata, rendition, index)
+        rv = send_stored_path(path, 'video/mp2t', shaper=shaper)
+    # Segments never change for a given content version
+    rv.cache_control.no_cache = None
+    rv.cache_control.private = True
+    rv.cache_control.max_age = 86400
+    return rv
+
+
+def get_own_scrub_video(file_id):
+    file = File.query.get_or_404(file_id)
+    if file.user_id != current_user.id:
+        abort(403)
+    if not wants_sprites(file):
+        abort(404)
+    return file
+
+
+@media_bp.route('/sprites/<int:file_id>/index.vtt')
+@login_required
+def sprite_index(file_id):
+    """WebVTT map of the scrub thumbnails; generation is queued on first request"""
+    file = get_own_scrub_video(file_id)
+    if not sprites_current(file):
+        info = get_media_info(file, probe=False)
+        if info is not None and not wants_sprites(file, info):
+            abort(404)
+        queue_sprites(file.id)
+        return jsonify({'error': 'Preview thumbnails are still being generated'}), 503
+    rv = send_stored_path(sprite_index_path(file.path), 'text/vtt')
+    rv.cache_control.private = True
+    return rv
+
+
+@media_bp.route('/sprites/<int:file_id>/<int:sheet>.<ext>')
+@login_required
+def sprite_sheet(file_id, sheet, ext):
+    file = get_own_scrub_video(file_id)
+    if ext not in SPRITE_MIMETYPES:
+        abort(404)
+    try:
+        rv = send_stored_path(sprite_sheet_path(file.path, sheet, ext), SPRITE_MIMETYPES[ext])
+    except FileNotFoundError:
+        abort(404)
+    # The index links sheets with a version, so a cached sheet is never outdated
+    rv.cache_control.no_cache = None
+    rv.cache_control.private = True
+    rv.cache_control.max_age = 86400
+    return rv
+
+
+@media_bp.route('/image/<int:file_id>/<version>/<int:size>')
+@login_required
+def image_derivative(file_id, version, size):
+    """A resized copy of an image, WebP where the browser accepts it.
+
+    The URL carries the content version, so the response never changes
+    and is cached as immutable; an outdated version redirects.
+    """
+    file = File.query.get_or_404(file_id)
+    if file.user_id != current_user.id:
+        abort(403)
+    if size not in current_app.config['DERIVATIVE_SIZES'] or not has_derivatives(file):
+        abort(404)
+    try:
+        current = content_version(file)
+    except FileNotFoundError:
+        abort(404)
+    if version != current:
+        return redirect(derivative_url(file, size))
+
+    fmt = preferred_image_format()
+    derivatives = get_derivatives()
+    return send_rendered(lambda: derivatives.lookup(file, size, fmt), 'derivative', file.id,
+                         f'{size}.{fmt}', FORMATS[fmt][1])
+
+
+def preferred_image_format():
+    return 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpg'
+
+
+def send_rendered(lookup, kind, file_id, args, mimetype):
+    """Serve a cached rendering, having the job workers make it first if needed.
+
+    Renders run on the job queue, ahead of background work, so a page
+    full of thumbnails cannot start more decodes than MAX_WORKERS. URLs
+    of renderings carry the content version, so responses are immutable.
+    """
+    path = lookup()
+    if path is None:
+        queue = get_queue()
+        queue.enqueue(kind, file_id, args, PRIORITY_INTERACTIVE)
+        if not queue.wait(kind, file_id, args):
+            return jsonify({'error': 'Preview is still being rendered'}), 503
+        path = lookup()
+        if path is None:
+            return jsonify({'error': 'Preview could not be rendered'}), 415
+    try:
+        rv = send_stored_path(path, mimetype)
+    except FileNotFoundError:
+        # Evicted between the lookup and the send
+        return jsonify({'error': 'Preview is still being rendered'}), 503
+    rv.cache_control.no_cache = None
+    rv.cache_control.private = True
+    rv.cache_control.max_age = 31536000
+    rv.cache_control.immutable = True
+    rv.vary.add('Accept')
+    return rv
+
+
+def get_own_pdf(file_id):
+    file = File.query.get_or_404(file_id)
+    if file.user_id != current_user.id:
+        abort(403)
+    if not is_pdf(file):
+        abort(404)
+    return file
+
+
+@media_bp.route('/pdf/<int:file_id>/info')
+@login_required
+def pdf_info(file_id):
+    """Page count, first page size (points) and the versioned base URL of the pages"""
+    file = get_own_pdf(file_id)
+    try:
+        info = get_pdf_pages().info(file)
+    except FileNotFoundError:
+        abort(404)
+    except (RuntimeError, ValueError) as e:
+        return jsonify({'error': f'PDF could not be opened: {str(e)}'}), 415
+    info['dpis'] = list(current_app.config['PDF_PAGE_DPIS'])
+    # Pages are at <pages_url>/<page>/<dpi>
+    base = url_for('media.pdf_info', file_id=file.id).rsplit('/', 1)[0]
+    info['pages_url'] = f'{base}/{content_version(file)}'
+    rv = jsonify(info)
+    rv.cache_control.private = True
+    rv.cache_control.no_cache = True
+    return rv
+
+
+@media_bp.route('/pdf/<int:file_id>/<version>/<int:page>/<int:dpi>')
+@login_required
+def pdf_page(file_id, version, page, dpi):
+    """One PDF page as an image, rendered on first request at one of PDF_PAGE_DPIS"""
+    file = get_own_pdf(file_id)
+    if dpi not in current_app.config['PDF_PAGE_DPIS'] or page < 1:
+        abort(404)
+    try:
+        current = content_version(file)
+    except FileNotFoundError:
+        abort(404)
+    if version != current:
+        return redirect(url_for('media.pdf_page', file_id=file.id, version=current, page=page, dpi=dpi))
+
+    fmt = preferred_image_format()
+    pdf_pages = get_pdf_pages()
+    if pdf_pages.lookup(file, page, dpi, fmt) is None:
+        try:
+            if page > pdf_pages.info(file)['pages']:
+                abort(404)
+        except (RuntimeError, ValueError) as e:
+            return jsonify({'error': f'PDF could not be opened: {str(e)}'}), 415
+    return send_rendered(lambda: pdf_pages.lookup(file, page, dpi, fmt), 'pdf_page', file.id,
+                         f'{page}.{dpi}.{fmt}', FORMATS[fmt][1])
@@ -0,0 +1,94 @@
+import time
+import requests
+from flask import Blueprint, request, jsonify, current_app, url_for
+from flask_login import login_required, current_user
+from app.utils import search
+from app.utils.embeddings import get_embeddings, is_enabled as semantic_enabled
+
+search_bp = Blueprint('search', __name__, url_prefix='/search')
+
+
+@search_bp.route('/files')
+@login_required
+def search_files():
+    """Full-text search over the current user's files, best matches first.
+
+    `name` and `snippet` are HTML: the file's text escaped, with the
+    matched words in <mark>.
+    """
+    terms = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', current_app.config['SEARCH_RESULTS_LIMIT'], type=int) or 1,
+                current_app.config['SEARCH_RESULTS_LIMIT'])
+    started = time.perf_counter()
+    results = search.search(current_user.id, terms, limit)
+    return jsonify({
+        'query': terms,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2),
+        'results': [{
+            'id': file.id,
+            'name': str(name),
+            'snippet': str(snippet),
+            'category': file.category,
+            'tags': [tag.name for tag in file.tags],
+            'size': file.file_size,
+            'uploaded_at': file.uploaded_at.isoformat() if file.uploaded_at else None,
+            'preview_url': url_for('files.preview', file_id=file.id),
+            'score': round(-rank, 3)
+        } for file, name, snippet, rank in results]
+    })
+
+
+@search_bp.route('/names')
+@login_required
+def suggest_names():
+    """Search-as-you-type over the current user's file names.
+
+    Matches names containing `q` anywhere, or failing that names that look
+    like it; `name` is HTML with the matched part in <mark>.
+    """
+    terms = request.args.get('q', '')[:100]
+    limit = min(request.args.get('limit', 10, type=int) or 1, current_app.config['SEARCH_RESULTS_LIMIT'])
+    started = time.perf_counter()
+    results = search.suggest_names(current_user.id, terms, limit)
+    return jsonify({
+        'query': terms,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2),
+        'results': [{
+            'id': file.id,
+            'name': str(name),
+            'category': file.category,
+            'preview_url': url_for('files.preview', file_id=file.id)
+        } for file, name in results]
+    })
+
+
+@search_bp.route('/semantic')
+@login_required
+def semantic_search():
+    """The current user's documents closest in meaning to `q`.
+
+    Only the query is sent to the AI server, once per distinct query; the
+    documents' embeddings are already stored and scored locally.
+    """
+    if not semantic_enabled():
+        return jsonify({'error': 'Semantic search is not enabled'}), 404
+    terms = ' '.join(request.args.get('q', '').split())[:500]
+    if not terms:
+        return jsonify({'query': terms, 'results': []})
+    limit = min(request.args.get('limit', 10, type=int) or 1, current_app.config['SEARCH_RESULTS_LIMIT'])
+    started = time.perf_counter()
+    try:
+        results = get_embeddings().search(current_user.id, terms, limit)
+    except (requests.RequestException, ValueError) as e:
+        return jsonify({'error': f'AI server unavailable: {str(e)}'}), 503
+    return jsonify({
+        'query': terms,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2),
+        'results': [{
+            'id': file.id,
+            'name': file.original_filename,
+            'excerpt': excerpt,
+            'score': round(score, 4),
+            'preview_url': url_for('files.preview', file_id=file.id)
+        } for file, score, excerpt in results]
+    })
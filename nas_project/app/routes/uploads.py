@@ -0,0 +1,201 @@
+from flask import Blueprint, request, jsonify, current_app
+from flask_login import login_required, current_user
+from app.models import db, UploadSession
+from app.routes.files import allowed_file
+from app.utils.storage import create_file_record, place_upload
+from app.utils.upload_sessions import (
+    ChunkError, create_session, write_chunk, missing_chunks, finish_data_file,
+    discard_session, expire_stale_sessions, get_session_dir, get_reservation,
+    restore_data_file, fail_session, claim_session
+)
+from app.utils.upload_stream import UploadError
+from app.utils.quota import reserve_storage, release_reservation
+from app.utils.qos import get_qos
+from app.utils.media_jobs import after_upload
+import shutil
+
+uploads_bp = Blueprint('uploads', __name__, url_prefix='/files/uploads')
+
+
+def get_own_session(upload_id):
+    session = UploadSession.query.get(upload_id)
+    if not session or session.user_id != current_user.id:
+        return None
+    return session
+
+
+def completed_response(session):
+    return jsonify({
+        'message': 'File uploaded successfully',
+        'file_id': session.file_id,
+        'filename': session.original_filename
+    }), 200
+
+
+def session_response(session):
+    data = session.to_dict()
+    data['parallel_chunks'] = current_app.config['UPLOAD_PARALLEL_CHUNKS']
+    return data
+
+
+@uploads_bp.route('', methods=['POST'])
+@login_required
+def create_upload():
+    """Open a resumable upload: {filename, size, category?, tags?}"""
+    data = request.get_json(silent=True) or request.form
+    filename = data.get('filename', '')
+    category = data.get('category') or 'other'
+    tag_ids = data.getlist('tags') if hasattr(data, 'getlist') else data.get('tags', [])
+
+    try:
+        total_size = int(data.get('size'))
+        if total_size < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({'error': 'A valid file size is required'}), 400
+
+    if not filename:
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not allowed_file(filename):
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        return jsonify({'error': f'File type not allowed: {ext}'}), 400
+
+    try:
+        tag_ids = [int(t) for t in tag_ids]
+    except (TypeError, ValueError):
+        tag_ids = []
+
+    expire_stale_sessions(current_user.id)
+
+    # Admit the whole file now, before a single chunk is sent
+    try:
+        reservation = reserve_storage(current_user, total_size, expires=False)
+    except UploadError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+    try:
+        session = create_session(current_user, filename, total_size, category, tag_ids,
+                                 reservation=reservation)
+    except OSError as e:
+        current_app.logger.error(f"Could not allocate upload of {total_size} bytes: {str(e)}")
+        return jsonify({'error': 'Not enough free disk space'}), 507
+    return jsonify(session_response(session)), 201
+
+
+@uploads_bp.route('/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Report which chunks (and byte offsets) the server already has"""
+    session = get_own_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(session_response(session)), 200
+
+
+@uploads_bp.route('/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    """Store one chunk. Safe to repeat; X-Chunk-SHA256 is verified when sent."""
+    session = get_own_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    if session.status != 'active':
+        return jsonify({'error': 'Upload already finished'}), 409
+
+    try:
+        stream = get_qos().upload_stream(request.stream, current_user.id)
+        chunk = write_chunk(session, index, stream,
+                            checksum=request.headers.get('X-Chunk-SHA256'))
+    except ChunkError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except OSError as e:
+        current_app.logger.error(f"Error writing chunk {index} of {upload_id}: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': f'Could not store chunk: {str(e)}'}), 500
+
+    return jsonify({
+        'index': chunk.chunk_index,
+        'offset': chunk.chunk_index * session.chunk_size,
+        'size': chunk.size,
+        'checksum': chunk.checksum
+    }), 200
+
+
+@uploads_bp.route('/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    """Assemble the received chunks into a File"""
+    session = get_own_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    if session.status == 'active':
+        missing = missing_chunks(session)
+        if missing:
+            return jsonify({'error': 'Upload incomplete', 'missing': missing}), 409
+    if not claim_session(session):
+        if session.status == 'completed':
+            # Finalize was retried after a lost response
+            return completed_response(session)
+        if session.status == 'failed':
+            return jsonify({'error': 'Upload failed, start it again'}), 409
+        return jsonify({'error': 'Upload is being completed'}), 409
+
+    file_path = None
+    sha256 = None
+    try:
+        # Chunks were written in place, so finalizing is a rename
+        data_path, sha256, mime_type = finish_data_file(session)
+        file_path = place_upload(current_user, data_path, session.original_filename)
+
+        tag_ids = [int(t) for t in session.tag_ids.split(',') if t] if session.tag_ids else []
+        new_file = create_file_record(
+            current_user, file_path, session.original_filename, session.total_size,
+            category=session.category, tag_ids=tag_ids, ip_address=request.remote_addr,
+            sha256=sha256, mime_type=mime_type
+        )
+        db.session.flush()
+        release_reservation(get_reservation(session))
+
+        session.status = 'completed'
+        session.file_id = new_file.id
+        for chunk in session.chunks:
+            db.session.delete(chunk)
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(f"Error finalizing upload {upload_id}: {str(e)}")
+        db.session.rollback()
+        # Keep the session resumable: the client may retry the completion
+        try:
+            restored = restore_data_file(session, file_path, sha256)
+        except OSError as restore_error:
+            current_app.logger.error(f"Could not restore upload {upload_id}: {str(restore_error)}")
+            restored = False
+        if restored:
+            session.status = 'active'
+            db.session.commit()
+        else:
+            fail_session(session)
+            db.session.commit()
+            shutil.rmtree(get_session_dir(session.id), ignore_errors=True)
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
+    shutil.rmtree(get_session_dir(session.id), ignore_errors=True)
+    after_upload(new_file)
+
+    return completed_response(session)
+
+
+@uploads_bp.route('/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_upload(upload_id):
+    session = get_own_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    if session.status == 'finalizing':
+        return jsonify({'error': 'Upload is being completed'}), 409
+    discard_session(session)
+    db.session.commit()
+    return jsonify({'message': 'Upload cancelled'}), 200
@@ -34,6 +34,11 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
+// Resumable uploads: the file is sent as numbered chunks to an upload session.
+// The session id is remembered in localStorage so picking the same file again
+// after a dropped connection or page reload continues where it stopped.
+const UPLOAD_MAX_RETRIES = 5;
+
 function uploadFile() {
     const fileInput = document.querySelector('#uploadForm input[type="file"]');
     const categorySelect = document.querySelector('#uploadForm select[name="category"]');
@@ -54,175 +59,193 @@ function uploadFile() {
     if (categorySelect) categorySelect.disabled = true;
     if (uploadButton) uploadButton.innerHTML = '<span class="spinner-border spinner-border-sm me-2"></span>Uploading...';
 
-    const formData = new FormData(form);
     const file = fileInput.files[0];
+    const tags = Array.from(form.querySelectorAll('input[name="tags"]:checked')).map(el => el.value);
     console.log(`Starting upload of ${file.name} (${formatFileSize(file.size)})`);
 
-    const xhr = new XMLHttpRequest();
-    xhr.open('POST', '/files/upload', true);
-    xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
-
-    // Add event listeners for progress updates
-    xhr.upload.onprogress = function(e) {
-        if (e.lengthComputable && progressBar && progressText) {
-            const percent = (e.loaded / e.total) * 100;
-            progressBar.style.width = percent + '%';
-            progressText.textContent = Math.round(percent) + '%';
-            
-            // Log progress to console for debugging
-            console.log(`Upload progress: ${Math.round(percent)}% (${formatFileSize(e.loaded)} of ${formatFileSize(e.total)})`);
-            
-            // Update upload speed and time estimate if these elements exist
-            const speedSpan = document.querySelector('.upload-speed');
-            const timeSpan = document.querySelector('.upload-time');
-            const sizeSpan = document.querySelector('.upload-size');
-            
-            if (speedSpan && timeSpan && sizeSpan) {
-                // Calculate upload speed
-                const currentTime = new Date().getTime();
-                const elapsedTime = (currentTime - uploadStartTime) / 1000; // in seconds
-                const speed = e.loaded / elapsedTime; // bytes per second
-                
-                // Update displayed info
-                speedSpan.textContent = `${formatFileSize(speed)}/s`;
-                sizeSpan.textContent = `${formatFileSize(e.loaded)} / ${formatFileSize(e.total)}`;
-                
-                // Calculate time remaining
-                const remaining = e.total - e.loaded;
-                const timeRemaining = remaining / speed; // seconds
-                timeSpan.textContent = `Time remaining: ${formatTime(timeRemaining)}`;
-            }
+    const uploadStartTime = new Date().getTime();
+    let bytesThisRun = 0;
+
+    function resetForm() {
+        if (uploadButton) {
+            uploadButton.disabled = false;
+            uploadButton.innerHTML = 'Upload';
         }
-    };
+        if (fileInput) fileInput.disabled = false;
+        if (categorySelect) categorySelect.disabled = false;
+    }
 
-    // Track upload start time
-    const uploadStartTime = new Date().getTime();
+    function showProgress(received, total) {
+        if (!progressBar || !progressText) return;
+        const percent = total ? (received / total) * 100 : 100;
+        progressBar.style.width = percent + '%';
+        progressText.textContent = Math.round(percent) + '%';
 
-    xhr.upload.onloadstart = function() {
-        console.log("Upload started");
-    };
+        // Update upload speed and time estimate if these elements exist
+        const speedSpan = document.querySelector('.upload-speed');
+        const timeSpan = document.querySelector('.upload-time');
+        const sizeSpan = document.querySelector('.upload-size');
 
-    xhr.upload.onloadend = function() {
-        console.log("Upload finished");
-    };
+        if (speedSpan && timeSpan && sizeSpan) {
+            const elapsedTime = (new Date().getTime() - uploadStartTime) / 1000; // in seconds
+            const speed = bytesThisRun / Math.max(elapsedTime, 0.001); // bytes per second
 
-    xhr.onload = function() {
-        console.log(`Server response status: ${xhr.status}`);
-        console.log(`Server response text: ${xhr.responseText}`);
-        
-        if (xhr.status === 200) {
-            try {
-                // Parse the JSON response
-                const response = JSON.parse(xhr.responseText);
-                console.log("JSON response:", response);
+            speedSpan.textContent = `${formatFileSize(speed)}/s`;
+            sizeSpan.textContent = `${formatFileSize(received)} / ${formatFileSize(total)}`;
+            timeSpan.textContent = `Time remaining: ${formatTime((total - received) / Math.max(speed, 1))}`;
+        }
+    }
+
+    openUploadSession(file, categorySelect ? categorySelect.value : 'other', tags)
+        .then(session => sendMissingChunks(file, session, (received) => showProgress(received, file.size),
+                                           (sent) => { bytesThisRun += sent; }))
+        .then(session => uploadRequest('POST', `/files/uploads/${session.upload_id}/complete`))
+        .then(response => {
+            console.log("Upload finished:", response);
+            localStorage.removeItem(uploadResumeKey(file));
+
+            // Update UI for success
+            if (progressBar) {
+                progressBar.classList.remove('bg-danger');
+                progressBar.classList.add('bg-success');
+                progressBar.style.width = '100%';
+            }
+            if (progressText) {
+                progressText.textContent = '100%';
+            }
 
-                // Update UI for success
+            // Close modal and reset after delay
+            setTimeout(function() {
+                const bsModal = bootstrap.Modal.getInstance(uploadModal);
+                if (bsModal) bsModal.hide();
+
+                // Reset form and progress
+                if (form) form.reset();
                 if (progressBar) {
-                    progressBar.classList.remove('bg-danger');
-                    progressBar.classList.add('bg-success');
-                    progressBar.style.width = '100%';
-                }
-                if (progressText) {
-                    progressText.textContent = '100%';
+                    progressBar.style.width = '0%';
+                    progressBar.classList.remove('bg-success');
                 }
-                
-                // Close modal and reset after delay
-                setTimeout(function() {
-                    const bsModal = bootstrap.Modal.getInstance(uploadModal);
-                    if (bsModal) bsModal.hide();
-                    
-                    // Reset form and progress
-                    if (form) form.reset();
-                    if (progressBar) {
-                        progressBar.style.width = '0%';
-                        progressBar.classList.remove('bg-success');
-                    }
-                    if (progressText) progressText.textContent = '0%';
-                    
-                    // Re-enable form elements
-                    if (uploadButton) {
-                        uploadButton.disabled = false;
-                        uploadButton.innerHTML = 'Upload';
-                    }
-                    if (fileInput) fileInput.disabled = false;
-                    if (categorySelect) categorySelect.disabled = false;
-                    
-                    // Refresh page to show new file
-                    window.location.reload();
-                }, 1000);
-            } catch (e) {
-                console.error("Error parsing JSON response:", e);
-                window.location.reload(); // Fallback to reloading the page
-            }
-        } else {
-            // Error case
+                if (progressText) progressText.textContent = '0%';
+                resetForm();
+
+                // Refresh page to show new file
+                window.location.reload();
+            }, 1000);
+        })
+        .catch(error => {
+            console.error("Upload failed:", error);
             if (progressBar) progressBar.classList.add('bg-danger');
-            let errorMsg = 'Upload failed';
-            try {
-                const response = JSON.parse(xhr.responseText);
-                errorMsg = response.error || errorMsg;
-            } catch (e) {
-                errorMsg = xhr.responseText || errorMsg;
-            }
-            alert(errorMsg);
-            
-            // Re-enable form elements
-            if (uploadButton) {
-                uploadButton.disabled = false;
-                uploadButton.innerHTML = 'Upload';
-            }
-            if (fileInput) fileInput.disabled = false;
-            if (categorySelect) categorySelect.disabled = false;
-        }
-    };
+            alert(error.message || 'Upload failed');
+            resetForm();
+        });
+}
 
-    xhr.onerror = function() {
-        console.log("XHR error occurred");
-        if (progressBar) progressBar.classList.add('bg-danger');
-        alert('Network error occurred. Please try again.');
-        
-        // Re-enable form elements
-        if (uploadButton) {
-            uploadButton.disabled = false;
-            uploadButton.innerHTML = 'Upload';
-        }
-        if (fileInput) fileInput.disabled = false;
-        if (categorySelect) categorySelect.disabled = false;
-    };
+function uploadResumeKey(file) {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
 
-    xhr.ontimeout = function() {
-        console.log("XHR request timed out");
-        if (progressBar) progressBar.classList.add('bg-danger');
-        alert('Request timed out. Please try again.');
-        
-        // Re-enable form elements
-        if (uploadButton) {
-            uploadButton.disabled = false;
-            uploadButton.innerHTML = 'Upload';
-        }
-        if (fileInput) fileInput.disabled = false;
-        if (categorySelect) categorySelect.disabled = false;
-    };
-
-    // Set a longer timeout for large files (5 minutes)
-    xhr.timeout = 300000;
-
-    // Start upload
-    try {
-        xhr.send(formData);
-        console.log("XHR request sent");
-    } catch (error) {
-        console.error("Error sending XHR request:", error);
-        alert('Error starting upload: ' + error.message);
-        
-        // Re-enable form elements
-        if (uploadButton) {
-            uploadButton.disabled = false;
-            uploadButton.innerHTML = 'Upload';
+// Resume a previous session for this exact file if the server still has it,
+// otherwise create a new one.
+function openUploadSession(file, category, tags) {
+    const key = uploadResumeKey(file);
+    const previousId = localStorage.getItem(key);
+
+    const resume = previousId
+        ? uploadRequest('GET', `/files/uploads/${previousId}`)
+            .then(session => session.status === 'active' ? session : null)
+            .catch(() => null)
+        : Promise.resolve(null);
+
+    return resume.then(session => {
+        if (session) {
+            console.log(`Resuming upload ${session.upload_id}: ${session.received.length}/${session.total_chunks} chunks on server`);
+            return session;
         }
-        if (fileInput) fileInput.disabled = false;
-        if (categorySelect) categorySelect.disabled = false;
+        return uploadRequest('POST', '/files/uploads', JSON.stringify({
+            filename: file.name,
+            size: file.size,
+            category: category,
+            tags: tags
+        }), {'Content-Type': 'application/json'}).then(created => {
+            localStorage.setItem(key, created.upload_id);
+            return created;
+        });
+    });
+}
+
+// Upload the chunks the server does not have yet, several at a time. The
+// server writes each chunk at its own offset, so completion order is irrelevant.
+function sendMissingChunks(file, session, onProgress, onSent) {
+    const received = new Set(session.received);
+    const pending = [];
+    for (let index = 0; index < session.total_chunks; index++) {
+        if (!received.has(index)) pending.push(index);
     }
+    let receivedBytes = session.received_bytes;
+    onProgress(receivedBytes);
+
+    function worker() {
+        if (!pending.length) return Promise.resolve();
+        const index = pending.shift();
+        const start = index * session.chunk_size;
+        const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+        return sendChunk(session.upload_id, index, blob).then(() => {
+            receivedBytes += blob.size;
+            onSent(blob.size);
+            onProgress(receivedBytes);
+            return worker();
+        });
+    }
+
+    const workers = [];
+    const parallel = Math.max(1, session.parallel_chunks || 1);
+    for (let i = 0; i < Math.min(parallel, pending.length); i++) {
+        workers.push(worker());
+    }
+    return Promise.all(workers).then(() => session);
+}
+
+function sendChunk(uploadId, index, blob, attempt = 0) {
+    return chunkChecksum(blob)
+        .then(checksum => {
+            const headers = {'Content-Type': 'application/octet-stream'};
+            if (checksum) headers['X-Chunk-SHA256'] = checksum;
+            return uploadRequest('PUT', `/files/uploads/${uploadId}/chunks/${index}`, blob, headers);
+        })
+        .catch(error => {
+            // Client errors (except a corrupted chunk) will not fix themselves
+            if (attempt >= UPLOAD_MAX_RETRIES || (error.status && error.status !== 400 && error.status < 500)) {
+                throw error;
+            }
+            const delay = Math.min(30000, 1000 * Math.pow(2, attempt));
+            console.log(`Chunk ${index} failed (${error.message}), retrying in ${delay / 1000}s`);
+            return new Promise(resolve => setTimeout(resolve, delay))
+                .then(() => sendChunk(uploadId, index, blob, attempt + 1));
+        });
+}
+
+// SHA-256 of a chunk, or null where WebCrypto is unavailable (plain HTTP)
+function chunkChecksum(blob) {
+    if (!window.crypto || !window.crypto.subtle) return Promise.resolve(null);
+    return blob.arrayBuffer()
+        .then(buffer => window.crypto.subtle.digest('SHA-256', buffer))
+        .then(hash => Array.from(new Uint8Array(hash)).map(b => b.toString(16).padStart(2, '0')).join(''));
+}
+
+function uploadRequest(method, url, body, headers = {}) {
+    return fetch(url, {
+        method: method,
+        body: body,
+        credentials: 'same-origin',
+        headers: Object.assign({'X-Requested-With': 'XMLHttpRequest'}, headers)
+    }).then(response => response.json().catch(() => ({})).then(data => {
+        if (!response.ok) {
+            const error = new Error(data.error || `Upload failed (HTTP ${response.status})`);
+            error.status = response.status;
+            throw error;
+        }
+        return data;
+    }));
 }
 
 function deleteFile(fileId) {
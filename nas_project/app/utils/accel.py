@@ -0,0 +1,57 @@
+import os
+from urllib.parse import quote
+from flask import current_app, request
+from werkzeug.utils import send_file as werkzeug_send_file
+from app.utils.volumes import get_pool
+
+
+def accel_enabled():
+    """Whether this request came through nginx and file bodies can be offloaded to it.
+
+    nginx sets X-Accel-Enabled on the download locations (overwriting
+    anything a client sent), so a direct request to the Flask port never
+    gets an X-Accel-Redirect it cannot follow.
+    """
+    return bool(current_app.config.get('ACCEL_REDIRECT')) \
+        and request.headers.get('X-Accel-Enabled') == '1'
+
+
+def accel_uri(path):
+    """Internal nginx URI for a stored file: <prefix>/<volume>/<path within the volume>"""
+    pool = get_pool()
+    volume = pool.get(pool.volume_for_path(path))
+    relative = os.path.relpath(os.path.abspath(path), volume.path)
+    if relative.startswith(os.pardir):
+        return None
+    prefix = current_app.config['ACCEL_REDIRECT_PREFIX'].rstrip('/')
+    return f"{prefix}/{quote(volume.name)}/{quote(relative.replace(os.sep, '/'))}"
+
+
+def accel_response(path, mimetype=None, as_attachment=False, download_name=None, limit_rate=None):
+    """Headers-only response telling nginx to send `path` itself.
+
+    nginx keeps Content-Type and Content-Disposition from this response and
+    serves the body (including Range requests) with sendfile, so no Flask
+    worker is held for the transfer. Returns None if the file is outside
+    every volume, in which case the caller streams it in-process.
+    `limit_rate` (bytes per second) becomes X-Accel-Limit-Rate.
+    """
+    uri = accel_uri(path)
+    if uri is None:
+        return None
+    rv = werkzeug_send_file(
+        path, request.environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=False,
+        etag=False,
+        use_x_sendfile=True,
+        response_class=current_app.response_class
+    )
+    del rv.headers['X-Sendfile']
+    rv.headers['X-Accel-Redirect'] = uri
+    if limit_rate:
+        rv.headers['X-Accel-Limit-Rate'] = str(limit_rate)
+    rv.content_length = 0
+    return rv
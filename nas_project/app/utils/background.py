@@ -0,0 +1,261 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, func, case
+from sqlalchemy.dialects.sqlite import insert
+from app.models import db, BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+# Job priorities, lower first
+PRIORITY_INTERACTIVE = 0  # A page on screen is waiting for the result
+PRIORITY_UPLOAD = 5  # Processing of a file just uploaded
+PRIORITY_BACKFILL = 10  # Catching up on files uploaded before a feature existed
+
+_handlers = {}  # kind -> fn(file_id, args)
+
+
+def job(kind):
+    """Register fn(file_id, args) as the handler of jobs of `kind`"""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+class JobQueue:
+    """Preview and media jobs stored in the background_job table and run on a
+    small pool of worker threads.
+
+    The table is the queue, so jobs queued before a restart are picked up
+    after it, and every process sharing the database can queue and run
+    them; a conditional UPDATE makes sure only one worker claims a job.
+    Queuing the same (kind, file, args) again only raises the priority of
+    the pending row.
+
+    While jobs run, a heartbeat thread refreshes their heartbeat_at every
+    JOB_HEARTBEAT_INTERVAL. A running job is only queued again once its
+    heartbeat is JOB_STALE_AFTER old, i.e. the process running it died,
+    so a long transcode is never run twice.
+
+    With MAX_WORKERS > 1 the first worker only takes interactive jobs, so
+    a page waiting on a thumbnail never queues behind a bulk import; the
+    other workers take anything and run niced, which ffmpeg inherits.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = max(1, app.config['MAX_WORKERS'])
+        self.poll = app.config['JOB_POLL_INTERVAL']
+        self.max_attempts = app.config['JOB_MAX_ATTEMPTS']
+        self.stale_after = app.config['JOB_STALE_AFTER']
+        self.heartbeat_interval = app.config['JOB_HEARTBEAT_INTERVAL']
+        self.nice = app.config['JOB_BACKGROUND_NICE']
+        self.max_waiters = app.config['THREAD_POOL_SIZE']
+        self._changed = threading.Condition()  # Notified when jobs are queued or finish
+        self._waiters = 0
+        self._running = set()  # Ids of the jobs this process is running
+        self._running_lock = threading.Lock()
+        self._threads = []
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        # Handlers register themselves when their module is imported
+        import app.utils.media_jobs  # noqa: F401
+        for i in range(self.workers):
+            interactive_only = self.workers > 1 and i == 0
+            thread = threading.Thread(target=self._work, args=(interactive_only,),
+                                      name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def enqueue(self, kind, file_id, args='', priority=PRIORITY_BACKFILL):
+        """Queue a job, or make the same pending job at least this urgent.
+
+        A failed job queued again is retried from scratch. Runs on its own
+        connection, so the caller's session is left alone.
+        """
+        stmt = insert(BackgroundJob.__table__).values(
+            kind=kind, file_id=file_id, args=args, priority=priority,
+            status='queued', attempts=0, created_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['kind', 'file_id', 'args'],
+            set_={
+                'priority': func.min(BackgroundJob.__table__.c.priority, stmt.excluded.priority),
+                'status': case((BackgroundJob.__table__.c.status == 'failed', 'queued'),
+                               else_=BackgroundJob.__table__.c.status),
+                'attempts': case((BackgroundJob.__table__.c.status == 'failed', 0),
+                                 else_=BackgroundJob.__table__.c.attempts),
+            })
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+        with self._changed:
+            self._changed.notify_all()
+
+    def is_pending(self, kind, file_id, args=''):
+        with db.engine.connect() as conn:
+            return conn.execute(select(BackgroundJob.id).where(
+                BackgroundJob.kind == kind, BackgroundJob.file_id == file_id, BackgroundJob.args == args,
+                BackgroundJob.status.in_(('queued', 'running')))).first() is not None
+
+    def wait(self, kind, file_id, args='', timeout=None):
+        """Wait until a job is no longer pending.
+
+        Returns False on timeout, or straight away when THREAD_POOL_SIZE
+        requests are already waiting. A finished job may still have failed;
+        callers check for its result.
+        """
+        with self._changed:
+            if self._waiters >= self.max_waiters:
+                return False
+            self._waiters += 1
+        try:
+            deadline = time.monotonic() + (timeout if timeout is not None else self.app.config['JOB_WAIT_TIMEOUT'])
+            while self.is_pending(kind, file_id, args):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                with self._changed:
+                    # Polling covers jobs finished by other processes
+                    self._changed.wait(min(remaining, self.poll))
+            return True
+        finally:
+            with self._changed:
+                self._waiters -= 1
+
+    def _claim(self, interactive_only):
+        """Mark the most urgent runnable job as running and return it"""
+        with db.engine.begin() as conn:
+            stale = datetime.utcnow() - timedelta(seconds=self.stale_after)
+            conn.execute(update(BackgroundJob).where(
+                BackgroundJob.status == 'running',
+                func.coalesce(BackgroundJob.heartbeat_at, BackgroundJob.started_at) < stale
+            ).values(status='queued'))
+            query = select(BackgroundJob.id).where(BackgroundJob.status == 'queued')
+            if interactive_only:
+                query = query.where(BackgroundJob.priority <= PRIORITY_INTERACTIVE)
+            candidates = conn.execute(query.order_by(BackgroundJob.priority, BackgroundJob.id).limit(5)).all()
+            for (job_id,) in candidates:
+                now = datetime.utcnow()
+                claimed = conn.execute(update(BackgroundJob).where(
+                    BackgroundJob.id == job_id, BackgroundJob.status == 'queued'
+                ).values(status='running', started_at=now, heartbeat_at=now,
+                         attempts=BackgroundJob.attempts + 1)).rowcount
+                if claimed:
+                    with self._running_lock:
+                        self._running.add(job_id)
+                    return conn.execute(select(BackgroundJob.id, BackgroundJob.kind, BackgroundJob.file_id,
+                                               BackgroundJob.args, BackgroundJob.attempts)
+                                        .where(BackgroundJob.id == job_id)).first()
+        return None
+
+    def beat(self):
+        """Refresh heartbeat_at of the jobs this process is running"""
+        with self._running_lock:
+            running = list(self._running)
+        if not running:
+            return
+        with db.engine.begin() as conn:
+            conn.execute(update(BackgroundJob).where(
+                BackgroundJob.id.in_(running), BackgroundJob.status == 'running'
+            ).values(heartbeat_at=datetime.utcnow()))
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.app.app_context():
+                try:
+                    self.beat()
+                except Exception as e:
+                    logger.error(f"Could not refresh background job heartbeats: {str(e)}")
+
+    def _work(self, interactive_only):
+        if not interactive_only and self.workers > 1 and self.nice and hasattr(os, 'setpriority'):
+            try:
+                # Linux applies niceness per thread; child processes inherit it
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+            except OSError:
+                pass
+        while True:
+            with self.app.app_context():
+                try:
+                    claimed = self._claim(interactive_only)
+                except Exception as e:
+                    logger.error(f"Could not claim a background job: {str(e)}")
+                    claimed = None
+                if claimed is not None:
+                    self._run(claimed)
+                db.session.remove()
+            if claimed is None:
+                with self._changed:
+                    self._changed.wait(self.poll)
+            else:
+                with self._changed:
+                    self._changed.notify_all()
+
+    def _run(self, claimed):
+        try:
+            self._run_handler(*claimed)
+        finally:
+            with self._running_lock:
+                self._running.discard(claimed[0])
+
+    def _run_handler(self, job_id, kind, file_id, args, attempts):
+        handler = _handlers.get(kind)
+        try:
+            if handler is None:
+                raise LookupError(f'No handler for {kind} jobs')
+            handler(file_id, args)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Background job {kind}({file_id}, {args!r}) failed: {str(e)}")
+            retry = attempts < self.max_attempts and handler is not None
+            with db.engine.begin() as conn:
+                conn.execute(update(BackgroundJob).where(BackgroundJob.id == job_id).values(
+                    status='queued' if retry else 'failed',
+                    priority=func.max(BackgroundJob.priority, PRIORITY_BACKFILL),
+                    error=str(e)[:255]))
+            return
+        with db.engine.begin() as conn:
+            conn.execute(delete(BackgroundJob).where(BackgroundJob.id == job_id))
+
+    def stats(self):
+        """Queue depth by priority class, plus running and failed counts"""
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(
+                BackgroundJob.status, BackgroundJob.priority <= PRIORITY_INTERACTIVE, func.count()
+            ).group_by(BackgroundJob.status, BackgroundJob.priority <= PRIORITY_INTERACTIVE)).all()
+        stats = {'queued': {'interactive': 0, 'background': 0}, 'running': 0, 'failed': 0,
+                 'workers': self.workers, 'waiting_requests': self._waiters}
+        for status, interactive, count in rows:
+            if status == 'queued':
+                stats['queued']['interactive' if interactive else 'background'] += count
+            else:
+                stats[status] = stats.get(status, 0) + count
+        return stats
+
+
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    with _queue_lock:
+        queue = current_app.extensions.get('job_queue')
+        if queue is None:
+            queue = current_app.extensions['job_queue'] = JobQueue(current_app._get_current_object())
+            queue.start()
+        return queue
+
+
+def enqueue(kind, file_id, args='', priority=PRIORITY_BACKFILL):
+    """Queue a job on the shared queue; see JobQueue.enqueue"""
+    get_queue().enqueue(kind, file_id, args, priority)
@@ -0,0 +1,123 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+from app.models import db, Blob
+from app.utils.volumes import move
+
+logger = logging.getLogger(__name__)
+
+
+def dedup_enabled():
+    return bool(current_app.config.get('STORAGE_DEDUP'))
+
+
+def get_blob_dir():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'blobs')
+
+
+def blob_path(sha256):
+    """blobs/ab/cd/<sha256>, so no directory grows past 65536 entries per level"""
+    return os.path.join(get_blob_dir(), sha256[:2], sha256[2:4], sha256)
+
+
+def ingest(source_path, sha256, size):
+    """Store the upload at `source_path` as blob `sha256` and take a reference.
+
+    When the blob already exists the upload is a duplicate: its bytes are
+    dropped and the blob's ref_count goes up by one. Otherwise the upload is
+    renamed into the blob store. Returns the blob's path. The caller commits.
+    """
+    path = blob_path(sha256)
+    for _ in range(2):
+        # Taking the reference is a single UPDATE, so a concurrent
+        # collect_garbage() either sees ref_count > 0 or has already
+        # deleted the row (and we insert a fresh one below)
+        taken = Blob.query.filter_by(sha256=sha256).update(
+            {Blob.ref_count: Blob.ref_count + 1, Blob.unreferenced_at: None},
+            synchronize_session=False
+        )
+        if taken:
+            blob = Blob.query.get(sha256)
+            if os.path.exists(blob.path):
+                os.remove(source_path)
+            else:
+                logger.error(f"Blob {sha256} was missing on disk, restored from upload")
+                move(source_path, blob.path)
+            return blob.path
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(Blob(sha256=sha256, size=size, path=path, ref_count=1,
+                                    created_at=datetime.utcnow()))
+        except IntegrityError:
+            # The same content was stored concurrently; take a reference to it
+            continue
+        move(source_path, path)
+        return path
+
+    raise RuntimeError(f'Could not store blob {sha256}')
+
+
+def release(sha256):
+    """Drop one reference to a blob. The caller commits.
+
+    The blob is not removed here; once unreferenced for BLOB_GC_GRACE
+    seconds collect_garbage() reclaims it.
+    """
+    remaining = Blob.ref_count - 1
+    Blob.query.filter_by(sha256=sha256).update(
+        {
+            Blob.ref_count: case((remaining < 0, 0), else_=remaining),
+            Blob.unreferenced_at: case((remaining <= 0, datetime.utcnow()), else_=Blob.unreferenced_at),
+        },
+        synchronize_session=False
+    )
+
+
+def collect_garbage(grace=None, limit=None):
+    """Delete blobs that have had no references for `grace` seconds.
+
+    Each blob's row is deleted and its file unlinked before the commit, so
+    an ingest() of the same content waits for the row lock and then stores
+    a fresh copy instead of referencing a file that is about to vanish.
+    Returns (blobs removed, bytes reclaimed).
+    """
+    grace = current_app.config['BLOB_GC_GRACE'] if grace is None else grace
+    limit = limit or current_app.config['BLOB_GC_BATCH']
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+
+    candidates = db.session.query(Blob.sha256).filter(
+        Blob.ref_count <= 0, Blob.unreferenced_at < cutoff
+    ).limit(limit).all()
+    db.session.rollback()
+
+    removed = 0
+    reclaimed = 0
+    for (sha256,) in candidates:
+        blob = Blob.query.get(sha256)
+        if blob is None:
+            continue
+        path, size = blob.path, blob.size
+        deleted = Blob.query.filter(
+            Blob.sha256 == sha256, Blob.ref_count <= 0, Blob.unreferenced_at < cutoff
+        ).delete(synchronize_session=False)
+        if not deleted:
+            db.session.rollback()
+            continue
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not reclaim blob {sha256}: {str(e)}")
+            continue
+        removed += 1
+        reclaimed += size or 0
+
+    if removed:
+        logger.info(f"Blob GC reclaimed {removed} blobs, {reclaimed} bytes")
+    return removed, reclaimed
@@ -0,0 +1,615 @@
+import io
+import os
+import mmap
+import bisect
+import hashlib
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, case, exists, or_
+from sqlalchemy.exc import IntegrityError
+from app.models import db, Chunk, ChunkPack, FileChunk, File, Blob
+from app.utils.volumes import DEFAULT_VOLUME
+
+try:
+    import numpy as np
+except ImportError:  # Chunking falls back to a (much slower) pure Python loop
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Rolling hash: polynomial over a sliding window, modulo 2**64. Boundaries
+# depend only on the WINDOW bytes before them, so an insert or delete in a
+# large file only changes the chunks around the edit.
+WINDOW = 48
+PRIME = 0x100000001b3
+MASK64 = (1 << 64) - 1
+PRIME_INV = pow(PRIME, -1, 1 << 64)
+OUT_FACTOR = pow(PRIME, WINDOW, 1 << 64)
+
+# Bytes hashed per numpy pass when looking for boundaries
+SCAN_BLOCK = 1024 * 1024
+
+# Chunk hashes looked up per query
+LOOKUP_BATCH = 500
+
+_powers_cache = {}
+
+
+def chunking_enabled():
+    return bool(current_app.config.get('STORAGE_CHUNK_DEDUP'))
+
+
+def should_chunk(file_size):
+    return chunking_enabled() and file_size >= current_app.config['CHUNK_DEDUP_MIN_SIZE']
+
+
+def is_candidate(file):
+    """Whether a File is a plain file that chunk_file() would split"""
+    return not file.is_chunked and not file.blob_sha256 and should_chunk(file.file_size or 0)
+
+
+def get_chunk_dir():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'chunks')
+
+
+# -- Content-defined chunking --------------------------------------------------
+
+def _boundary_shift():
+    """Cut where the top log2(CDC_AVG_CHUNK) bits of the window hash are zero"""
+    return 64 - (current_app.config['CDC_AVG_CHUNK'].bit_length() - 1)
+
+
+def _powers(n):
+    cached = _powers_cache.get(n)
+    if cached is None:
+        powers = np.ones(n, dtype=np.uint64)
+        inverse = np.ones(n, dtype=np.uint64)
+        powers[1:] = np.cumprod(np.full(n - 1, PRIME, dtype=np.uint64), dtype=np.uint64)
+        inverse[1:] = np.cumprod(np.full(n - 1, PRIME_INV, dtype=np.uint64), dtype=np.uint64)
+        _powers_cache.clear()
+        cached = _powers_cache[n] = (powers, inverse)
+    return cached
+
+
+def _candidates_numpy(data, size, shift):
+    """Boundary candidates in data[:size], all in a few vector passes per block.
+
+    With S = cumsum(b[k] * p^-k), the hash of the window ending at i is
+    (S[i] - S[i-WINDOW]) * p^i; uint64 arithmetic wraps modulo 2**64 just
+    like the pure Python version.
+    """
+    candidates = []
+    view = np.frombuffer(data, dtype=np.uint8, count=size)
+    for start in range(0, size, SCAN_BLOCK):
+        # Each block also sees the WINDOW bytes before it
+        lead = min(start, WINDOW)
+        block = view[start - lead:min(start + SCAN_BLOCK, size)]
+        powers, inverse = _powers(SCAN_BLOCK + WINDOW)
+        n = len(block)
+        sums = np.cumsum(block.astype(np.uint64) * inverse[:n], dtype=np.uint64)
+        shifted = np.zeros(n, dtype=np.uint64)
+        shifted[WINDOW:] = sums[:-WINDOW]
+        hashes = (sums - shifted) * powers[:n]
+        hits = np.flatnonzero((hashes[lead:] >> np.uint64(shift)) == 0)
+        candidates.extend((hits + start + 1).tolist())
+    return candidates
+
+
+def _candidates_python(data, size, shift):
+    candidates = []
+    h = 0
+    for i in range(size):
+        h = (h * PRIME + data[i]) & MASK64
+        if i >= WINDOW:
+            h = (h - data[i - WINDOW] * OUT_FACTOR) & MASK64
+        if not h >> shift:
+            candidates.append(i + 1)
+    return candidates
+
+
+def find_chunks(data, size):
+    """Split data[:size] into content-defined chunks.
+
+    Returns a list of (offset, length). Every chunk is at least
+    CDC_MIN_CHUNK and at most CDC_MAX_CHUNK bytes, except the last one.
+    """
+    min_chunk = current_app.config['CDC_MIN_CHUNK']
+    max_chunk = current_app.config['CDC_MAX_CHUNK']
+    shift = _boundary_shift()
+    if np is not None:
+        candidates = _candidates_numpy(data, size, shift)
+    else:
+        candidates = _candidates_python(data, size, shift)
+
+    chunks = []
+    start = 0
+    while start < size:
+        end = min(start + max_chunk, size)
+        if start + min_chunk < size:
+            i = bisect.bisect_left(candidates, start + min_chunk)
+            if i < len(candidates) and candidates[i] < end:
+                end = candidates[i]
+        else:
+            end = size
+        chunks.append((start, end - start))
+        start = end
+    return chunks
+
+
+# -- Pack files ------------------------------------------------------------------
+
+def claim_pack(commit=True):
+    """Take an open pack for exclusive appending, or start a new one.
+
+    The claim is a conditional UPDATE, so two uploads (in any worker) never
+    append to the same pack. Commits, unless `commit` is False; then a new
+    pack is always started inside the caller's transaction.
+    """
+    if not commit:
+        return _new_pack()
+    for pack in ChunkPack.query.filter_by(status='open').order_by(ChunkPack.id).limit(5).all():
+        claimed = ChunkPack.query.filter_by(id=pack.id, status='open').update(
+            {ChunkPack.status: 'writing', ChunkPack.updated_at: datetime.utcnow()},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if claimed:
+            db.session.refresh(pack)
+            return pack
+
+    pack = _new_pack()
+    db.session.commit()
+    return pack
+
+
+def _new_pack():
+    pack = ChunkPack(path='', size=0, status='writing', updated_at=datetime.utcnow())
+    db.session.add(pack)
+    db.session.flush()
+    pack.path = os.path.join(get_chunk_dir(), 'packs', f'{pack.id:08d}.pack')
+    os.makedirs(os.path.dirname(pack.path), exist_ok=True)
+    return pack
+
+
+class PackWriter:
+    """Appends chunks to a claimed pack with positional writes"""
+
+    def __init__(self):
+        self.pack = None
+        self.fd = None
+        self.size = 0
+        self.in_transaction = False  # Set once the caller's transaction must not be committed
+
+    def append(self, data):
+        if self.fd is None:
+            self.pack = claim_pack(commit=not self.in_transaction)
+            self.fd = os.open(self.pack.path, os.O_WRONLY | os.O_CREAT, 0o644)
+            # The file may be longer than pack.size if an earlier writer died
+            self.size = max(self.pack.size or 0, os.fstat(self.fd).st_size)
+        offset = self.size
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, self.size)
+            view = view[n:]
+            self.size += n
+        return self.pack.id, offset
+
+    def flush(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+
+    def close(self):
+        """Record the pack's new size and hand it back. The caller commits."""
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        sealed = self.size >= current_app.config['CHUNK_PACK_SIZE']
+        ChunkPack.query.filter_by(id=self.pack.id).update(
+            {ChunkPack.size: self.size, ChunkPack.status: 'sealed' if sealed else 'open',
+             ChunkPack.updated_at: datetime.utcnow()},
+            synchronize_session=False
+        )
+
+
+# -- Ingest ----------------------------------------------------------------------
+
+class ChunkedUpload:
+    """Result of splitting an upload; attach() turns it into FileChunk rows"""
+
+    def __init__(self, source_path, size, chunks, written, writer):
+        self.source_path = source_path
+        self.size = size
+        self.chunks = chunks  # [(sha256, offset, length)] in file order
+        self.written = written  # sha256 -> (pack_id, pack_offset) stored by this upload
+        self.writer = writer
+
+
+def ingest(source_path):
+    """Split a file into chunks and store the ones not seen before.
+
+    Chunk bytes are appended to a pack claimed for this upload and fsynced;
+    nothing refers to them until attach() runs in the caller's transaction.
+    Must be called before the caller adds anything to the session, since
+    claiming a pack commits.
+    """
+    size = os.path.getsize(source_path)
+    writer = PackWriter()
+    written = {}
+    with open(source_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        chunks = [(hashlib.sha256(data[offset:offset + length]).hexdigest(), offset, length)
+                  for offset, length in find_chunks(data, size)]
+
+        unique = list(dict.fromkeys(sha for sha, _, _ in chunks))
+        known = set()
+        for i in range(0, len(unique), LOOKUP_BATCH):
+            batch = unique[i:i + LOOKUP_BATCH]
+            known.update(row[0] for row in db.session.query(Chunk.sha256)
+                         .filter(Chunk.sha256.in_(batch)).all())
+
+        for sha, offset, length in chunks:
+            if sha not in known and sha not in written:
+                written[sha] = writer.append(data[offset:offset + length])
+        writer.flush()
+
+    logger.info(f"Chunked {source_path}: {len(chunks)} chunks, {len(unique)} unique, "
+                f"{len(written)} new")
+    return ChunkedUpload(source_path, size, chunks, written, writer)
+
+
+def attach(new_file, upload):
+    """Reference the upload's chunks from `new_file`.
+
+    Existing chunks gain a reference with a conditional UPDATE; if one was
+    garbage collected since ingest() looked, its bytes are stored again from
+    the source. The caller commits, then removes the source file.
+    """
+    counts = Counter(sha for sha, _, _ in upload.chunks)
+    first_offset = {}
+    for sha, offset, length in upload.chunks:
+        first_offset.setdefault(sha, (offset, length))
+    upload.writer.in_transaction = True
+
+    with open(upload.source_path, 'rb') as source:
+        for sha, count in counts.items():
+            if sha not in upload.written and _take_reference(sha, count):
+                continue
+            offset, length = first_offset[sha]
+            location = upload.written.get(sha)
+            if location is None:
+                source.seek(offset)
+                location = upload.writer.append(source.read(length))
+                upload.writer.flush()
+            try:
+                with db.session.begin_nested():
+                    db.session.add(Chunk(sha256=sha, pack_id=location[0], offset=location[1],
+                                         size=length, ref_count=count))
+            except IntegrityError:
+                # Stored concurrently by another upload; use that copy
+                if not _take_reference(sha, count):
+                    raise
+
+    upload.writer.close()
+    db.session.bulk_insert_mappings(FileChunk, [
+        {'file_id': new_file.id, 'seq': seq, 'offset': offset, 'chunk_sha256': sha}
+        for seq, (sha, offset, _) in enumerate(upload.chunks)
+    ])
+    new_file.is_chunked = True
+
+
+def abandon(upload):
+    """Give up on an ingest(): the chunks it stored count as dead space. The caller commits."""
+    upload.writer.close()
+    sizes = {sha: length for sha, _, length in upload.chunks}
+    dead = Counter()
+    for sha, (pack_id, _) in upload.written.items():
+        dead[pack_id] += sizes[sha]
+    for pack_id, size in dead.items():
+        ChunkPack.query.filter_by(id=pack_id).update(
+            {ChunkPack.dead_bytes: ChunkPack.dead_bytes + size}, synchronize_session=False)
+
+
+def chunk_file(file_id):
+    """Move a plain File's body into the chunk store.
+
+    Runs from the job queue, so a large upload is split after its request
+    was answered instead of while the client waits. The File is switched
+    over only if it still has the same body once the chunks are stored;
+    if it was deleted or rewritten meanwhile, they are left to the GC.
+    Returns True if the file was chunked.
+    """
+    file = db.session.get(File, file_id)
+    if file is None or not is_candidate(file) or not os.path.exists(file.path):
+        return False
+    path = file.path
+    before = os.stat(path)
+    upload = ingest(path)
+
+    after = os.stat(path) if os.path.exists(path) else None
+    switched = after is not None and (after.st_size, after.st_mtime_ns) == (before.st_size, before.st_mtime_ns) \
+        and File.query.filter(
+            File.id == file_id, File.path == path, File.blob_sha256.is_(None),
+            or_(File.is_chunked.is_(None), File.is_chunked == False)  # noqa: E712
+        ).update({File.volume: DEFAULT_VOLUME}, synchronize_session=False)
+    if not switched:
+        abandon(upload)
+        db.session.commit()
+        logger.info(f"File {file_id} changed while it was chunked; left as it is")
+        return False
+    attach(file, upload)
+    db.session.commit()
+    # Downloads already reading the plain file keep their open handle
+    os.remove(path)
+    return True
+
+
+def _take_reference(sha, count):
+    return Chunk.query.filter_by(sha256=sha).update(
+        {Chunk.ref_count: Chunk.ref_count + count, Chunk.unreferenced_at: None},
+        synchronize_session=False
+    )
+
+
+def release_file_chunks(file_id):
+    """Drop a chunked file's chunk references and its FileChunk rows. The caller commits."""
+    counts = db.session.query(FileChunk.chunk_sha256, func.count()) \
+        .filter(FileChunk.file_id == file_id).group_by(FileChunk.chunk_sha256).all()
+    now = datetime.utcnow()
+    for sha, count in counts:
+        remaining = Chunk.ref_count - count
+        Chunk.query.filter_by(sha256=sha).update(
+            {Chunk.ref_count: case((remaining < 0, 0), else_=remaining),
+             Chunk.unreferenced_at: case((remaining <= 0, now), else_=Chunk.unreferenced_at)},
+            synchronize_session=False
+        )
+    FileChunk.query.filter_by(file_id=file_id).delete(synchronize_session=False)
+
+
+def collect_garbage(grace=None, limit=None):
+    """Forget chunks unreferenced for `grace` seconds and delete emptied packs.
+
+    Packs are append-only, so a collected chunk only becomes dead space;
+    packs that are mostly dead space are compacted (see compact_pack), and
+    a pack nobody is writing to is removed once none of its chunks are
+    left. Packs stuck in 'writing' by a crashed upload are reopened after
+    REQUEST_TIMEOUT.
+    Returns (chunks collected, packs removed).
+    """
+    grace = current_app.config['BLOB_GC_GRACE'] if grace is None else grace
+    limit = limit or current_app.config['BLOB_GC_BATCH'] * 10
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+
+    dead = db.session.query(Chunk.sha256, Chunk.pack_id, Chunk.size).filter(
+        Chunk.ref_count <= 0, Chunk.unreferenced_at < cutoff
+    ).limit(limit).all()
+    collected = 0
+    for sha, pack_id, size in dead:
+        deleted = Chunk.query.filter(
+            Chunk.sha256 == sha, Chunk.ref_count <= 0, Chunk.unreferenced_at < cutoff
+        ).delete(synchronize_session=False)
+        if deleted:
+            ChunkPack.query.filter_by(id=pack_id).update(
+                {ChunkPack.dead_bytes: ChunkPack.dead_bytes + size}, synchronize_session=False)
+            collected += 1
+    db.session.commit()
+
+    stale = datetime.utcnow() - timedelta(seconds=current_app.config['REQUEST_TIMEOUT'])
+    ChunkPack.query.filter(ChunkPack.status == 'writing', ChunkPack.updated_at < stale) \
+        .update({ChunkPack.status: 'open'}, synchronize_session=False)
+    db.session.commit()
+
+    ratio = current_app.config['CHUNK_PACK_COMPACT_RATIO']
+    sparse = [row[0] for row in db.session.query(ChunkPack.id).filter(
+        ChunkPack.status != 'writing', ChunkPack.size > 0, ChunkPack.dead_bytes >= ChunkPack.size * ratio
+    ).order_by(ChunkPack.dead_bytes.desc()).limit(current_app.config['BLOB_GC_BATCH']).all()]
+    compacted = 0
+    for pack_id in sparse:
+        try:
+            compacted += compact_pack(pack_id)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not compact chunk pack {pack_id}: {str(e)}")
+
+    removed = 0
+    empty = db.session.query(ChunkPack.id, ChunkPack.path).filter(
+        ChunkPack.status != 'writing', ~exists().where(Chunk.pack_id == ChunkPack.id)
+    ).all()
+    for pack_id, path in empty:
+        # Deleted and unlinked in one transaction, like blob_store.collect_garbage
+        deleted = ChunkPack.query.filter(
+            ChunkPack.id == pack_id, ChunkPack.status != 'writing',
+            ~exists().where(Chunk.pack_id == pack_id)
+        ).delete(synchronize_session=False)
+        if not deleted:
+            db.session.rollback()
+            continue
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            db.session.commit()
+            removed += 1
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not remove chunk pack {path}: {str(e)}")
+
+    if collected or compacted or removed:
+        logger.info(f"Chunk GC collected {collected} chunks, compacted {compacted} packs, "
+                    f"removed {removed} packs")
+    return collected, removed
+
+
+def compact_pack(pack_id):
+    """Copy a pack's live chunks into another pack, leaving it empty.
+
+    The pack is claimed like a writer claims one, so nothing is appended
+    to it meanwhile; the chunks' rows are repointed in one transaction and
+    the emptied pack is then removed like any other. Readers that loaded
+    the old locations look them up again (see ChunkedFileReader). Returns
+    True if the pack was compacted.
+    """
+    status = db.session.query(ChunkPack.status).filter_by(id=pack_id).scalar()
+    claimed = ChunkPack.query.filter(ChunkPack.id == pack_id, ChunkPack.status == status,
+                                     ChunkPack.status != 'writing').update(
+        {ChunkPack.status: 'writing', ChunkPack.updated_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.session.commit()
+    if not claimed:
+        return False
+
+    pack = db.session.get(ChunkPack, pack_id)
+    live = db.session.query(Chunk.sha256, Chunk.offset, Chunk.size) \
+        .filter(Chunk.pack_id == pack_id).order_by(Chunk.offset).all()
+    writer = PackWriter()
+    moved = []
+    try:
+        with open(pack.path, 'rb') as source:
+            for sha, offset, size in live:
+                source.seek(offset)
+                data = source.read(size)
+                if len(data) != size:
+                    raise IOError(f'Chunk pack {pack.path} is truncated')
+                moved.append((sha, writer.append(data)))
+        writer.flush()
+        for sha, (new_pack_id, new_offset) in moved:
+            # A chunk collected meanwhile is simply not found
+            Chunk.query.filter_by(sha256=sha, pack_id=pack_id).update(
+                {Chunk.pack_id: new_pack_id, Chunk.offset: new_offset}, synchronize_session=False)
+        writer.close()
+        ChunkPack.query.filter_by(id=pack_id).update(
+            {ChunkPack.status: 'sealed', ChunkPack.updated_at: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        writer.close()
+        if writer.pack is not None:
+            # What was copied is dead space in the other pack now
+            copied = sum(size for _, _, size in live[:len(moved)])
+            ChunkPack.query.filter_by(id=writer.pack.id).update(
+                {ChunkPack.dead_bytes: ChunkPack.dead_bytes + copied}, synchronize_session=False)
+        ChunkPack.query.filter_by(id=pack_id).update({ChunkPack.status: status}, synchronize_session=False)
+        db.session.commit()
+        raise
+    logger.info(f"Compacted chunk pack {pack_id}: moved {len(moved)} chunks, "
+                f"freed {(pack.size or 0) - sum(size for _, _, size in live)} bytes")
+    return True
+
+
+# -- Reading ---------------------------------------------------------------------
+
+class ChunkedFileReader(io.RawIOBase):
+    """Seekable read-only view of a chunked File, reassembled from its packs.
+
+    The chunk map is loaded once; reads pread straight from the pack files,
+    so any byte range can be served without touching the chunks before it.
+    If a pack was compacted away since, the map is loaded again.
+    """
+
+    def __init__(self, file_id):
+        super().__init__()
+        self.file_id = file_id
+        self._pos = 0
+        self._fds = {}
+        self._load()
+
+    def _load(self):
+        rows = db.session.query(FileChunk.offset, Chunk.size, Chunk.offset, ChunkPack.path) \
+            .join(Chunk, Chunk.sha256 == FileChunk.chunk_sha256) \
+            .join(ChunkPack, ChunkPack.id == Chunk.pack_id) \
+            .filter(FileChunk.file_id == self.file_id).order_by(FileChunk.seq).all()
+        self._starts = [row[0] for row in rows]
+        self._chunks = [(row[1], row[2], row[3]) for row in rows]
+        self.size = rows[-1][0] + rows[-1][1] if rows else 0
+
+    def _open_pack(self, path):
+        fd = self._fds.get(path)
+        if fd is None:
+            fd = self._fds[path] = os.open(path, os.O_RDONLY)
+        return fd
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position')
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        i = bisect.bisect_right(self._starts, self._pos) - 1
+        try:
+            fd = self._open_pack(self._chunks[i][2])
+        except FileNotFoundError:
+            self._load()
+            fd = self._open_pack(self._chunks[i][2])
+        length, pack_offset, path = self._chunks[i]
+        within = self._pos - self._starts[i]
+        n = min(len(buffer), length - within)
+        data = os.pread(fd, n, pack_offset + within)
+        if len(data) != n:
+            raise IOError(f'Chunk pack {path} is truncated')
+        buffer[:n] = data
+        self._pos += n
+        return n
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+        super().close()
+
+
+def open_chunked(file):
+    return io.BufferedReader(ChunkedFileReader(file.id), current_app.config['CHUNK_SIZE'])
+
+
+# -- Reporting -------------------------------------------------------------------
+
+def dedup_stats(user_id):
+    """Logical vs. physical bytes for a user's files.
+
+    Physical counts each distinct blob and chunk the user references once
+    (shared content is counted in full for every user who has it), and
+    plain files at their size.
+    """
+    logical = db.session.query(func.coalesce(func.sum(File.file_size), 0)) \
+        .filter(File.user_id == user_id).scalar()
+    plain = db.session.query(func.coalesce(func.sum(File.file_size), 0)).filter(
+        File.user_id == user_id, File.blob_sha256.is_(None),
+        or_(File.is_chunked.is_(None), File.is_chunked == False)  # noqa: E712
+    ).scalar()
+
+    blob_ids = db.session.query(File.blob_sha256).filter(
+        File.user_id == user_id, File.blob_sha256.isnot(None)).distinct().subquery()
+    blobs = db.session.query(func.coalesce(func.sum(Blob.size), 0)) \
+        .filter(Blob.sha256.in_(db.session.query(blob_ids.c.blob_sha256))).scalar()
+
+    chunk_ids = db.session.query(FileChunk.chunk_sha256).join(File, File.id == FileChunk.file_id) \
+        .filter(File.user_id == user_id).distinct().subquery()
+    chunks = db.session.query(func.coalesce(func.sum(Chunk.size), 0)) \
+        .filter(Chunk.sha256.in_(db.session.query(chunk_ids.c.chunk_sha256))).scalar()
+
+    physical = plain + blobs + chunks
+    return {
+        'user_id': user_id,
+        'logical_bytes': logical,
+        'physical_bytes': physical,
+        'saved_bytes': logical - physical,
+        'dedup_ratio': round(logical / physical, 3) if physical else 1.0,
+    }
@@ -0,0 +1,145 @@
+import os
+import threading
+from PIL import Image, ImageOps
+from flask import current_app, url_for
+from app.config import Config
+from app.utils.disk_cache import DiskCache
+from app.utils.storage import content_version, open_stored_file
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:  # HEIC/HEIF previews need pillow-heif; other formats work without it
+    pass
+
+# Output format -> (Pillow format, mimetype)
+FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpg': ('JPEG', 'image/jpeg')}
+
+# Image extensions Pillow cannot rasterise
+NON_RASTER = {'svg', 'ai'}
+
+
+def is_candidate(file):
+    """Whether resized derivatives can be made of a File"""
+    ext = file.original_filename.rsplit('.', 1)[-1].lower() if '.' in file.original_filename else ''
+    if ext in NON_RASTER or file.mime_type == 'image/svg+xml':
+        return False
+    if file.mime_type and file.mime_type.startswith('image/'):
+        return True
+    return Config.get_file_category(file.original_filename) == 'image'
+
+
+def flatten(img):
+    """RGB copy of an image, with transparency composited onto white"""
+    img = img.convert('RGBA')
+    background = Image.new('RGB', img.size, (255, 255, 255))
+    background.paste(img, mask=img.getchannel('A'))
+    return background
+
+
+def render(source, target, size, fmt, quality):
+    """Write `source` scaled to fit in size x size pixels to `target`.
+
+    JPEGs are decoded at a reduced scale with draft(), and other formats
+    are shrunk by an integer factor with reduce() before resampling, so a
+    small preview of a large photo never resamples it at full resolution.
+    Images are never enlarged.
+    """
+    pil_format = FORMATS[fmt][0]
+    with Image.open(source) as img:
+        img.draft('RGB', (size, size))
+        img.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+        img = ImageOps.exif_transpose(img)
+        if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = flatten(img)
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA')
+        img.save(target, pil_format, quality=quality)
+
+
+class Derivatives:
+    """Resized copies of images, made on first request and kept in a DiskCache.
+
+    Paths include the file's content version, so a changed file gets new
+    derivatives and the old ones simply age out of the cache.
+    """
+
+    def __init__(self, config):
+        self.root = os.path.join(config['UPLOAD_FOLDER'], 'derivatives')
+        self.quality = config['DERIVATIVE_QUALITY']
+        self.cache = DiskCache(self.root, config['DERIVATIVE_CACHE_BUDGET'], tuple(f'.{ext}' for ext in FORMATS))
+        self._inflight = {}  # target path -> Lock held while it is rendered
+        self._lock = threading.Lock()
+
+    def path_for(self, file, size, fmt):
+        return os.path.join(self.root, str(file.id), content_version(file), f'{size}.{fmt}')
+
+    def lookup(self, file, size, fmt):
+        """Path of a cached derivative, or None if it still has to be made"""
+        target = self.path_for(file, size, fmt)
+        return target if self.cache.touch(target) else None
+
+    def get(self, file, size, fmt):
+        """Path of a derivative, rendering it first if it is not cached.
+
+        Concurrent requests for the same derivative wait for one render.
+        """
+        target = self.path_for(file, size, fmt)
+        if self.cache.touch(target):
+            return target
+        with self._lock:
+            lock = self._inflight.setdefault(target, threading.Lock())
+        try:
+            with lock:
+                if not self.cache.touch(target):
+                    self._render(file, target, size, fmt)
+        finally:
+            with self._lock:
+                self._inflight.pop(target, None)
+        return target
+
+    def _render(self, file, target, size, fmt):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f'{target}.part'
+        try:
+            with open_stored_file(file) as source:
+                render(source, tmp_path, size, fmt, self.quality)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, target)
+        self.cache.add(target, os.path.getsize(target))
+
+    def forget(self, file_id):
+        """Remove every derivative of a deleted file"""
+        self.cache.remove_tree(os.path.join(self.root, str(file_id)))
+
+    def stats(self):
+        return self.cache.usage()
+
+
+_derivatives_lock = threading.Lock()
+
+
+def get_derivatives():
+    with _derivatives_lock:
+        derivatives = current_app.extensions.get('image_derivatives')
+        if derivatives is None:
+            derivatives = current_app.extensions['image_derivatives'] = Derivatives(current_app.config)
+        return derivatives
+
+
+def derivative_url(file, size):
+    """URL of a File's derivative of the given size, or None if it has none.
+
+    The URL names the content version, which is what lets responses be
+    cached as immutable.
+    """
+    if size not in current_app.config['DERIVATIVE_SIZES'] or not is_candidate(file):
+        return None
+    try:
+        version = content_version(file)
+    except OSError:
+        return None
+    return url_for('media.image_derivative', file_id=file.id, version=version, size=size)
@@ -0,0 +1,139 @@
+import os
+import time
+import shutil
+import threading
+from collections import OrderedDict
+
+RESCAN_INTERVAL = 60  # Seconds before the index is rebuilt from disk
+
+
+class DiskCache:
+    """Generated files under `root`, evicted least recently used past a byte budget.
+
+    The index lives in memory and is rebuilt from the files' mtimes (bumped
+    on every hit), so recency survives a restart. Every worker process
+    keeps its own index over the same files, so each one rescans the tree
+    every `rescan_interval` seconds and evicts against what all of them
+    wrote; a file another process wrote since is adopted the first time it
+    is looked up.
+    """
+
+    def __init__(self, root, budget, extensions, rescan_interval=RESCAN_INTERVAL):
+        self.root = root
+        self.budget = budget
+        self.extensions = tuple(extensions)  # Only these count; partial writes use other names
+        self.rescan_interval = rescan_interval
+        self._entries = OrderedDict()  # path -> size, oldest first
+        self._total = 0
+        self._lock = threading.Lock()
+        self._scanned_at = None
+
+    def _scan(self):
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(self.extensions):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        return OrderedDict((path, size) for _, path, size in sorted(found))
+
+    def _refresh(self):
+        """Rebuild the index from disk once it is rescan_interval old.
+
+        The walk runs outside the lock; other threads use the old index
+        meanwhile, and anything they miss is adopted on lookup.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._scanned_at is not None and now - self._scanned_at < self.rescan_interval:
+                return
+            self._scanned_at = now
+        entries = self._scan()
+        with self._lock:
+            self._entries = entries
+            self._total = sum(entries.values())
+
+    def _forget(self, path):
+        with self._lock:
+            self._total -= self._entries.pop(path, 0)
+
+    def touch(self, path):
+        """Mark a cached file as just used; False if it is not cached"""
+        self._refresh()
+        with self._lock:
+            known = path in self._entries
+            if known:
+                self._entries.move_to_end(path)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            self._forget(path)
+            return False
+        if not known:
+            # Written by another process since the last scan
+            self.add(path, size)
+        return True
+
+    def contains(self, path):
+        """Whether a file is cached, without marking it as used"""
+        self._refresh()
+        with self._lock:
+            known = path in self._entries
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            self._forget(path)
+            return False
+        if not known:
+            self.add(path, size)
+        return True
+
+    def add(self, path, size):
+        self._refresh()
+        with self._lock:
+            self._total += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            evicted = self._evict()
+        for victim in evicted:
+            self._remove(victim)
+
+    def _evict(self):
+        evicted = []
+        while self._total > self.budget and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total -= size
+            evicted.append(path)
+        return evicted
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        # Drop directories once they are empty
+        parent = os.path.dirname(path)
+        while parent != self.root and parent.startswith(self.root):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def remove_tree(self, path):
+        """Drop every cached file under directory `path`"""
+        prefix = os.path.join(path, '')
+        with self._lock:
+            for cached in [p for p in self._entries if p.startswith(prefix)]:
+                self._total -= self._entries.pop(cached)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def usage(self):
+        self._refresh()
+        with self._lock:
+            return {'bytes': self._total, 'files': len(self._entries), 'budget': self.budget}
@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from flask import current_app, request, session
+from app.models import db, File
+
+# The File columns serve_file() needs, detached from the database session,
+# and the on-disk version of the body they describe
+FileSnapshot = namedtuple('FileSnapshot', [
+    'id', 'user_id', 'path', 'is_chunked', 'mime_type', 'original_filename',
+    'sha256', 'file_size', 'uploaded_at', 'version'
+])
+
+
+def disk_version(path):
+    """Size, mtime and inode of a file body; changes when it is rewritten or replaced"""
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def snapshot(file):
+    # Chunked files are never rewritten; their chunks are checked when served
+    version = None if file.is_chunked else disk_version(file.path)
+    return FileSnapshot(file.id, file.user_id, file.path, file.is_chunked, file.mime_type,
+                        file.original_filename, file.sha256, file.file_size, file.uploaded_at,
+                        version)
+
+
+def is_current(snapshot):
+    """Whether the body on disk is still the one a snapshot was taken of.
+
+    A faststart remux (possibly in another process) replaces the file and
+    updates its size and hash, which the snapshot would otherwise keep
+    serving as Content-Length and ETag.
+    """
+    if snapshot.version is None:
+        return True
+    try:
+        return disk_version(snapshot.path) == snapshot.version
+    except FileNotFoundError:
+        return False
+
+
+def row_exists(snapshot):
+    """Whether the snapshot's File row is still there and still its owner's.
+
+    Another worker may have deleted it, and its forget_file() only reaches
+    its own sessions; a deduplicated body outlives the row in the blob store.
+    """
+    return db.session.query(File.id).filter_by(id=snapshot.id, user_id=snapshot.user_id).first() is not None
+
+
+class DownloadSessions:
+    """Downloads that were recently authorised and logged, per worker.
+
+    Download managers fetch one file over several connections, each asking
+    for other byte ranges. The first request checks access, writes the
+    ActivityLog entry and records the file here; the range requests that
+    follow from the same user and address within DOWNLOAD_SESSION_TTL
+    seconds are served from the snapshot, after one primary key lookup
+    that the File still exists. A snapshot whose file changed on disk
+    since is dropped, so the next request reads the row again.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, FileSnapshot)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(file_id):
+        """Session key for the current request, or None if it has no logged-in user.
+
+        The user id comes from the signed session cookie, so a client can
+        only ever reuse a download session its own login created.
+        """
+        user_id = session.get('_user_id')
+        if user_id is None:
+            return None
+        return (str(user_id), file_id, request.remote_addr)
+
+    def get(self, key):
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < now or not is_current(entry[1]):
+                del self._entries[key]
+                return None
+        if not row_exists(entry[1]):
+            self.discard(key)
+            return None
+        with self._lock:
+            if key in self._entries:
+                # Every range request keeps a running download alive
+                self._entries[key] = (now + self.ttl, entry[1])
+                self._entries.move_to_end(key)
+        return entry[1]
+
+    def add(self, key, file):
+        if key is None or self.ttl <= 0:
+            return
+        try:
+            entry = (time.monotonic() + self.ttl, snapshot(file))
+        except FileNotFoundError:
+            # Nothing to serve; the caller answers 404
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def forget_file(self, file_id):
+        """Drop every session for a file, e.g. once it was deleted"""
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == file_id]:
+                del self._entries[key]
+
+
+def get_download_sessions():
+    sessions = current_app.extensions.get('download_sessions')
+    if sessions is None:
+        sessions = current_app.extensions['download_sessions'] = DownloadSessions(
+            current_app.config['DOWNLOAD_SESSION_TTL'], current_app.config['DOWNLOAD_SESSION_MAX'])
+    return sessions
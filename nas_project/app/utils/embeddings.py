@@ -0,0 +1,409 @@
+import os
+import re
+import json
+import fcntl
+import logging
+import threading
+from collections import OrderedDict
+import requests
+from flask import current_app
+from sqlalchemy import func
+from app.models import db, File, EmbeddingChunk
+from app.utils.text_extract import get_text_cache, is_candidate as has_text
+from app.utils.search import text_version
+
+try:
+    import numpy as np
+except ImportError:  # Semantic search needs NumPy; everything else works without it
+    np = None
+
+logger = logging.getLogger(__name__)
+
+PARAGRAPH = re.compile(r'\n\s*\n')
+
+QUERY_CACHE_SIZE = 256  # Query embeddings kept, so repeated searches skip the AI server
+SCORE_BLOCK = 65536  # Rows scored per matrix product, bounding the temporary arrays
+COMPACT_DEAD_FRACTION = 0.25  # Vector files are rewritten past this share of dead rows
+
+
+def is_enabled():
+    return np is not None and bool(current_app.config['EMBEDDING_API_URL'])
+
+
+def is_candidate(file):
+    return is_enabled() and has_text(file)
+
+
+def split_chunks(text, size, overlap):
+    """Cut text into pieces of about `size` characters along paragraph breaks.
+
+    Paragraphs are packed together up to `size`; a longer paragraph is cut
+    into windows sharing `overlap` characters, so no sentence is only ever
+    seen cut in half.
+    """
+    chunks, current = [], ''
+    for paragraph in PARAGRAPH.split(text):
+        paragraph = ' '.join(paragraph.split())
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 1 > size:
+            chunks.append(current)
+            current = ''
+        if len(paragraph) <= size:
+            current = f'{current} {paragraph}' if current else paragraph
+            continue
+        step = max(1, size - overlap)
+        for start in range(0, len(paragraph), step):
+            chunks.append(paragraph[start:start + size])
+            if start + size >= len(paragraph):
+                break
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+class EmbeddingClient:
+    """Talks to the AI server's /embed endpoint: {"texts": [...]} in,
+    {"embeddings": [[...], ...]} out, batched and over one keep-alive session."""
+
+    def __init__(self, config):
+        self.url = config['EMBEDDING_API_URL']
+        self.batch_size = config['EMBEDDING_BATCH_SIZE']
+        self.timeout = config['EMBEDDING_TIMEOUT']
+        self.session = requests.Session()
+
+    def embed(self, texts):
+        """Unit-length float32 embeddings of `texts`, one row each"""
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            res = self.session.post(self.url, json={'texts': batch}, timeout=self.timeout)
+            res.raise_for_status()
+            embeddings = res.json().get('embeddings') or []
+            if len(embeddings) != len(batch):
+                raise ValueError(f'AI server returned {len(embeddings)} embeddings for {len(batch)} texts')
+            rows.extend(embeddings)
+        return normalize(np.asarray(rows, dtype=np.float32))
+
+
+class VectorFile:
+    """A user's embeddings: rows of float32 appended to one file.
+
+    The row count follows from the file size, so appending needs no other
+    bookkeeping; an flock serialises writers across processes. The
+    dimension is fixed by the first append and kept in meta.json.
+    """
+
+    def __init__(self, root, user_id):
+        self.dir = os.path.join(root, str(user_id))
+        self.path = os.path.join(self.dir, 'vectors.f32')
+        self.meta_path = os.path.join(self.dir, 'meta.json')
+        self.ivf_path = os.path.join(self.dir, 'ivf.npz')
+
+    def dim(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)['dim']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def locked(self):
+        os.makedirs(self.dir, exist_ok=True)
+        lock = open(os.path.join(self.dir, '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def append(self, vectors):
+        """Append rows; returns the row number of the first. The caller holds locked()"""
+        dim = self.dim()
+        if dim is None:
+            dim = vectors.shape[1]
+            with open(self.meta_path, 'w') as f:
+                json.dump({'dim': dim}, f)
+        elif dim != vectors.shape[1]:
+            raise ValueError(f'Embeddings have {vectors.shape[1]} dimensions, the index {dim}; '
+                             f'the AI server model changed, reset the index')
+        with open(self.path, 'ab') as f:
+            first = f.tell() // (4 * dim)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        return first
+
+    def matrix(self):
+        """Read-only memory map of every row, or None while there are none"""
+        dim = self.dim()
+        try:
+            rows = os.path.getsize(self.path) // (4 * dim) if dim else 0
+        except OSError:
+            rows = 0
+        if not rows:
+            return None
+        return np.memmap(self.path, dtype=np.float32, mode='r', shape=(rows, dim))
+
+    def stamp(self):
+        """Changes whenever the file is appended to or replaced"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size
+
+
+def kmeans(vectors, clusters, iterations=8, seed=0):
+    """Spherical k-means centroids of unit vectors"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assigned = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assigned, vectors)
+        filled = np.bincount(assigned, minlength=clusters) > 0
+        centroids[filled] = normalize(sums[filled])
+    return centroids
+
+
+def assign_rows(matrix, centroids):
+    return np.concatenate([np.argmax(matrix[start:start + SCORE_BLOCK] @ centroids.T, axis=1)
+                           for start in range(0, len(matrix), SCORE_BLOCK)])
+
+
+class UserIndex:
+    """What a search of one user needs in memory: the memory-mapped matrix,
+    which file each row belongs to (-1 for dead rows) and the IVF lists."""
+
+    def __init__(self, vector_file, rows, generation):
+        self.stamp = vector_file.stamp()
+        self.generation = generation
+        self.matrix = vector_file.matrix()
+        count = len(self.matrix) if self.matrix is not None else 0
+        self.files = np.full(count, -1, dtype=np.int64)
+        for row, file_id in rows:
+            if row < count:
+                self.files[row] = file_id
+        self.ivf = None
+        try:
+            with np.load(vector_file.ivf_path) as ivf:
+                if int(ivf['rows']) <= count:
+                    self.ivf = {name: ivf[name] for name in ('centroids', 'order', 'offsets', 'rows')}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def candidate_rows(self, query, probes):
+        """Rows worth scoring: those of the `probes` nearest partitions plus
+        rows appended since the partitions were built; None means all."""
+        if self.ivf is None:
+            return None
+        order, offsets = self.ivf['order'], self.ivf['offsets']
+        nearest = np.argsort(-(self.ivf['centroids'] @ query))[:probes]
+        parts = [order[offsets[c]:offsets[c + 1]] for c in nearest]
+        parts.append(np.arange(int(self.ivf['rows']), len(self.matrix)))
+        return np.sort(np.concatenate(parts))
+
+    def top_files(self, query, k, probes):
+        """[(file_id, score, row)] of the k files with the chunks closest to `query`"""
+        if self.matrix is None:
+            return []
+        rows = self.candidate_rows(query, probes)
+        if rows is None:
+            scores = np.concatenate([self.matrix[start:start + SCORE_BLOCK] @ query
+                                     for start in range(0, len(self.matrix), SCORE_BLOCK)])
+            rows = np.arange(len(self.matrix))
+        else:
+            scores = self.matrix[rows] @ query
+        alive = self.files[rows] >= 0
+        rows, scores = rows[alive], scores[alive]
+        # Best chunk per file: look at enough top chunks to fill k files
+        best = {}
+        shortlist = min(len(scores), k * 20)
+        if shortlist:
+            for i in np.argpartition(-scores, shortlist - 1)[:shortlist]:
+                file_id = int(self.files[rows[i]])
+                if file_id not in best or scores[i] > best[file_id][0]:
+                    best[file_id] = (float(scores[i]), int(rows[i]))
+        ranked = sorted(best.items(), key=lambda item: -item[1][0])[:k]
+        return [(file_id, score, row) for file_id, (score, row) in ranked]
+
+
+class Embeddings:
+    """Semantic search over document text: chunks are embedded once by the
+    AI server in the background, and queries are scored locally with a
+    vectorised cosine over the user's memory-mapped matrix."""
+
+    def __init__(self, config):
+        self.root = os.path.join(config['UPLOAD_FOLDER'], 'embeddings')
+        self.config = config
+        self.client = EmbeddingClient(config)
+        self._indexes = {}  # user_id -> UserIndex
+        self._queries = OrderedDict()  # query text -> embedding
+        self._lock = threading.Lock()
+
+    def vector_file(self, user_id):
+        return VectorFile(self.root, user_id)
+
+    def is_current(self, file):
+        version = text_version(file)
+        return db.session.query(EmbeddingChunk.id).filter_by(file_id=file.id, version=version).first() is not None
+
+    def embed_file(self, file):
+        """Embed the chunks of a File's text, replacing those of an older version.
+
+        Returns the number of chunks embedded; 0 when they were current.
+        """
+        if self.is_current(file):
+            return 0
+        config = self.config
+        with get_text_cache().open(file) as f:
+            text = f.read(config['EMBEDDING_CHUNK_CHARS'] * config['EMBEDDING_MAX_CHUNKS'])
+        chunks = split_chunks(text, config['EMBEDDING_CHUNK_CHARS'], config['EMBEDDING_CHUNK_OVERLAP'])
+        chunks = chunks[:config['EMBEDDING_MAX_CHUNKS']]
+        # Embedded before taking the lock: the AI server is the slow part
+        vectors = self.client.embed(chunks) if chunks else None
+        version = text_version(file)
+
+        vector_file = self.vector_file(file.user_id)
+        lock = vector_file.locked()
+        try:
+            EmbeddingChunk.query.filter_by(file_id=file.id).delete()
+            if vectors is not None:
+                first = vector_file.append(vectors)
+                db.session.add_all([
+                    EmbeddingChunk(user_id=file.user_id, file_id=file.id, row=first + i, chunk=i,
+                                   version=version, excerpt=chunk[:300])
+                    for i, chunk in enumerate(chunks)
+                ])
+            db.session.commit()
+            self._maintain(file.user_id, vector_file)
+        finally:
+            lock.close()
+        return len(chunks)
+
+    def remove_file(self, file_id):
+        """Forget a deleted File's chunks; their rows become dead"""
+        EmbeddingChunk.query.filter_by(file_id=file_id).delete()
+        db.session.commit()
+
+    def _maintain(self, user_id, vector_file):
+        """Compact a vector file with many dead rows, and (re)build its IVF
+        partitions once it is big enough or has grown by a quarter.
+        The caller holds the vector file's lock."""
+        matrix = vector_file.matrix()
+        if matrix is None:
+            return
+        alive = db.session.query(func.count(EmbeddingChunk.id)).filter_by(user_id=user_id).scalar()
+        if len(matrix) - alive > len(matrix) * COMPACT_DEAD_FRACTION:
+            matrix = self._compact(user_id, vector_file, matrix)
+        if matrix is None or len(matrix) < self.config['EMBEDDING_IVF_MIN_VECTORS']:
+            if os.path.exists(vector_file.ivf_path):
+                os.remove(vector_file.ivf_path)
+            return
+        try:
+            with np.load(vector_file.ivf_path) as ivf:
+                built = int(ivf['rows'])
+        except (OSError, ValueError, KeyError):
+            built = 0
+        if built and len(matrix) < built * 1.25:
+            return
+        self._build_ivf(vector_file, matrix)
+
+    def _compact(self, user_id, vector_file, matrix):
+        """Rewrite the vector file without dead rows, renumbering the chunks"""
+        chunks = EmbeddingChunk.query.filter_by(user_id=user_id).order_by(EmbeddingChunk.row).all()
+        kept = np.array([chunk.row for chunk in chunks], dtype=np.int64)
+        tmp_path = f'{vector_file.path}.part'
+        with open(tmp_path, 'wb') as f:
+            for start in range(0, len(kept), SCORE_BLOCK):
+                f.write(np.ascontiguousarray(matrix[kept[start:start + SCORE_BLOCK]]).tobytes())
+        for new_row, chunk in enumerate(chunks):
+            chunk.row = -1 - new_row  # Out of the way of the unique (user_id, row) constraint
+        db.session.flush()
+        for chunk in chunks:
+            chunk.row = -1 - chunk.row
+        os.replace(tmp_path, vector_file.path)
+        db.session.commit()
+        if os.path.exists(vector_file.ivf_path):
+            os.remove(vector_file.ivf_path)
+        logger.info(f"Compacted embeddings of user {user_id} from {len(matrix)} to {len(kept)} rows")
+        return vector_file.matrix()
+
+    def _build_ivf(self, vector_file, matrix):
+        count = len(matrix)
+        clusters = int(count ** 0.5)
+        rng = np.random.default_rng(count)
+        sample = np.asarray(matrix[np.sort(rng.choice(count, min(count, clusters * 64), replace=False))])
+        centroids = kmeans(sample, clusters)
+        assigned = assign_rows(matrix, centroids)
+        order = np.argsort(assigned, kind='stable').astype(np.int32)
+        offsets = np.searchsorted(assigned[order], np.arange(clusters + 1))
+        tmp_path = f'{vector_file.ivf_path}.part.npz'
+        np.savez(tmp_path, centroids=centroids, order=order, offsets=offsets, rows=count)
+        os.replace(tmp_path, vector_file.ivf_path)
+        logger.info(f"Built {clusters} IVF partitions over {count} embeddings in {vector_file.dir}")
+
+    def _index(self, user_id):
+        """The user's UserIndex, reloaded when the vector file or chunks changed"""
+        vector_file = self.vector_file(user_id)
+        stamp = vector_file.stamp()
+        if stamp is None:
+            return None
+        with self._lock:
+            index = self._indexes.get(user_id)
+        # Chunks of deleted files vanish without touching the vector file
+        generation = db.session.query(func.count(EmbeddingChunk.id), func.max(EmbeddingChunk.id)) \
+            .filter_by(user_id=user_id).one()
+        if index is None or index.stamp != stamp or index.generation != tuple(generation):
+            rows = db.session.query(EmbeddingChunk.row, EmbeddingChunk.file_id).filter_by(user_id=user_id).all()
+            index = UserIndex(vector_file, rows, tuple(generation))
+            with self._lock:
+                self._indexes[user_id] = index
+        return index
+
+    def query_vector(self, query):
+        with self._lock:
+            vector = self._queries.get(query)
+            if vector is not None:
+                self._queries.move_to_end(query)
+                return vector
+        vector = self.client.embed([query])[0]
+        with self._lock:
+            self._queries[query] = vector
+            while len(self._queries) > QUERY_CACHE_SIZE:
+                self._queries.popitem(last=False)
+        return vector
+
+    def search(self, user_id, query, k=10):
+        """The user's Files closest in meaning to `query`, as (File, score, excerpt)"""
+        index = self._index(user_id)
+        if index is None or index.matrix is None:
+            return []
+        found = index.top_files(self.query_vector(query), k, self.config['EMBEDDING_IVF_PROBES'])
+        if not found:
+            return []
+        files = {file.id: file for file in File.query.filter(File.id.in_([f for f, _, _ in found]),
+                                                              File.user_id == user_id)}
+        excerpts = dict(db.session.query(EmbeddingChunk.row, EmbeddingChunk.excerpt).filter(
+            EmbeddingChunk.user_id == user_id, EmbeddingChunk.row.in_([row for _, _, row in found])))
+        return [(files[file_id], score, excerpts.get(row, '')) for file_id, score, row in found if file_id in files]
+
+    def stats(self):
+        return {
+            'enabled': is_enabled(),
+            'chunks': db.session.query(func.count(EmbeddingChunk.id)).scalar(),
+            'users_loaded': len(self._indexes),
+            'cached_queries': len(self._queries)
+        }
+
+
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings():
+    with _embeddings_lock:
+        embeddings = current_app.extensions.get('embeddings')
+        if embeddings is None:
+            embeddings = current_app.extensions['embeddings'] = Embeddings(current_app.config)
+        return embeddings
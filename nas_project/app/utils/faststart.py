@@ -0,0 +1,130 @@
+import os
+import struct
+import shutil
+import logging
+import ffmpeg
+from flask import current_app
+from app.models import db, File
+from app.utils.storage import adjust_storage_used
+from app.utils.security_utils import SecurityUtils
+
+logger = logging.getLogger(__name__)
+
+# ffprobe format names of the containers +faststart applies to
+FASTSTART_FORMATS = ('mov', 'mp4', 'm4a', '3gp', '3g2', 'mj2')
+
+
+def is_candidate(file):
+    """Whether a File is an MP4/MOV stored as a plain file of its own.
+
+    Blob- and chunk-deduplicated files share their bytes with other files,
+    so they are never rewritten in place.
+    """
+    if not current_app.config['FASTSTART_ENABLED'] or file.blob_sha256 or file.is_chunked:
+        return False
+    ext = file.original_filename.rsplit('.', 1)[-1].lower() if '.' in file.original_filename else ''
+    return ext in current_app.config['FASTSTART_EXTENSIONS']
+
+
+def top_level_atoms(path):
+    """Yield (type, offset, size) of the top-level boxes of an ISO media file"""
+    total = os.path.getsize(path)
+    offset = 0
+    with open(path, 'rb') as f:
+        while offset + 8 <= total:
+            f.seek(offset)
+            header = f.read(16)
+            size, kind = struct.unpack('>I4s', header[:8])
+            if size == 1 and len(header) == 16:
+                size = struct.unpack('>Q', header[8:16])[0]
+            elif size == 0:
+                size = total - offset
+            if size < 8:
+                return
+            yield kind, offset, size
+            offset += size
+
+
+def needs_faststart(path):
+    """True when ffprobe sees an MP4/MOV whose moov atom comes after mdat.
+
+    ffprobe identifies the container; where moov sits is read from the
+    box headers, which costs a handful of small reads.
+    """
+    try:
+        probe = ffmpeg.probe(path)
+    except ffmpeg.Error:
+        return False
+    formats = probe.get('format', {}).get('format_name', '').split(',')
+    if not any(name in FASTSTART_FORMATS for name in formats):
+        return False
+    for kind, _, _ in top_level_atoms(path):
+        if kind == b'moov':
+            return False
+        if kind == b'mdat':
+            return True
+    return False
+
+
+def remux(source, target):
+    """Copy every stream of `source` into `target` with moov moved to the front"""
+    fmt = 'mov' if source.lower().endswith('.mov') else 'mp4'
+    (
+        ffmpeg
+        .input(source)
+        .output(target, format=fmt, c='copy', map=0, map_metadata=0, movflags='+faststart')
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+
+
+def faststart_file(file_id):
+    """Remux one File to faststart, swapping it in place.
+
+    The remuxed copy is written next to the original and renamed over it,
+    so readers see either the old or the new file, never a partial one;
+    downloads already running keep reading the old inode. The row's size,
+    hash and the owner's usage are updated after the swap; if the file was
+    deleted or moved meanwhile, the new copy is removed instead.
+    """
+    file = db.session.get(File, file_id)
+    if file is None or not is_candidate(file) or not os.path.exists(file.path):
+        return False
+    path, old_size = file.path, file.file_size or 0
+    if not needs_faststart(path):
+        return False
+
+    free = shutil.disk_usage(os.path.dirname(path)).free
+    if free < old_size + current_app.config['DISK_FREE_MARGIN']:
+        logger.warning(f"Not enough space to remux file {file_id} to faststart")
+        return False
+
+    root, ext = os.path.splitext(path)
+    tmp_path = f'{root}.faststart{ext}'
+    try:
+        remux(path, tmp_path)
+        # Permissions only: the new mtime is what tells caches the bytes changed
+        shutil.copymode(path, tmp_path)
+    except ffmpeg.Error as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        logger.error(f"Faststart remux of file {file_id} failed: {e.stderr.decode('utf-8', 'replace')[-500:]}")
+        return False
+
+    new_size = os.path.getsize(tmp_path)
+    sha256 = SecurityUtils.hash_file(tmp_path) if file.sha256 else None
+    os.replace(tmp_path, path)
+
+    values = {File.file_size: new_size}
+    if sha256:
+        values[File.sha256] = sha256
+    updated = File.query.filter_by(id=file_id, path=path).update(values, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        if os.path.exists(path) and not File.query.filter_by(path=path).first():
+            os.remove(path)
+        return False
+    adjust_storage_used(file.user_id, new_size - old_size)
+    db.session.commit()
+    logger.info(f"Remuxed file {file_id} to faststart ({old_size} -> {new_size} bytes)")
+    return True
@@ -0,0 +1,236 @@
+import os
+import math
+import queue
+import logging
+import itertools
+import threading
+import subprocess
+from concurrent.futures import Future
+import ffmpeg
+from flask import current_app
+from app.config import Config
+from app.utils.disk_cache import DiskCache
+from app.utils.storage import content_version
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_EXT = '.ts'
+
+# Job priorities: segments a player is waiting for go before read-ahead
+PRIORITY_PLAYBACK = 0
+PRIORITY_PREFETCH = 1
+
+
+def is_video(file):
+    if file.mime_type and file.mime_type.startswith('video/'):
+        return True
+    return Config.get_file_category(file.original_filename) == 'video'
+
+
+def cache_key(file):
+    """Directory name for a file's renditions; changes when its content does"""
+    return f'{file.id}-{content_version(file)}'
+
+
+def renditions_for(metadata, ladder):
+    """Renditions of the HLS_RENDITIONS ladder worth offering for a source.
+
+    Nothing is upscaled; a source smaller than every rung still gets the
+    lowest one so it can be played at a low bitrate.
+    """
+    height = metadata.get('height') or 0
+    fitting = [r for r in ladder if r['height'] <= height]
+    if not fitting:
+        fitting = [min(ladder, key=lambda r: r['height'])]
+    return sorted(fitting, key=lambda r: r['video_bitrate'], reverse=True)
+
+
+def rendition_width(metadata, height):
+    """Width that keeps the source aspect ratio, rounded to an even number"""
+    if not metadata.get('width') or not metadata.get('height'):
+        return round(height * 16 / 9 / 2) * 2
+    return round(metadata['width'] * height / metadata['height'] / 2) * 2
+
+
+def segment_count(duration, segment_seconds):
+    return max(1, math.ceil(duration / segment_seconds))
+
+
+def master_playlist(metadata, ladder):
+    """Master playlist text; rendition URIs are relative to it"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in renditions_for(metadata, ladder):
+        bandwidth = rendition['video_bitrate'] + (rendition['audio_bitrate'] if metadata.get('has_audio') else 0)
+        codecs = 'avc1.4d401f,mp4a.40.2' if metadata.get('has_audio') else 'avc1.4d401f'
+        lines.append(
+            f'#EXT-X-STREAM-INF:BANDWIDTH={int(bandwidth * 1.1)},AVERAGE-BANDWIDTH={bandwidth},'
+            f'RESOLUTION={rendition_width(metadata, rendition["height"])}x{rendition["height"]},'
+            f'CODECS="{codecs}",NAME="{rendition["name"]}"')
+        lines.append(f'{rendition["name"]}.m3u8')
+    return '\n'.join(lines) + '\n'
+
+
+def media_playlist(metadata, rendition, segment_seconds):
+    """VOD playlist of one rendition.
+
+    Segment boundaries follow from the duration alone, so the playlist is
+    complete before a single segment has been transcoded.
+    """
+    duration = metadata.get('duration') or 0
+    count = segment_count(duration, segment_seconds)
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-PLAYLIST-TYPE:VOD',
+             f'#EXT-X-TARGETDURATION:{math.ceil(segment_seconds)}', '#EXT-X-MEDIA-SEQUENCE:0']
+    for index in range(count):
+        length = min(segment_seconds, duration - index * segment_seconds) if duration else segment_seconds
+        lines.append(f'#EXTINF:{max(length, 0.001):.3f},')
+        lines.append(f'{rendition["name"]}/{index}{SEGMENT_EXT}')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+class Transcoder:
+    """Produces HLS segments with ffmpeg in a small pool of worker threads.
+
+    Each segment is encoded on its own, starting at its offset in the
+    source (-ss before -i, so ffmpeg seeks instead of decoding from the
+    start) and with -output_ts_offset so timestamps continue across
+    segments. A segment a player is waiting for jumps ahead of read-ahead
+    work, and concurrent requests for one segment share a single encode.
+    """
+
+    def __init__(self, config):
+        self.root = os.path.join(config['UPLOAD_FOLDER'], 'hls')
+        self.segment_seconds = config['HLS_SEGMENT_SECONDS']
+        self.prefetch = config['HLS_PREFETCH_SEGMENTS']
+        self.preset = config['HLS_PRESET']
+        self.timeout = config['HLS_SEGMENT_TIMEOUT']
+        self.cache = DiskCache(self.root, config['HLS_CACHE_BUDGET'], (SEGMENT_EXT,))
+        self._jobs = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._inflight = {}  # target path -> Future
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f'hls-transcoder-{i}', daemon=True)
+                         for i in range(max(1, config['HLS_WORKERS']))]
+        for thread in self._threads:
+            thread.start()
+
+    def segment_path(self, key, rendition, index):
+        return os.path.join(self.root, key, rendition['name'], f'{index}{SEGMENT_EXT}')
+
+    def _submit(self, priority, source, key, metadata, rendition, index):
+        target = self.segment_path(key, rendition, index)
+        with self._lock:
+            future = self._inflight.get(target)
+            if future is None:
+                future = self._inflight[target] = Future()
+            elif priority != PRIORITY_PLAYBACK:
+                return future
+            # Requeued at playback priority if it was only read-ahead so far
+            self._jobs.put((priority, next(self._order), (future, source, target, metadata, rendition, index)))
+        return future
+
+    def _work(self):
+        while True:
+            _, _, job = self._jobs.get()
+            future, source, target, metadata, rendition, index = job
+            with self._lock:
+                # A requeued job shows up twice; only the first one runs
+                if future.running() or future.done() or not future.set_running_or_notify_cancel():
+                    continue
+            try:
+                self._transcode(source, target, metadata, rendition, index)
+                self.cache.add(target, os.path.getsize(target))
+                future.set_result(target)
+            except Exception as e:
+                logger.error(f"Transcoding {target} failed: {str(e)}")
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(target, None)
+
+    def _transcode(self, source, target, metadata, rendition, index):
+        start = index * self.segment_seconds
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f'{target}.part'
+        stream = ffmpeg.input(source, ss=start, t=self.segment_seconds)
+        video = stream.video.filter('scale', rendition_width(metadata, rendition['height']), rendition['height'])
+        outputs = [video]
+        options = {
+            'format': 'mpegts',
+            'vcodec': 'libx264',
+            'preset': self.preset,
+            'profile:v': 'main',
+            'pix_fmt': 'yuv420p',
+            'video_bitrate': rendition['video_bitrate'],
+            'maxrate': int(rendition['video_bitrate'] * 1.2),
+            'bufsize': rendition['video_bitrate'] * 2,
+            'force_key_frames': 'expr:gte(t,0)',
+            'sc_threshold': 0,
+            'output_ts_offset': start,
+            'muxdelay': 0,
+        }
+        if metadata.get('has_audio'):
+            outputs.append(stream.audio)
+            options.update({'acodec': 'aac', 'audio_bitrate': rendition['audio_bitrate'], 'ac': 2})
+        process = ffmpeg.output(*outputs, tmp_path, **options).overwrite_output() \
+            .run_async(pipe_stdout=True, pipe_stderr=True)
+        try:
+            _, stderr = process.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError(f'ffmpeg took longer than {self.timeout}s')
+        if process.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError(stderr.decode('utf-8', 'replace')[-500:])
+        os.replace(tmp_path, target)
+
+    def get_segment(self, source, key, metadata, rendition, index):
+        """Path of a segment, transcoding it now if it is not cached.
+
+        Also queues the next HLS_PREFETCH_SEGMENTS segments in the
+        background so playback does not wait on every one of them.
+        """
+        count = segment_count(metadata.get('duration') or 0, self.segment_seconds)
+        for ahead in range(index + 1, min(index + 1 + self.prefetch, count)):
+            if not self.cache.contains(self.segment_path(key, rendition, ahead)):
+                self._submit(PRIORITY_PREFETCH, source, key, metadata, rendition, ahead)
+
+        target = self.segment_path(key, rendition, index)
+        if self.cache.touch(target):
+            return target
+        future = self._submit(PRIORITY_PLAYBACK, source, key, metadata, rendition, index)
+        return future.result(timeout=self.timeout)
+
+    def forget(self, file_id):
+        """Remove every segment of a deleted file and cancel its queued encodes.
+
+        A segment that is being encoded right now still lands in the
+        cache, where it is evicted like any other unused entry.
+        """
+        prefix = f'{file_id}-'
+        with self._lock:
+            for target, future in list(self._inflight.items()):
+                if os.path.relpath(target, self.root).startswith(prefix) and future.cancel():
+                    del self._inflight[target]
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name.startswith(prefix):
+                    self.cache.remove_tree(os.path.join(self.root, name))
+
+    def stats(self):
+        return {'queued': self._jobs.qsize(), 'inflight': len(self._inflight), 'cache': self.cache.usage()}
+
+
+_transcoder_lock = threading.Lock()
+
+
+def get_transcoder():
+    with _transcoder_lock:
+        transcoder = current_app.extensions.get('hls_transcoder')
+        if transcoder is None:
+            transcoder = current_app.extensions['hls_transcoder'] = Transcoder(current_app.config)
+        return transcoder
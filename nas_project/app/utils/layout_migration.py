@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import errno
+import shutil
+import logging
+from flask import current_app
+from app.models import db, File
+from app.utils.storage import new_storage_path, is_sharded, thumbnail_path, sprite_paths
+from app.utils.volumes import get_pool, remove_paths
+
+logger = logging.getLogger(__name__)
+
+STATE_FILENAME = '.layout_migration.json'
+
+
+def get_state_path():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], STATE_FILENAME)
+
+
+def load_state():
+    """Progress of an earlier run: last File.id handled and old paths not yet removed"""
+    try:
+        with open(get_state_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'last_id': 0, 'pending': [], 'moved': 0, 'missing': []}
+
+
+def save_state(state):
+    path = get_state_path()
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _link(source, target):
+    """Hard link `source` to `target`, copying when they are on different filesystems"""
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, target)
+
+
+def move_file(file_id, old_path, user_id, filename, size=0):
+    """Give one file a sharded path.
+
+    The body is linked at the new path and File.path switched with a
+    conditional UPDATE, so the row is only touched if nobody changed or
+    deleted it meanwhile. The old path keeps working until the caller
+    removes it. Returns True when the row was moved. The caller commits.
+    """
+    volume = get_pool().volume_for_path(old_path)
+    new_path = new_storage_path(user_id, filename or old_path, size, prefer=volume)
+    _link(old_path, new_path)
+    old_thumb = thumbnail_path(old_path)
+    if os.path.exists(old_thumb):
+        _link(old_thumb, thumbnail_path(new_path))
+
+    moved = File.query.filter_by(id=file_id, path=old_path).update(
+        {File.path: new_path, File.volume: get_pool().volume_for_path(new_path)},
+        synchronize_session=False)
+    if not moved:
+        remove_paths([new_path, thumbnail_path(new_path)])
+    return bool(moved)
+
+
+def migrate_batch(state, batch_size):
+    """Move the next `batch_size` unsharded files. Returns how many rows were examined."""
+    rows = db.session.query(File.id, File.path, File.user_id, File.filename, File.file_size).filter(
+        File.id > state['last_id'],
+        File.blob_sha256.is_(None),
+        File.is_chunked.isnot(True)
+    ).order_by(File.id).limit(batch_size).all()
+
+    for file_id, path, user_id, filename, file_size in rows:
+        state['last_id'] = file_id
+        if is_sharded(path, user_id):
+            continue
+        if not os.path.exists(path):
+            state['missing'].append(file_id)
+            logger.warning(f"File {file_id} is missing on disk: {path}")
+            continue
+        if move_file(file_id, path, user_id, filename, file_size or 0):
+            state['pending'].extend([path, thumbnail_path(path)] + sprite_paths(path))
+            state['moved'] += 1
+    db.session.commit()
+    return len(rows)
+
+
+def run(batch_size=200, grace=30, pause=0.5, max_batches=None, progress=print):
+    """Migrate every file to the sharded layout, a batch at a time.
+
+    Safe to run while the server is up: each batch is committed before its
+    old paths are removed, and removal waits `grace` seconds so downloads
+    that looked up the old path just before the commit can still open it.
+    Progress is saved to UPLOAD_FOLDER/.layout_migration.json after every
+    step, so an interrupted run resumes where it stopped.
+    """
+    state = load_state()
+    if state['pending']:
+        progress(f"Removing {len(state['pending'])} old paths left by the previous run")
+        remove_paths(state['pending'])
+        state['pending'] = []
+        save_state(state)
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        examined = migrate_batch(state, batch_size)
+        save_state(state)
+        if not examined:
+            break
+        batches += 1
+        progress(f"Batch {batches}: up to file {state['last_id']}, {state['moved']} moved so far")
+
+        if state['pending']:
+            time.sleep(grace)
+            remove_paths(state['pending'])
+            state['pending'] = []
+            save_state(state)
+        time.sleep(pause)
+
+    return state
@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+from datetime import datetime
+import ffmpeg
+from PIL import Image, ExifTags
+from sqlalchemy.exc import IntegrityError
+from app.config import Config
+from app.models import db, File, MediaInfo
+from app.utils.background import enqueue, PRIORITY_INTERACTIVE
+
+logger = logging.getLogger(__name__)
+
+PROBED_KINDS = ('video', 'audio', 'image')
+
+# EXIF fields kept for display; maker notes and embedded thumbnails are bulky
+EXIF_FIELDS = {
+    'Make', 'Model', 'LensModel', 'Software', 'DateTime', 'DateTimeOriginal', 'Orientation',
+    'ExposureTime', 'FNumber', 'ISOSpeedRatings', 'FocalLength', 'Flash'
+}
+EXIF_IFD = 0x8769  # Sub-IFD holding the camera settings
+
+# Stream fields kept per stream, when ffprobe reports them
+STREAM_FIELDS = ('width', 'height', 'pix_fmt', 'channels', 'channel_layout', 'sample_rate', 'bit_rate')
+
+# Columns a probe fills in; the rest are reset when a file is re-probed
+PROBE_COLUMNS = ('kind', 'format_name', 'duration', 'width', 'height', 'codec',
+                 'audio_codec', 'bitrate', 'frame_rate', 'error')
+
+
+def media_kind(file):
+    """'video', 'audio' or 'image' for files worth probing, else None"""
+    if file.mime_type:
+        kind = file.mime_type.split('/', 1)[0]
+        if kind in PROBED_KINDS:
+            return kind
+    kind = Config.get_file_category(file.original_filename)
+    return kind if kind in PROBED_KINDS else None
+
+
+def is_probeable(file):
+    # ffprobe and Pillow need a real path; chunked files have none
+    return media_kind(file) is not None and not file.is_chunked
+
+
+def _number(value, cast=float):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _frame_rate(stream):
+    num, _, den = (stream.get('avg_frame_rate') or stream.get('r_frame_rate') or '').partition('/')
+    try:
+        return round(float(num) / float(den or 1), 3)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def probe_av(path):
+    """Fields of a video or audio file, from a single ffprobe run"""
+    probe = ffmpeg.probe(path)
+    fmt = probe.get('format', {})
+    streams = probe.get('streams', [])
+    # Cover art in audio files shows up as a one-frame video stream
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+    info = {
+        'kind': 'video' if video else 'audio',
+        'format_name': fmt.get('format_name'),
+        'duration': _number(fmt.get('duration')),
+        'bitrate': _number(fmt.get('bit_rate'), int),
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'streams': [
+            dict({'index': s.get('index'), 'type': s.get('codec_type'), 'codec': s.get('codec_name')},
+                 **{field: s[field] for field in STREAM_FIELDS if field in s})
+            for s in streams
+        ],
+        'tags': fmt.get('tags', {})
+    }
+    if video:
+        info.update(width=_number(video.get('width'), int), height=_number(video.get('height'), int),
+                    codec=video.get('codec_name'), frame_rate=_frame_rate(video))
+    return info
+
+
+def exif_tags(img):
+    exif = img.getexif()
+    fields = dict(exif)
+    fields.update(exif.get_ifd(EXIF_IFD))
+    tags = {}
+    for tag, value in fields.items():
+        name = ExifTags.TAGS.get(tag)
+        if name not in EXIF_FIELDS:
+            continue
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        if isinstance(value, str):
+            value = value.strip('\x00 ')
+        tags[name] = value
+    return tags
+
+
+def probe_image(path):
+    """Dimensions, format and EXIF of an image; Pillow reads only the header"""
+    with Image.open(path) as img:
+        return {
+            'kind': 'image',
+            'format_name': img.format,
+            'codec': img.format,
+            'width': img.width,
+            'height': img.height,
+            'tags': exif_tags(img)
+        }
+
+
+def file_version(file):
+    """(size, mtime) of a File's bytes on disk, or None if they are missing"""
+    try:
+        stat = os.stat(file.path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def is_current(info, version):
+    return info is not None and version is not None and (info.size, info.mtime) == version
+
+
+def store_media_info(file, version, info=None):
+    """Probe a File and save the result, replacing a stale row"""
+    kind = media_kind(file)
+    try:
+        fields = probe_image(file.path) if kind == 'image' else probe_av(file.path)
+    except ffmpeg.Error as e:
+        fields = {'kind': kind, 'error': e.stderr.decode('utf-8', 'replace').strip()[-255:] or 'ffprobe failed'}
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, ValueError) as e:
+        fields = {'kind': kind, 'error': str(e)[:255]}
+    except OSError as e:
+        # ffprobe missing or the file unreadable: nothing worth remembering
+        logger.error(f"Could not probe file {file.id}: {str(e)}")
+        return None
+
+    if info is None:
+        info = MediaInfo(file_id=file.id)
+        db.session.add(info)
+    for column in PROBE_COLUMNS:
+        setattr(info, column, fields.get(column))
+    info.streams = json.dumps(fields.get('streams') or [])
+    info.tags = json.dumps(fields.get('tags') or {}, default=str)
+    info.size, info.mtime = version
+    info.probed_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Probed concurrently by another request or job
+        db.session.rollback()
+        info = db.session.get(MediaInfo, file.id)
+    return info
+
+
+def get_media_info(file, probe=True):
+    """Stored media info of a File, probing it first when missing or stale.
+
+    A row is stale once the file's size or mtime differ from the probed
+    version. With probe=False only current stored info is returned.
+    """
+    if not is_probeable(file):
+        return None
+    version = file_version(file)
+    if version is None:
+        return None
+    info = db.session.get(MediaInfo, file.id)
+    if is_current(info, version):
+        return info
+    if not probe:
+        return None
+    return store_media_info(file, version, info)
+
+
+def probe_file(file_id):
+    """Background job: store a File's media info if it is missing or stale"""
+    file = db.session.get(File, file_id)
+    if file is not None:
+        get_media_info(file)
+
+
+def cached_media_info(file):
+    """Stored media info without waiting on ffprobe.
+
+    A missing or stale row is probed in the background for the next view.
+    """
+    info = get_media_info(file, probe=False)
+    if info is None and is_probeable(file) and os.path.exists(file.path):
+        enqueue('probe', file.id, priority=PRIORITY_INTERACTIVE)
+    return info
+
+
+def media_info_map(files):
+    """{file_id: MediaInfo} of the current stored info of `files`, never probing"""
+    ids = [file.id for file in files if is_probeable(file)]
+    if not ids:
+        return {}
+    rows = {info.file_id: info for info in MediaInfo.query.filter(MediaInfo.file_id.in_(ids))}
+    return {file.id: rows[file.id] for file in files
+            if file.id in rows and is_current(rows[file.id], file_version(file))}
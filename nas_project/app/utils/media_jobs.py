@@ -0,0 +1,140 @@
+import logging
+from flask import current_app
+from app.models import db, File
+from app.utils.background import job, enqueue, PRIORITY_UPLOAD, PRIORITY_BACKFILL
+from app.utils import faststart, media_info, sprites, derivatives, pdf_pages, search, embeddings, chunk_store
+
+logger = logging.getLogger(__name__)
+
+
+@job('media')
+def process_media(file_id, args=''):
+    """Post-upload media work for one File, in order.
+
+    The remux runs first so the probe records the final bytes; a failed
+    remux still leaves the original worth probing. Sprites need the
+    probed duration, so they come after it. A file due for the chunk
+    store is split last, since that takes its real path away.
+    """
+    file = db.session.get(File, file_id)
+    if file is None:
+        return
+    if faststart.is_candidate(file):
+        try:
+            faststart.faststart_file(file_id)
+        except Exception as e:
+            logger.error(f"Faststart of file {file_id} failed: {str(e)}")
+            db.session.rollback()
+    if current_app.config['MEDIA_INFO_ON_UPLOAD'] and media_info.is_probeable(file):
+        media_info.probe_file(file_id)
+        if sprites.is_candidate(file) and not chunk_store.is_candidate(file):
+            sprites.generate_sprites(file_id)
+    if chunk_store.is_candidate(file):
+        chunk_store.chunk_file(file_id)
+
+
+@job('chunk')
+def chunk_for_dedup(file_id, args=''):
+    """Split a large plain File into the chunk store"""
+    chunk_store.chunk_file(file_id)
+
+
+@job('probe')
+def probe_media(file_id, args=''):
+    media_info.probe_file(file_id)
+
+
+@job('sprites')
+def make_sprites(file_id, args=''):
+    sprites.generate_sprites(file_id)
+
+
+@job('derivative')
+def make_derivative(file_id, args):
+    """Render one image derivative; `args` is '<size>.<format>'"""
+    file = db.session.get(File, file_id)
+    if file is None or not derivatives.is_candidate(file):
+        return
+    size, fmt = args.split('.')
+    derivatives.get_derivatives().get(file, int(size), fmt)
+
+
+@job('pdf_page')
+def render_pdf_page(file_id, args):
+    """Render one PDF page; `args` is '<page>.<dpi>.<format>'"""
+    file = db.session.get(File, file_id)
+    if file is None or not pdf_pages.is_candidate(file):
+        return
+    page, dpi, fmt = args.split('.')
+    try:
+        pdf_pages.get_pdf_pages().render(file, int(page), int(dpi), fmt)
+    except IndexError:
+        return  # Past the last page; the request gets a 415
+
+
+@job('search_index')
+def index_for_search(file_id, args=''):
+    """Index a File's name, tags and extracted text for search"""
+    file = db.session.get(File, file_id)
+    if file is None:
+        search.remove_file(file_id)
+    else:
+        search.index_file(file)
+
+
+@job('embed')
+def embed_text(file_id, args=''):
+    """Embed a document's text chunks for semantic search; AI server errors retry"""
+    file = db.session.get(File, file_id)
+    if file is not None and embeddings.is_candidate(file):
+        embeddings.get_embeddings().embed_file(file)
+
+
+def queue_derivatives(file, sizes, priority):
+    for size in sizes:
+        enqueue('derivative', file.id, f'{size}.webp', priority)
+
+
+def after_upload(file):
+    """Queue the media processing a newly committed File needs"""
+    if faststart.is_candidate(file) or (current_app.config['MEDIA_INFO_ON_UPLOAD'] and media_info.is_probeable(file)):
+        # Also chunks the file once the rest is done
+        enqueue('media', file.id, priority=PRIORITY_UPLOAD)
+    elif chunk_store.is_candidate(file):
+        enqueue('chunk', file.id, priority=PRIORITY_BACKFILL)
+    if derivatives.is_candidate(file):
+        queue_derivatives(file, current_app.config['DERIVATIVE_PREGENERATE'], PRIORITY_UPLOAD)
+    # Searchable by name straight away; the text follows from the queue
+    search.index_file(file, with_content=False)
+    if search.needs_content(file):
+        enqueue('search_index', file.id, priority=PRIORITY_UPLOAD)
+    # Waits on the AI server, so it does not hold up previews
+    if embeddings.is_candidate(file):
+        enqueue('embed', file.id, priority=PRIORITY_BACKFILL)
+
+
+def backfill(user_id=None):
+    """Queue probes, sprites, listing thumbnails, search indexing, embeddings and
+    chunking for files uploaded before they existed. Jobs whose output is
+    current finish without work. Returns the number of files looked at.
+    """
+    query = File.query
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    # Loaded up front: SQLite cannot take the queue's writes while a read cursor is open
+    files = query.all()
+    unindexed = set(search.unindexed_file_ids(user_id))
+    for file in files:
+        if file.id in unindexed or search.needs_content(file):
+            enqueue('search_index', file.id, priority=PRIORITY_BACKFILL)
+        if embeddings.is_candidate(file) and not embeddings.get_embeddings().is_current(file):
+            enqueue('embed', file.id, priority=PRIORITY_BACKFILL)
+        if chunk_store.is_candidate(file):
+            enqueue('chunk', file.id, priority=PRIORITY_BACKFILL)
+        if media_info.is_probeable(file):
+            enqueue('probe', file.id, priority=PRIORITY_BACKFILL)
+        if sprites.is_candidate(file) and not chunk_store.is_candidate(file):
+            enqueue('sprites', file.id, priority=PRIORITY_BACKFILL)
+        if derivatives.is_candidate(file):
+            queue_derivatives(file, current_app.config['DERIVATIVE_PREGENERATE'], PRIORITY_BACKFILL)
+    return len(files)
@@ -0,0 +1,120 @@
+import os
+import threading
+from collections import OrderedDict
+import fitz  # PyMuPDF
+from PIL import Image
+from flask import current_app
+from app.utils.disk_cache import DiskCache
+from app.utils.derivatives import FORMATS
+from app.utils.storage import content_version
+
+
+def is_candidate(file):
+    """Whether a File can be shown in the page viewer; fitz needs a real path"""
+    if file.is_chunked:
+        return False
+    return file.mime_type == 'application/pdf' or file.original_filename.lower().endswith('.pdf')
+
+
+class DocumentPool:
+    """Open fitz documents, the least recently used closed past `size`.
+
+    Opening a PDF parses its cross-reference table, which for a long
+    manual costs more than rendering a page; keeping it open makes every
+    later page cheap. MuPDF is not thread-safe, so callers hold `lock`
+    for as long as they use a document.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.RLock()
+        self._documents = OrderedDict()  # (path, content version) -> fitz.Document
+
+    def get(self, path, version):
+        key = (path, version)
+        doc = self._documents.get(key)
+        if doc is not None:
+            self._documents.move_to_end(key)
+            return doc
+        doc = fitz.open(path)
+        if doc.needs_pass:
+            doc.close()
+            raise ValueError('PDF is password protected')
+        self._documents[key] = doc
+        while len(self._documents) > self.size:
+            _, oldest = self._documents.popitem(last=False)
+            oldest.close()
+        return doc
+
+    def __len__(self):
+        return len(self._documents)
+
+
+class PdfPages:
+    """PDF pages rendered to WebP/JPEG on request and kept in a DiskCache"""
+
+    def __init__(self, config):
+        self.root = os.path.join(config['UPLOAD_FOLDER'], 'pdf_pages')
+        self.quality = config['DERIVATIVE_QUALITY']
+        self.max_pixels = config['PDF_MAX_PAGE_PIXELS']
+        self.cache = DiskCache(self.root, config['PDF_PAGE_CACHE_BUDGET'], tuple(f'.{ext}' for ext in FORMATS))
+        self.documents = DocumentPool(config['PDF_MAX_OPEN_DOCUMENTS'])
+
+    def info(self, file):
+        """Page count and the size of the first page in points"""
+        with self.documents.lock:
+            doc = self.documents.get(file.path, content_version(file))
+            rect = doc[0].rect if doc.page_count else fitz.Rect(0, 0, 612, 792)
+            return {'pages': doc.page_count, 'width': rect.width, 'height': rect.height}
+
+    def path_for(self, file, page, dpi, fmt):
+        return os.path.join(self.root, str(file.id), content_version(file), f'{page}-{dpi}.{fmt}')
+
+    def lookup(self, file, page, dpi, fmt):
+        """Path of a cached page image, or None if it still has to be rendered"""
+        target = self.path_for(file, page, dpi, fmt)
+        return target if self.cache.touch(target) else None
+
+    def render(self, file, page, dpi, fmt):
+        """Render page number `page` (from 1) and cache it; returns its path"""
+        target = self.path_for(file, page, dpi, fmt)
+        if self.cache.touch(target):
+            return target
+        with self.documents.lock:
+            doc = self.documents.get(file.path, content_version(file))
+            if not 1 <= page <= doc.page_count:
+                raise IndexError(f'Page {page} is out of range')
+            pdf_page = doc[page - 1]
+            zoom = dpi / 72
+            pixels = pdf_page.rect.width * pdf_page.rect.height * zoom * zoom
+            if pixels > self.max_pixels:
+                zoom *= (self.max_pixels / pixels) ** 0.5
+            pixmap = pdf_page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            img = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f'{target}.part'
+        img.save(tmp_path, FORMATS[fmt][0], quality=self.quality)
+        os.replace(tmp_path, target)
+        self.cache.add(target, os.path.getsize(target))
+        return target
+
+    def forget(self, file_id):
+        """Remove every rendered page of a deleted file"""
+        self.cache.remove_tree(os.path.join(self.root, str(file_id)))
+
+    def stats(self):
+        stats = self.cache.usage()
+        stats['open_documents'] = len(self.documents)
+        return stats
+
+
+_pdf_pages_lock = threading.Lock()
+
+
+def get_pdf_pages():
+    with _pdf_pages_lock:
+        pdf_pages = current_app.extensions.get('pdf_pages')
+        if pdf_pages is None:
+            pdf_pages = current_app.extensions['pdf_pages'] = PdfPages(current_app.config)
+        return pdf_pages
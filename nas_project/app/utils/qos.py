@@ -0,0 +1,379 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from flask import current_app, request
+from app.utils.ranges import resolve_ranges
+
+logger = logging.getLogger(__name__)
+
+STATE_FILENAME = '.qos.json'
+
+# Largest piece sent between two bucket checks, so low rates stay smooth
+SLICE_SIZE = 64 * 1024
+
+# Settings admins can change at runtime, persisted in UPLOAD_FOLDER/.qos.json
+SETTINGS = (
+    'QOS_ENABLED',
+    'QOS_GLOBAL_DOWNLOAD_RATE', 'QOS_GLOBAL_UPLOAD_RATE',
+    'QOS_USER_DOWNLOAD_RATE', 'QOS_USER_UPLOAD_RATE',
+    'QOS_INTERACTIVE_RESERVE', 'QOS_INTERACTIVE_MAX',
+)
+
+DIRECTIONS = ('download', 'upload')
+
+
+class TokenBucket:
+    """Token bucket that lets callers run into debt.
+
+    consume() always takes the tokens and returns how long the caller has
+    to sleep to pay the debt back, so one check covers a whole block and
+    several buckets can be charged at once (the longest wait wins).
+    A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate, burst_seconds):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = rate * burst_seconds
+        self.updated = time.monotonic()
+
+    def consume(self, n, now):
+        if not self.rate:
+            return 0
+        capacity = self.rate * self.burst_seconds
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class RateMeter:
+    """Exponentially decaying bytes-per-second average over ~`tau` seconds"""
+
+    def __init__(self, tau=5.0):
+        self.tau = tau
+        self.value = 0.0
+        self.updated = time.monotonic()
+
+    def add(self, n, now):
+        self.value = self.rate(now) + n / self.tau
+        self.updated = now
+
+    def rate(self, now):
+        return self.value * math.exp(-(now - self.updated) / self.tau)
+
+
+class Limiter:
+    """A rate limit with part of it held back for interactive transfers.
+
+    Every transfer is charged to the `all` bucket at the full rate; bulk
+    transfers are also charged to the `bulk` bucket, which only refills at
+    (1 - reserve) of it. Bulk traffic alone can therefore never take the
+    reserved share, and a video seek gets it without waiting for the
+    downloads already running.
+    """
+
+    def __init__(self, rate, reserve, burst_seconds):
+        self.all = TokenBucket(rate, burst_seconds)
+        self.bulk = TokenBucket(rate * (1 - reserve), burst_seconds)
+        self.meter = RateMeter()
+        self.active = 0
+
+    def set_rate(self, rate, reserve):
+        self.all.rate = rate
+        self.bulk.rate = rate * (1 - reserve)
+
+    def consume(self, n, interactive, now):
+        self.meter.add(n, now)
+        wait = self.all.consume(n, now)
+        if not interactive:
+            wait = max(wait, self.bulk.consume(n, now))
+        return wait
+
+
+class Shaper:
+    """Global and per-user limiters for one direction (download or upload)"""
+
+    def __init__(self, qos, direction):
+        self.qos = qos
+        self.direction = direction
+        self.global_limiter = Limiter(0, 0, qos.burst_seconds)
+        self.users = {}  # user_id -> Limiter
+        self.apply_settings()
+
+    def global_rate(self):
+        return self.qos.settings[f'QOS_GLOBAL_{self.direction.upper()}_RATE'] or 0
+
+    def user_rate(self, user_id):
+        override = self.qos.user_rates.get(str(user_id), {}).get(self.direction)
+        if override is not None:
+            return override
+        return self.qos.settings[f'QOS_USER_{self.direction.upper()}_RATE'] or 0
+
+    def apply_settings(self):
+        reserve = self.qos.settings['QOS_INTERACTIVE_RESERVE']
+        self.global_limiter.set_rate(self.qos.process_share(self.global_rate()), reserve)
+        for user_id, limiter in self.users.items():
+            limiter.set_rate(self.qos.process_share(self.user_rate(user_id)), reserve)
+
+    def user_limiter(self, user_id):
+        limiter = self.users.get(user_id)
+        if limiter is None:
+            limiter = self.users[user_id] = Limiter(
+                self.qos.process_share(self.user_rate(user_id)),
+                self.qos.settings['QOS_INTERACTIVE_RESERVE'], self.qos.burst_seconds)
+        return limiter
+
+    def start(self, user_id):
+        with self.qos.lock:
+            self.global_limiter.active += 1
+            self.user_limiter(user_id).active += 1
+
+    def finish(self, user_id):
+        with self.qos.lock:
+            self.global_limiter.active -= 1
+            self.user_limiter(user_id).active -= 1
+
+    def wait(self, user_id, n, interactive):
+        """Charge `n` bytes and return how many seconds to sleep before sending them"""
+        now = time.monotonic()
+        with self.qos.lock:
+            return max(self.global_limiter.consume(n, interactive, now),
+                       self.user_limiter(user_id).consume(n, interactive, now))
+
+    def stats(self):
+        now = time.monotonic()
+        with self.qos.lock:
+            users = {str(uid): {'rate': round(l.meter.rate(now)), 'limit': l.all.rate, 'active': l.active}
+                     for uid, l in self.users.items() if l.active or l.meter.rate(now) >= 1}
+            return {
+                'rate': round(self.global_limiter.meter.rate(now)),
+                'limit': self.global_limiter.all.rate,
+                'active': self.global_limiter.active,
+                'users': users,
+            }
+
+
+class ShapedIterator:
+    """Response body that is paced by a Shaper"""
+
+    def __init__(self, body, shaper, user_id, interactive):
+        self.body = body
+        self.shaper = shaper
+        self.user_id = user_id
+        self.interactive = interactive
+        shaper.start(user_id)
+        self._closed = False
+
+    def __iter__(self):
+        for data in self.body:
+            view = memoryview(data)
+            for i in range(0, len(view), SLICE_SIZE):
+                piece = view[i:i + SLICE_SIZE]
+                delay = self.shaper.wait(self.user_id, len(piece), self.interactive)
+                if delay:
+                    time.sleep(delay)
+                yield bytes(piece)
+        self._finish()
+
+    def _finish(self):
+        if not self._closed:
+            self._closed = True
+            self.shaper.finish(self.user_id)
+
+    def close(self):
+        self._finish()
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class ShapedReader:
+    """Request stream whose reads are paced by a Shaper.
+
+    Reading slower makes TCP push back on the client, so an upload is
+    throttled without buffering anything.
+    """
+
+    def __init__(self, stream, shaper, user_id):
+        self.stream = stream
+        self.shaper = shaper
+        self.user_id = user_id
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > SLICE_SIZE:
+            size = SLICE_SIZE
+        data = self.stream.read(size)
+        if data:
+            delay = self.shaper.wait(self.user_id, len(data), False)
+            if delay:
+                time.sleep(delay)
+        return data
+
+
+class QoS:
+    """Bandwidth scheduler for file transfers.
+
+    Settings start from the QOS_* config values and are overridden by what
+    admins saved in UPLOAD_FOLDER/.qos.json, together with per-user rates.
+    Other processes pick up a change when get_qos() sees the file replaced.
+
+    The buckets live in this process's memory, so every web server process
+    shapes only its own transfers. Each enforces 1/QOS_WORKER_PROCESSES of
+    the configured rates, which keeps the total within them; a user whose
+    transfers all land on one process gets that share rather than the
+    full rate. Set QOS_WORKER_PROCESSES to the server's worker count.
+    """
+
+    def __init__(self, config):
+        self.state_path = os.path.join(config['UPLOAD_FOLDER'], STATE_FILENAME)
+        self.burst_seconds = config['QOS_BURST_SECONDS']
+        self.processes = max(1, config['QOS_WORKER_PROCESSES'])
+        self.defaults = {key: config[key] for key in SETTINGS}
+        self.settings = dict(self.defaults)
+        self.user_rates = {}
+        self.lock = threading.Lock()
+        self._state_version = None
+        self._load()
+        self.shapers = {direction: Shaper(self, direction) for direction in DIRECTIONS}
+
+    def _stat_state(self):
+        """Identity of the saved state file; _save replaces it, so its inode changes"""
+        try:
+            stat = os.stat(self.state_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load(self):
+        self._state_version = self._stat_state()
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable QoS settings {self.state_path}: {str(e)}")
+            return
+        self.settings = dict(self.defaults)
+        self.settings.update({k: v for k, v in state.get('settings', {}).items() if k in SETTINGS})
+        self.user_rates = state.get('user_rates', {})
+
+    def _save(self):
+        tmp_path = f'{self.state_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'settings': self.settings, 'user_rates': self.user_rates}, f)
+        os.replace(tmp_path, self.state_path)
+        self._state_version = self._stat_state()
+
+    def refresh(self):
+        """Reload the settings if another process saved new ones"""
+        if self._stat_state() == self._state_version:
+            return
+        with self.lock:
+            self._load()
+            for shaper in self.shapers.values():
+                shaper.apply_settings()
+
+    def update(self, settings=None, user_rates=None):
+        """Change settings and per-user rates ({user_id: {'download': B/s, 'upload': B/s}}).
+
+        A per-user rate of None removes the override.
+        """
+        with self.lock:
+            # Start from what other processes saved, so their changes are kept
+            self._load()
+            for key, value in (settings or {}).items():
+                if key in SETTINGS:
+                    self.settings[key] = value
+            for user_id, rates in (user_rates or {}).items():
+                entry = self.user_rates.setdefault(str(user_id), {})
+                for direction, rate in rates.items():
+                    if direction not in DIRECTIONS:
+                        continue
+                    if rate is None:
+                        entry.pop(direction, None)
+                    else:
+                        entry[direction] = rate
+                if not entry:
+                    del self.user_rates[str(user_id)]
+            self._save()
+            for shaper in self.shapers.values():
+                shaper.apply_settings()
+
+    def process_share(self, rate):
+        """This process's part of a configured rate; 0 stays unlimited"""
+        return max(1, rate // self.processes) if rate else 0
+
+    @property
+    def enabled(self):
+        return bool(self.settings['QOS_ENABLED'])
+
+    def is_interactive(self, size, inline):
+        """Whether the current request is interactive rather than a bulk transfer.
+
+        Range requests of an inline view (a player seeking) and small range
+        requests of downloads are interactive; whole files and the large
+        segments of download managers are bulk.
+        """
+        ranges = resolve_ranges(request.headers.get('Range'), size)
+        if not ranges:
+            return False
+        if inline:
+            return True
+        return sum(stop - start for start, stop in ranges) <= self.settings['QOS_INTERACTIVE_MAX']
+
+    def download_shaper(self, user_id, size, inline=False, interactive=None):
+        """Callable wrapping a response body for send_ranged(), or None when QoS is off.
+
+        `interactive` overrides the guess from the Range header, e.g. for
+        HLS segments, which a player always fetches whole.
+        """
+        if not self.enabled:
+            return None
+        shaper = self.shapers['download']
+        if interactive is None:
+            interactive = self.is_interactive(size, inline)
+        return lambda body: ShapedIterator(body, shaper, user_id, interactive)
+
+    def accel_rate(self, user_id, size, inline=False):
+        """Per-connection limit for nginx (X-Accel-Limit-Rate), or None.
+
+        nginx only knows one connection at a time, so offloaded transfers
+        get the user's bulk rate capped at the global bulk rate; interactive
+        ones are not limited.
+        """
+        if not self.enabled or self.is_interactive(size, inline):
+            return None
+        shaper = self.shapers['download']
+        reserve = self.settings['QOS_INTERACTIVE_RESERVE']
+        rates = [rate * (1 - reserve) for rate in (shaper.global_rate(), shaper.user_rate(user_id)) if rate]
+        return int(min(rates)) if rates else None
+
+    def upload_stream(self, stream, user_id):
+        if not self.enabled:
+            return stream
+        return ShapedReader(stream, self.shapers['upload'], user_id)
+
+    def stats(self):
+        return {
+            'settings': dict(self.settings),
+            'user_rates': self.user_rates,
+            'processes': self.processes,
+            'download': self.shapers['download'].stats(),
+            'upload': self.shapers['upload'].stats(),
+        }
+
+
+_qos_lock = threading.Lock()
+
+
+def get_qos():
+    with _qos_lock:
+        qos = current_app.extensions.get('qos')
+        if qos is None:
+            qos = current_app.extensions['qos'] = QoS(current_app.config)
+    qos.refresh()
+    return qos
@@ -0,0 +1,149 @@
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, case, or_
+from app.models import db, User, StorageReservation
+from app.utils.upload_stream import UploadError
+from app.utils.volumes import get_pool
+
+logger = logging.getLogger(__name__)
+
+
+def declared_upload_size(req, allow_header=True):
+    """Size the client announced for the request body, before reading it.
+
+    Raw uploads may send X-File-Size when they stream with chunked
+    transfer encoding; otherwise Content-Length is required. Callers that
+    cannot hold the body to the announced size pass allow_header=False.
+    """
+    return parse_upload_size((req.headers.get('X-File-Size') if allow_header else None) or req.content_length)
+
+
+def parse_upload_size(declared):
+    """An announced upload size as an int; UploadError if it is missing or invalid"""
+    if declared is None or declared == '':
+        raise UploadError('Content-Length required', 411)
+    try:
+        declared = int(declared)
+    except (TypeError, ValueError):
+        raise UploadError('Invalid upload size', 400)
+    if declared < 0:
+        raise UploadError('Invalid upload size', 400)
+    return declared
+
+
+def reserve_storage(user, size, expires=True):
+    """Admit an upload of `size` bytes for `user` or raise UploadError.
+
+    Runs before any of the body is read. Streamed uploads get a
+    reservation that lapses after REQUEST_TIMEOUT; resumable uploads pass
+    expires=False and link it to their session, which releases it. Quota
+    is claimed with a single conditional UPDATE of user.storage_reserved,
+    so concurrent uploads (across workers too) cannot together exceed
+    storage_limit; the free disk check runs in the same transaction.
+    """
+    if size > current_app.config['MAX_CONTENT_LENGTH']:
+        raise UploadError('File too large', 413)
+
+    expire_reservations()
+
+    reserved = func.coalesce(User.storage_reserved, 0)
+    admitted = User.query.filter(
+        User.id == user.id,
+        or_(User.storage_limit.is_(None), User.storage_limit == 0,
+            func.coalesce(User.storage_used, 0) + reserved + size <= User.storage_limit)
+    ).update({User.storage_reserved: reserved + size}, synchronize_session=False)
+
+    if not admitted:
+        db.session.rollback()
+        raise UploadError('Storage limit exceeded', 400)
+
+    expires_at = None
+    if expires:
+        expires_at = datetime.utcnow() + timedelta(seconds=current_app.config['REQUEST_TIMEOUT'])
+    reservation = StorageReservation(user_id=user.id, size=size,
+                                     created_at=datetime.utcnow(), expires_at=expires_at)
+    db.session.add(reservation)
+    db.session.flush()
+
+    if not has_disk_space(size, exclude_id=reservation.id):
+        db.session.rollback()
+        raise UploadError('Not enough free disk space', 507)
+
+    db.session.commit()
+    return reservation
+
+
+def check_admission(user, size):
+    """Raise UploadError if reserve_storage(user, size) would refuse now.
+
+    Nothing is reserved, so this only lets a proxy turn an upload away
+    from its headers; the upload itself is still admitted by
+    reserve_storage().
+    """
+    if size > current_app.config['MAX_CONTENT_LENGTH']:
+        raise UploadError('File too large', 413)
+
+    expire_reservations()
+
+    in_use, limit = db.session.query(
+        func.coalesce(User.storage_used, 0) + func.coalesce(User.storage_reserved, 0), User.storage_limit
+    ).filter(User.id == user.id).one()
+    if limit and in_use + size > limit:
+        raise UploadError('Storage limit exceeded', 400)
+
+    if not has_disk_space(size):
+        raise UploadError('Not enough free disk space', 507)
+
+
+def has_disk_space(size, exclude_id=None):
+    """Whether `size` more bytes fit on the upload volume.
+
+    Streamed uploads that were admitted but have not finished writing are
+    counted against the free space; resumable uploads preallocate their
+    file up front and are already reflected in the free space. Uses the
+    storage pool's cached samples, minus DISK_FREE_MARGIN, of the volume
+    with the most room.
+    """
+    headroom = get_pool().max_headroom()
+    query = db.session.query(func.coalesce(func.sum(StorageReservation.size), 0)) \
+        .filter(StorageReservation.expires_at.isnot(None))
+    if exclude_id is not None:
+        query = query.filter(StorageReservation.id != exclude_id)
+    in_flight = query.scalar()
+    if headroom - in_flight - size < 0:
+        logger.warning(f"Refusing upload of {size} bytes: {headroom} free, {in_flight} in flight")
+        return False
+    return True
+
+
+def release_reservation(reservation):
+    """Give a reservation's bytes back. The caller commits."""
+    if reservation is None:
+        return
+    remaining = func.coalesce(User.storage_reserved, 0) - reservation.size
+    User.query.filter_by(id=reservation.user_id).update(
+        {User.storage_reserved: case((remaining < 0, 0), else_=remaining)},
+        synchronize_session=False
+    )
+    db.session.delete(reservation)
+
+
+def cancel_reservation(reservation):
+    """Release a reservation for an upload that failed, in its own transaction"""
+    try:
+        release_reservation(reservation)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Could not release reservation: {str(e)}")
+
+
+def expire_reservations():
+    """Release streamed-upload reservations whose request never finished"""
+    expired = StorageReservation.query.filter(StorageReservation.expires_at < datetime.utcnow()).all()
+    for reservation in expired:
+        logger.info(f"Releasing expired reservation of {reservation.size} bytes for user {reservation.user_id}")
+        release_reservation(reservation)
+    if expired:
+        db.session.commit()
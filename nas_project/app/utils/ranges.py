@@ -0,0 +1,261 @@
+import os
+import secrets
+import mimetypes
+import unicodedata
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import current_app, request
+from werkzeug.http import parse_if_range_header, is_resource_modified, quote_etag
+
+
+class RangeIterator:
+    """WSGI body for bytes [start, start + length) of an open file.
+
+    The range is read in large blocks; the file is closed when the server
+    closes the iterator, also when the client disconnects half way.
+    """
+
+    def __init__(self, file, start, length, block_size):
+        self.file = file
+        self.remaining = length
+        self.block_size = block_size
+        file.seek(start)
+
+    def __iter__(self):
+        while self.remaining > 0:
+            data = self.file.read(min(self.block_size, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+def range_body(environ, file, start, length, size, shaper=None):
+    """Body for one range: zero-copy where the server supports it.
+
+    When the source is a real file and the server offers wsgi.file_wrapper,
+    the file wrapper itself is the body, positioned at `start`; the server
+    recognises it and sends it with sendfile. Bounded ranges work the same
+    way, because PEP 3333 has the server stop at Content-Length (gunicorn
+    sends min(rest of file, Content-Length) bytes). A `shaper` (see
+    app.utils.qos) needs to see every block, so it rules that out.
+    """
+    block_size = current_app.config['CHUNK_SIZE']
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if shaper is None and file_wrapper is not None and _has_fileno(file):
+        file.seek(start)
+        return file_wrapper(file, block_size)
+    body = RangeIterator(file, start, length, block_size)
+    return shaper(body) if shaper is not None else body
+
+
+class MultipartRangeIterator:
+    """WSGI body of a multipart/byteranges response (RFC 7233 appendix A)"""
+
+    def __init__(self, file, parts, boundary, block_size):
+        self.file = file
+        self.parts = parts  # [(part header bytes, start, stop)]
+        self.boundary = boundary
+        self.block_size = block_size
+
+    @staticmethod
+    def part_header(boundary, mimetype, start, stop, size):
+        return (f'\r\n--{boundary}\r\n'
+                f'Content-Type: {mimetype}\r\n'
+                f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('latin-1')
+
+    @staticmethod
+    def trailer(boundary):
+        return f'\r\n--{boundary}--\r\n'.encode('latin-1')
+
+    def __iter__(self):
+        for header, start, stop in self.parts:
+            yield header
+            self.file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = self.file.read(min(self.block_size, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+        yield self.trailer(self.boundary)
+
+    def close(self):
+        self.file.close()
+
+
+def _has_fileno(file):
+    try:
+        file.fileno()
+        return True
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def guess_mimetype(mime_type, filename):
+    """Stored (sniffed) MIME type, else a guess from the name"""
+    return mime_type or mimetypes.guess_type(filename or '')[0] or 'application/octet-stream'
+
+
+def content_disposition(as_attachment, download_name):
+    """Content-Disposition value with an RFC 5987 filename* for non-ASCII names"""
+    value = 'attachment' if as_attachment else 'inline'
+    if not download_name:
+        return value
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return f"{value}; filename=\"{simple}\"; filename*=UTF-8''{quote(download_name, safe='')}"
+    escaped = download_name.replace('\\', '\\\\').replace('"', '\\"')
+    return f'{value}; filename="{escaped}"'
+
+
+def resolve_ranges(range_header, size):
+    """Byte ranges of a Range header as [(start, stop)], stop exclusive.
+
+    Returns None when the header is absent or malformed (the whole file is
+    sent, as RFC 7233 allows) and [] when no range is satisfiable. Suffix
+    (bytes=-N) and open-ended (bytes=N-) ranges are resolved against `size`
+    without any cap on their length. Unlike werkzeug's parser, overlapping
+    and out-of-order ranges are accepted and merged.
+    """
+    if not range_header:
+        return None
+    units, _, spec = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        first, dash, last = item.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first.isdigit() or last.isdigit()) \
+                or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            start, stop = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            stop = size if not last else min(int(last) + 1, size)
+            if last and int(last) < start:
+                return None
+        if start < stop:
+            ranges.append((start, stop))
+    return coalesce_ranges(ranges)
+
+
+def coalesce_ranges(ranges):
+    """Merge overlapping and adjacent ranges, in ascending order.
+
+    Sending a byte twice, or in parts that could have been one, only
+    costs bandwidth and seeks (RFC 7233 4.1).
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def if_range_allows(environ, etag, last_modified):
+    """RFC 7233 3.2: only honour Range if the client's copy is still current"""
+    header = environ.get('HTTP_IF_RANGE')
+    if not header:
+        return True
+    if_range = parse_if_range_header(header)
+    if if_range.etag is not None:
+        return etag is not None and if_range.etag == etag
+    if if_range.date is not None and last_modified is not None:
+        return int(if_range.date.timestamp()) == int(last_modified.timestamp())
+    return False
+
+
+def send_ranged(source, size, mimetype, etag=None, last_modified=None,
+                as_attachment=False, download_name=None, shaper=None):
+    """Serve a file with conditional GET and byte-range support.
+
+    `source` is a path or a seekable binary file object. Answers 304 for
+    a matching If-None-Match/If-Modified-Since, 206 for satisfiable ranges
+    (as multipart/byteranges when there are several), 416 when none is,
+    and 200 with the whole body otherwise. Requests with more than
+    MAX_BYTE_RANGES ranges get the whole body instead of a 206. `shaper`
+    wraps the body iterable, e.g. to throttle it.
+    """
+    environ = request.environ
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+
+    rv = current_app.response_class(mimetype=mimetype, direct_passthrough=True)
+    rv.headers['Accept-Ranges'] = 'bytes'
+    rv.headers['Content-Disposition'] = content_disposition(as_attachment, download_name)
+    rv.cache_control.no_cache = True
+    if etag:
+        rv.headers['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        rv.last_modified = last_modified
+
+    if not is_resource_modified(environ, etag=etag, last_modified=last_modified):
+        rv.status_code = 304
+        return rv
+
+    ranges = None
+    if if_range_allows(environ, etag, last_modified):
+        ranges = resolve_ranges(environ.get('HTTP_RANGE'), size)
+
+    if ranges == []:
+        rv.status_code = 416
+        rv.headers['Content-Range'] = f'bytes */{size}'
+        rv.content_length = 0
+        return rv
+
+    if ranges is not None and len(ranges) > current_app.config['MAX_BYTE_RANGES']:
+        ranges = None
+
+    file = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    if ranges is not None and len(ranges) > 1:
+        return _multipart_response(rv, file, ranges, size, mimetype, shaper)
+
+    if ranges is not None:
+        start, stop = ranges[0]
+        rv.status_code = 206
+        rv.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    else:
+        start, stop = 0, size
+
+    rv.response = range_body(environ, file, start, stop - start, size, shaper)
+    rv.content_length = stop - start
+    return rv
+
+
+def _multipart_response(rv, file, ranges, size, mimetype, shaper=None):
+    boundary = secrets.token_hex(16)
+    parts = [(MultipartRangeIterator.part_header(boundary, mimetype, start, stop, size), start, stop)
+             for start, stop in ranges]
+    rv.status_code = 206
+    rv.content_type = f'multipart/byteranges; boundary={boundary}'
+    rv.response = MultipartRangeIterator(file, parts, boundary, current_app.config['CHUNK_SIZE'])
+    if shaper is not None:
+        rv.response = shaper(rv.response)
+    rv.content_length = sum(len(header) + stop - start for header, start, stop in parts) \
+        + len(MultipartRangeIterator.trailer(boundary))
+    return rv
+
+
+def send_stored_path(path, mimetype, etag=None, as_attachment=False, download_name=None, shaper=None):
+    """send_ranged() for a file on disk; ETag defaults to mtime and size"""
+    stat = os.stat(path)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    if etag is None:
+        etag = f'{int(stat.st_mtime)}-{stat.st_size}'
+    return send_ranged(path, stat.st_size, mimetype, etag=etag, last_modified=last_modified,
+                       as_attachment=as_attachment, download_name=download_name, shaper=shaper)
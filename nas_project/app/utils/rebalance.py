@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from app.models import db, File
+from app.utils.storage import new_storage_path, thumbnail_path, sprite_paths
+from app.utils.volumes import get_pool, remove_paths
+
+logger = logging.getLogger(__name__)
+
+PENDING_FILENAME = '.rebalance_pending.json'
+
+# Read size for throttled copies
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class Rebalancer:
+    """Moves files from the fullest volume of the pool to the emptiest.
+
+    Copies are throttled to REBALANCE_BANDWIDTH. A file's row is switched
+    to the new copy with a conditional UPDATE, and the old copy is only
+    removed REBALANCE_GRACE seconds later, so downloads that are already
+    running (or just looked up the old path) are never cut off.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['REBALANCE_INTERVAL']
+        self.threshold = app.config['REBALANCE_THRESHOLD']
+        self.bandwidth = app.config['REBALANCE_BANDWIDTH']
+        self.batch_bytes = app.config['REBALANCE_BATCH_BYTES']
+        self.grace = app.config['REBALANCE_GRACE']
+        self.pending_path = os.path.join(app.config['UPLOAD_FOLDER'], PENDING_FILENAME)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Old copies waiting for their grace period, kept on disk so a restart
+    # does not leave them behind
+    def _load_pending(self):
+        try:
+            with open(self.pending_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _save_pending(self, pending):
+        tmp_path = f'{self.pending_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(pending, f)
+        os.replace(tmp_path, self.pending_path)
+
+    def remove_expired_copies(self):
+        pending = self._load_pending()
+        now = time.time()
+        due = [path for path, remove_at in pending if remove_at <= now]
+        if due:
+            remove_paths(due)
+            self._save_pending([entry for entry in pending if entry[1] > now])
+
+    def _copy(self, source, target):
+        """Copy at no more than `bandwidth` bytes per second, then fsync"""
+        started = time.monotonic()
+        copied = 0
+        with open(source, 'rb') as src, open(target, 'xb') as dst:
+            while not self._stop.is_set():
+                data = src.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+                copied += len(data)
+                if self.bandwidth:
+                    ahead = copied / self.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            dst.flush()
+            os.fsync(dst.fileno())
+        shutil.copystat(source, target)
+        return copied
+
+    def move_file(self, file_id, path, user_id, filename, size, target):
+        """Copy one file to volume `target` and point its row at the copy"""
+        new_path = new_storage_path(user_id, filename or path, size, prefer=target.name)
+        if not new_path.startswith(target.path + os.sep):
+            # The target filled up since it was sampled
+            return False
+        try:
+            copied = self._copy(path, new_path)
+            if copied != os.path.getsize(path):
+                raise IOError(f'Copy of {path} is incomplete')
+            if os.path.exists(thumbnail_path(path)):
+                shutil.copy2(thumbnail_path(path), thumbnail_path(new_path))
+        except Exception:
+            remove_paths([new_path, thumbnail_path(new_path)])
+            raise
+
+        moved = File.query.filter_by(id=file_id, path=path).update(
+            {File.path: new_path, File.volume: target.name}, synchronize_session=False)
+        db.session.commit()
+        if not moved:
+            # Deleted or changed while it was being copied
+            remove_paths([new_path, thumbnail_path(new_path)])
+            return False
+
+        remove_at = time.time() + self.grace
+        pending = self._load_pending()
+        pending.extend([[path, remove_at], [thumbnail_path(path), remove_at]])
+        # Scrub sprites are cheap to redo and are regenerated at the new path
+        pending.extend([sprite, remove_at] for sprite in sprite_paths(path))
+        self._save_pending(pending)
+        logger.info(f"Rebalanced file {file_id} ({size} bytes) to volume {target.name}")
+        return True
+
+    def run_pass(self):
+        """Move files until the pool is balanced or REBALANCE_BATCH_BYTES were moved"""
+        with self.app.app_context():
+            self.remove_expired_copies()
+            pool = get_pool()
+            moved = 0
+            skipped = set()
+            while moved < self.batch_bytes and not self._stop.is_set():
+                pool.refresh(force=True)
+                online = [v for v in pool.volumes if v.online]
+                if len(online) < 2:
+                    break
+                source = max(online, key=lambda v: v.fill())
+                target = min(online, key=lambda v: v.fill())
+                if source.fill() - target.fill() <= self.threshold:
+                    break
+
+                limit = min(target.headroom(pool.margin), self.batch_bytes - moved)
+                row = db.session.query(File.id, File.path, File.user_id, File.filename, File.file_size) \
+                    .filter(File.volume == source.name, File.blob_sha256.is_(None),
+                            File.is_chunked.isnot(True), File.file_size <= limit,
+                            File.id.notin_(skipped)) \
+                    .order_by(File.file_size.desc()).first()
+                if row is None:
+                    break
+                file_id, path, user_id, filename, size = row
+                try:
+                    if self.move_file(file_id, path, user_id, filename, size or 0, target):
+                        moved += size or 0
+                    else:
+                        skipped.add(file_id)
+                except Exception as e:
+                    db.session.rollback()
+                    skipped.add(file_id)
+                    logger.error(f"Could not rebalance file {file_id}: {str(e)}")
+            db.session.remove()
+            return moved
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_pass()
+            except Exception as e:
+                logger.error(f"Rebalancer pass failed: {str(e)}")
+
+    def start(self):
+        """Run passes every `interval` seconds in a daemon thread, if the pool has several volumes"""
+        if self.interval <= 0 or not self.app.config['STORAGE_VOLUMES'] or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='storage-rebalancer', daemon=True)
+        self._thread.start()
+        logger.info(f"Storage rebalancer started: every {self.interval}s at {self.bandwidth} B/s")
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,158 @@
+import os
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import func, select
+from app.models import db, User, File, StorageReservation
+from app.utils import blob_store, chunk_store
+
+logger = logging.getLogger(__name__)
+
+# Most recent report per user id, shown on the admin reconcile endpoint
+last_reports = {}
+
+
+def scan_disk_usage(user_id, page_size):
+    """Stat a user's files page by page (keyset pagination on File.id).
+
+    Returns (bytes on disk, missing file ids, ids whose size differs from
+    File.file_size). Only `page_size` rows are loaded at a time.
+    """
+    disk_used = 0
+    missing = []
+    mismatched = []
+    last_id = 0
+    while True:
+        rows = db.session.query(File.id, File.path, File.file_size, File.is_chunked) \
+            .filter(File.user_id == user_id, File.id > last_id) \
+            .order_by(File.id).limit(page_size).all()
+        if not rows:
+            break
+        for file_id, path, file_size, is_chunked in rows:
+            if is_chunked:
+                # Spread over shared chunk packs; counted at its logical size
+                disk_used += file_size or 0
+                continue
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                missing.append(file_id)
+                continue
+            disk_used += size
+            if size != (file_size or 0):
+                mismatched.append(file_id)
+        last_id = rows[-1][0]
+    return disk_used, missing, mismatched
+
+
+def reconcile_user(user_id, page_size=500, fix=True, check_disk=True):
+    """Recompute one user's storage_used/storage_reserved and report drift.
+
+    The corrected values are written with a single UPDATE whose value is a
+    subquery over file/storage_reservation, so uploads committed while the
+    reconciler runs are never lost.
+    """
+    before = db.session.query(User.storage_used, User.storage_reserved).filter_by(id=user_id).first()
+    if before is None:
+        return None
+
+    files_sum = select(func.coalesce(func.sum(File.file_size), 0)) \
+        .where(File.user_id == user_id).scalar_subquery()
+    reserved_sum = select(func.coalesce(func.sum(StorageReservation.size), 0)) \
+        .where(StorageReservation.user_id == user_id).scalar_subquery()
+
+    db_used = db.session.query(files_sum).scalar()
+    db_reserved = db.session.query(reserved_sum).scalar()
+
+    report = {
+        'user_id': user_id,
+        'checked_at': datetime.utcnow().isoformat(),
+        'storage_used': before.storage_used or 0,
+        'files_total': db_used,
+        'used_drift': (before.storage_used or 0) - db_used,
+        'storage_reserved': before.storage_reserved or 0,
+        'reserved_drift': (before.storage_reserved or 0) - db_reserved,
+    }
+
+    if check_disk:
+        disk_used, missing, mismatched = scan_disk_usage(user_id, page_size)
+        report.update({
+            'disk_total': disk_used,
+            'disk_drift': db_used - disk_used,
+            'missing_files': missing,
+            'size_mismatches': mismatched,
+        })
+
+    if fix and (report['used_drift'] or report['reserved_drift']):
+        User.query.filter_by(id=user_id).update(
+            {User.storage_used: files_sum, User.storage_reserved: reserved_sum},
+            synchronize_session=False
+        )
+        db.session.commit()
+    else:
+        db.session.rollback()
+
+    drifted = report['used_drift'] or report['reserved_drift'] \
+        or report.get('missing_files') or report.get('size_mismatches')
+    if drifted:
+        logger.warning(f"Storage drift for user {user_id}: {report}")
+    last_reports[user_id] = report
+    return report
+
+
+class StorageReconciler:
+    """Walks all users a few at a time, so no single pass scans everything.
+
+    Each call to run_batch() reconciles the next `batch_size` users after
+    the last one it saw and wraps around at the end.
+    """
+
+    def __init__(self, app, batch_size=None, interval=None):
+        self.app = app
+        self.batch_size = batch_size or app.config['STORAGE_RECONCILE_BATCH']
+        self.interval = interval if interval is not None else app.config['STORAGE_RECONCILE_INTERVAL']
+        self.page_size = app.config['STORAGE_RECONCILE_FILE_PAGE']
+        self.cursor = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_batch(self):
+        with self.app.app_context():
+            for store in (blob_store, chunk_store):
+                try:
+                    store.collect_garbage()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"{store.__name__} garbage collection failed: {str(e)}")
+
+            user_ids = [row[0] for row in db.session.query(User.id)
+                        .filter(User.id > self.cursor).order_by(User.id)
+                        .limit(self.batch_size).all()]
+            if not user_ids:
+                self.cursor = 0
+                return []
+            reports = []
+            for user_id in user_ids:
+                try:
+                    reports.append(reconcile_user(user_id, page_size=self.page_size))
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Reconciling storage for user {user_id} failed: {str(e)}")
+            self.cursor = user_ids[-1]
+            db.session.remove()
+            return reports
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_batch()
+
+    def start(self):
+        """Run batches every `interval` seconds in a daemon thread"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='storage-reconciler', daemon=True)
+        self._thread.start()
+        logger.info(f"Storage reconciler started: {self.batch_size} users every {self.interval}s")
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,260 @@
+import re
+import logging
+from difflib import SequenceMatcher
+from markupsafe import escape, Markup
+from flask import current_app
+from sqlalchemy import text
+from app.models import db, File
+from app.utils.text_extract import EXTRACTOR_VERSION, get_text_cache, is_candidate as has_text
+from app.utils.storage import content_version
+
+logger = logging.getLogger(__name__)
+
+# One row per File, rowid = file.id. `owner` holds a single token naming
+# the user, so a search is scoped by the index rather than by filtering
+# every match; `version` records what the content was extracted from.
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5(
+    name, tags, content, owner, version UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+# Trigrams of file names, for substring and misspelled-name lookups. The
+# owner is '#<user id>#': as a phrase it only matches itself, never a
+# longer id containing it.
+NAME_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS file_name_search USING fts5(
+    name, owner,
+    tokenize = 'trigram'
+)
+"""
+
+# Candidates fetched for a fuzzy name lookup, and the similarity they need
+FUZZY_CANDIDATES = 200
+FUZZY_MIN_SIMILARITY = 0.5
+
+# bm25() weights, in column order: a hit in the name counts most
+RANK_WEIGHTS = '10.0, 5.0, 1.0, 0.0, 0.0'
+
+# snippet()/highlight() markers; made into <mark> after escaping the text
+MARK_START, MARK_END = '\x02', '\x03'
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def ensure_search_index():
+    """Create the FTS5 tables; called at startup next to db.create_all()"""
+    with db.engine.begin() as conn:
+        conn.execute(text(SCHEMA))
+        conn.execute(text(NAME_SCHEMA))
+
+
+def owner_token(user_id):
+    return f'u{user_id}'
+
+
+def name_owner(user_id):
+    return f'#{user_id}#'
+
+
+def text_version(file):
+    return f'{content_version(file)}.v{EXTRACTOR_VERSION}'
+
+
+def tag_text(file):
+    return ' '.join(tag.name for tag in file.tags)
+
+
+def read_content(file):
+    """Leading SEARCH_MAX_CONTENT_CHARS of a File's text, from the text cache"""
+    with get_text_cache().open(file) as f:
+        return f.read(current_app.config['SEARCH_MAX_CONTENT_CHARS'])
+
+
+def index_file(file, with_content=True):
+    """Add or replace the index row of a File.
+
+    Without content only the name and tags are indexed, which is cheap
+    enough for a request; the content is filled in by a 'search_index' job.
+    Text already indexed from the same version is kept either way.
+    """
+    content, version = '', ''
+    row = db.session.execute(text('SELECT content, version FROM file_search WHERE rowid = :id'),
+                             {'id': file.id}).first()
+    try:
+        wanted = text_version(file) if has_text(file) else ''
+    except OSError:
+        wanted = ''
+    if row is not None and row.version and row.version == wanted:
+        content, version = row.content, row.version
+    elif with_content and wanted:
+        try:
+            content, version = read_content(file), wanted
+        except Exception as e:
+            # Indexed by name and tags only; a later backfill tries again
+            logger.error(f"Could not extract text of file {file.id} for search: {str(e)}")
+
+    db.session.execute(text('DELETE FROM file_search WHERE rowid = :id'), {'id': file.id})
+    db.session.execute(text(
+        'INSERT INTO file_search (rowid, name, tags, content, owner, version) '
+        'VALUES (:id, :name, :tags, :content, :owner, :version)'
+    ), {'id': file.id, 'name': file.original_filename, 'tags': tag_text(file), 'content': content,
+        'owner': owner_token(file.user_id), 'version': version})
+    db.session.execute(text('DELETE FROM file_name_search WHERE rowid = :id'), {'id': file.id})
+    db.session.execute(text('INSERT INTO file_name_search (rowid, name, owner) VALUES (:id, :name, :owner)'),
+                       {'id': file.id, 'name': file.original_filename, 'owner': name_owner(file.user_id)})
+    db.session.commit()
+
+
+def update_tags(files):
+    """Reindex the tags of Files after they were retagged; the caller has committed"""
+    for file in files:
+        updated = db.session.execute(text('UPDATE file_search SET tags = :tags WHERE rowid = :id'),
+                                     {'id': file.id, 'tags': tag_text(file)}).rowcount
+        if not updated:
+            index_file(file, with_content=False)
+    db.session.commit()
+
+
+def remove_file(file_id):
+    db.session.execute(text('DELETE FROM file_search WHERE rowid = :id'), {'id': file_id})
+    db.session.execute(text('DELETE FROM file_name_search WHERE rowid = :id'), {'id': file_id})
+    db.session.commit()
+
+
+def needs_content(file):
+    """Whether a File's index row lacks text that could be extracted"""
+    if not has_text(file):
+        return False
+    row = db.session.execute(text('SELECT version FROM file_search WHERE rowid = :id'),
+                             {'id': file.id}).first()
+    try:
+        return row is None or row.version != text_version(file)
+    except OSError:
+        return False
+
+
+def unindexed_file_ids(user_id=None):
+    """Ids of Files missing from either index; drops rows of Files that are gone"""
+    db.session.execute(text('DELETE FROM file_search WHERE rowid NOT IN (SELECT id FROM file)'))
+    db.session.execute(text('DELETE FROM file_name_search WHERE rowid NOT IN (SELECT id FROM file)'))
+    db.session.commit()
+    query = ('SELECT id FROM file WHERE (id NOT IN (SELECT rowid FROM file_search) '
+             'OR id NOT IN (SELECT rowid FROM file_name_search))')
+    params = {}
+    if user_id is not None:
+        query += ' AND user_id = :user_id'
+        params['user_id'] = user_id
+    return [row.id for row in db.session.execute(text(query), params)]
+
+
+def build_query(user_id, terms):
+    """FTS5 query for the words of `terms`, or None if there are none.
+
+    Every word must match, the last as a prefix so results show up while
+    typing. Words are quoted, so user input cannot inject query syntax.
+    """
+    words = WORD.findall(terms)
+    if not words:
+        return None
+    quoted = [f'"{word}"' for word in words]
+    quoted[-1] += '*'
+    return f'owner : "{owner_token(user_id)}" AND {{name tags content}} : ({" ".join(quoted)})'
+
+
+def marked(fragment):
+    """snippet()/highlight() output as HTML, with the matches in <mark>"""
+    html = str(escape(fragment or ''))
+    return Markup(html.replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def search(user_id, terms, limit=None):
+    """The user's Files best matching `terms`, as (File, name_html, snippet_html, rank)"""
+    query = build_query(user_id, terms)
+    if query is None:
+        return []
+    limit = limit or current_app.config['SEARCH_RESULTS_LIMIT']
+    rows = db.session.execute(text(
+        f"SELECT rowid AS id, bm25(file_search, {RANK_WEIGHTS}) AS rank, "
+        f"highlight(file_search, 0, :start, :end) AS name, "
+        f"snippet(file_search, 2, :start, :end, '…', 16) AS snippet "
+        f"FROM file_search WHERE file_search MATCH :query ORDER BY rank LIMIT :limit"
+    ), {'query': query, 'start': MARK_START, 'end': MARK_END, 'limit': limit}).all()
+    if not rows:
+        return []
+    files = {file.id: file for file in File.query.filter(File.id.in_([row.id for row in rows]),
+                                                          File.user_id == user_id)}
+    return [(files[row.id], marked(row.name), marked(row.snippet), row.rank)
+            for row in rows if row.id in files]
+
+
+def phrase(value):
+    """`value` as an FTS5 string, matched literally"""
+    return '"' + value.replace('"', '""') + '"'
+
+
+def trigrams(value):
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def similarity(terms, name):
+    """How alike a typed name and a file name are, from 0 to 1.
+
+    The best-matching stretch of the name counts, so a short query is not
+    penalised for the rest of a long name.
+    """
+    terms, name = terms.lower(), name.lower()
+    matcher = SequenceMatcher(None, terms, name, autojunk=False)
+    block = max(matcher.get_matching_blocks(), key=lambda b: b.size)
+    start = max(0, block.b - block.a)
+    return SequenceMatcher(None, terms, name[start:start + len(terms)], autojunk=False).ratio()
+
+
+def suggest_names(user_id, terms, limit=10):
+    """The user's Files whose names contain `terms`, or failing that look
+    like it, as (File, name_html) for search-as-you-type. Exact matches
+    come newest first, which the index returns without sorting.
+
+    Substrings of three or more characters are found through the trigram
+    index. Shorter input is matched as a word prefix in the full-text
+    index, and misspellings by ranking files sharing trigrams with it.
+    """
+    terms = terms.strip()
+    if not terms:
+        return []
+    params = {'start': MARK_START, 'end': MARK_END, 'limit': limit}
+    if len(terms) < 3:
+        words = WORD.findall(terms)
+        if not words:
+            return []
+        params['query'] = f'owner : "{owner_token(user_id)}" AND name : {phrase(words[0])}*'
+        rows = db.session.execute(text(
+            'SELECT rowid AS id, highlight(file_search, 0, :start, :end) AS name FROM file_search '
+            'WHERE file_search MATCH :query ORDER BY rowid DESC LIMIT :limit'), params).all()
+    else:
+        params['query'] = f'owner : {phrase(name_owner(user_id))} AND name : {phrase(terms)}'
+        rows = db.session.execute(text(
+            'SELECT rowid AS id, highlight(file_name_search, 0, :start, :end) AS name FROM file_name_search '
+            'WHERE file_name_search MATCH :query ORDER BY rowid DESC LIMIT :limit'), params).all()
+        if not rows:
+            rows = fuzzy_names(user_id, terms, limit)
+
+    files = {file.id: file for file in File.query.filter(File.id.in_([row.id for row in rows]),
+                                                          File.user_id == user_id)}
+    return [(files[row.id], marked(row.name)) for row in rows if row.id in files]
+
+
+def fuzzy_names(user_id, terms, limit):
+    """Rows (id, name) of names most like `terms`, for when none contain it"""
+    grams = trigrams(terms)
+    any_gram = ' OR '.join(phrase(gram) for gram in sorted(grams))
+    candidates = db.session.execute(text(
+        'SELECT rowid AS id, name FROM file_name_search WHERE file_name_search MATCH :query '
+        'ORDER BY rank LIMIT :candidates'
+    ), {'query': f'owner : {phrase(name_owner(user_id))} AND name : ({any_gram})',
+        'candidates': FUZZY_CANDIDATES}).all()
+    scored = sorted(((similarity(terms, row.name), row) for row in candidates), key=lambda pair: -pair[0])
+    return [row for score, row in scored if score >= FUZZY_MIN_SIMILARITY][:limit]
@@ -91,11 +91,11 @@ class SecurityUtils:
             return None
 
     @staticmethod
-    def hash_file(file_path: str) -> str:
+    def hash_file(file_path: str, block_size: int = 1024 * 1024) -> str:
         """Generate SHA-256 hash of file"""
         sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
+            for byte_block in iter(lambda: f.read(block_size), b""):
                 sha256_hash.update(byte_block)
         return sha256_hash.hexdigest()
 
@@ -0,0 +1,168 @@
+import os
+import math
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+import ffmpeg
+from PIL import Image
+from flask import current_app
+from app.models import db, File
+from app.utils.hls import is_video
+from app.utils.media_info import get_media_info
+from app.utils.background import enqueue, PRIORITY_INTERACTIVE
+from app.utils.storage import sprite_index_path, sprite_sheet_path, sprite_paths
+
+logger = logging.getLogger(__name__)
+
+SPRITE_MIMETYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+_running = set()  # File ids whose sprites are being generated
+_running_lock = threading.Lock()
+
+
+def is_candidate(file, info=None):
+    """Whether a File gets scrub sprites; `info` is its MediaInfo when known"""
+    if not current_app.config['SPRITE_ENABLED'] or file.is_chunked or not is_video(file):
+        return False
+    if info is None:
+        return True
+    return (info.duration or 0) >= current_app.config['SPRITE_MIN_DURATION']
+
+
+def is_current(file):
+    """True when the sprites on disk were made from the file's current bytes"""
+    index = sprite_index_path(file.path)
+    try:
+        return os.path.getmtime(index) >= os.path.getmtime(file.path)
+    except OSError:
+        return False
+
+
+def frame_interval(duration):
+    config = current_app.config
+    return max(config['SPRITE_INTERVAL'], duration / config['SPRITE_MAX_FRAMES'])
+
+
+def vtt_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:06.3f}'
+
+
+def build_index(frames, interval, duration, tile_width, tile_height, columns, per_sheet, ext, version):
+    """WebVTT cues pointing each interval at its region of a sprite sheet.
+
+    Sheet URLs are relative to the index and carry `version`, so browsers
+    can cache sheets for long and still see regenerated ones.
+    """
+    lines = ['WEBVTT', '']
+    for frame in range(frames):
+        start = frame * interval
+        end = min(start + interval, duration)
+        sheet, position = divmod(frame, per_sheet)
+        row, column = divmod(position, columns)
+        lines.append(f'{vtt_timestamp(start)} --> {vtt_timestamp(end)}')
+        lines.append(f'{sheet}.{ext}?v={version}#xywh={column * tile_width},{row * tile_height},'
+                     f'{tile_width},{tile_height}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def extract_sheets(source, target_dir, interval, ext):
+    """Decode the video once, sampling a frame every `interval` seconds and
+    tiling them into numbered sheets in `target_dir`.
+
+    Only keyframes are decoded, which is far cheaper than a full decode and
+    close enough for a preview.
+    """
+    config = current_app.config
+    quality = {'q:v': 5} if ext == 'jpg' else {'quality': 70}
+    process = (
+        ffmpeg
+        .input(source, skip_frame='nokey')
+        .video
+        .filter('fps', fps=f'1/{interval}')
+        .filter('scale', config['SPRITE_WIDTH'], -2)
+        .filter('tile', f"{config['SPRITE_COLUMNS']}x{config['SPRITE_ROWS']}")
+        .output(os.path.join(target_dir, f'%d.{ext}'), start_number=0, vsync='vfr', **quality)
+        .overwrite_output()
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    try:
+        _, stderr = process.communicate(timeout=config['SPRITE_TIMEOUT'])
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise RuntimeError(f"ffmpeg took longer than {config['SPRITE_TIMEOUT']}s")
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', 'replace')[-500:])
+    return sorted((name for name in os.listdir(target_dir) if name.endswith(f'.{ext}')),
+                  key=lambda name: int(name.split('.')[0]))
+
+
+def generate_sprites(file_id):
+    """Background job: (re)build the scrub sprites of one video.
+
+    Sheets are made in a scratch directory beside the video and moved into
+    place; the index is written last, so a complete index always refers
+    to complete sheets. Returns True when new sprites were written.
+    """
+    with _running_lock:
+        if file_id in _running:
+            return False
+        _running.add(file_id)
+    try:
+        file = db.session.get(File, file_id)
+        if file is None or not is_candidate(file) or not os.path.exists(file.path) or is_current(file):
+            return False
+        info = get_media_info(file)
+        if info is None or info.error or not is_candidate(file, info):
+            return False
+        return _generate(file, info.duration)
+    finally:
+        with _running_lock:
+            _running.discard(file_id)
+
+
+def _generate(file, duration):
+    config = current_app.config
+    ext = config['SPRITE_FORMAT']
+    columns, per_sheet = config['SPRITE_COLUMNS'], config['SPRITE_COLUMNS'] * config['SPRITE_ROWS']
+    interval = frame_interval(duration)
+    version = int(os.path.getmtime(file.path))
+
+    scratch = tempfile.mkdtemp(prefix='.sprites-', dir=os.path.dirname(file.path))
+    try:
+        sheets = extract_sheets(file.path, scratch, interval, ext)
+        if not sheets:
+            logger.warning(f"ffmpeg produced no sprite sheets for file {file.id}")
+            return False
+        # The tile filter pads every sheet to the full grid
+        with Image.open(os.path.join(scratch, sheets[0])) as first:
+            tile_width = first.width // columns
+            tile_height = first.height // config['SPRITE_ROWS']
+        frames = min(math.ceil(duration / interval), len(sheets) * per_sheet)
+
+        for path in sprite_paths(file.path):
+            os.remove(path)
+        for sheet, name in enumerate(sheets):
+            os.replace(os.path.join(scratch, name), sprite_sheet_path(file.path, sheet, ext))
+        index = build_index(frames, interval, duration, tile_width, tile_height, columns, per_sheet, ext, version)
+        index_tmp = os.path.join(scratch, 'index.vtt')
+        with open(index_tmp, 'w', encoding='utf-8') as f:
+            f.write(index)
+        os.replace(index_tmp, sprite_index_path(file.path))
+    except (RuntimeError, OSError) as e:
+        logger.error(f"Sprite generation for file {file.id} failed: {str(e)}")
+        return False
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    logger.info(f"Generated {len(sheets)} sprite sheets ({frames} frames) for file {file.id}")
+    return True
+
+
+def queue_sprites(file_id):
+    """Generate a video's sprites ahead of other background work; a player is waiting"""
+    enqueue('sprites', file_id, priority=PRIORITY_INTERACTIVE)
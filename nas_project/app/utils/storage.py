@@ -0,0 +1,206 @@
+import os
+import glob
+import uuid
+import hashlib
+import mimetypes
+from datetime import datetime
+from flask import current_app
+from werkzeug.utils import secure_filename
+from sqlalchemy import func, case
+from app.models import db, File, ActivityLog, Tag, User
+from app.utils import blob_store, chunk_store
+from app.utils.volumes import get_pool, move
+
+
+def get_upload_tmp_dir():
+    """Scratch space for in-flight uploads.
+
+    Lives under UPLOAD_FOLDER so finished uploads can be moved into place
+    with a rename instead of a copy.
+    """
+    tmp_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tmp_dir
+
+
+def new_storage_path(user_id, filename, size=0, prefer=None):
+    """Fresh path for a file body: <volume>/<user_id>/ab/cd/<token><ext>.
+
+    The volume is picked by the storage pool (see volumes.VolumePool.choose).
+    The token is random, so a name never has to be probed for collisions
+    and no directory grows beyond a few entries; the display name lives
+    only in the database. The extension is kept for tools that look at it.
+    """
+    volume = get_pool().choose(size, prefer)
+    token = uuid.uuid4().hex
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    shard_dir = os.path.join(volume.path, str(user_id), token[:2], token[2:4])
+    os.makedirs(shard_dir, exist_ok=True)
+    return os.path.join(shard_dir, token + extension)
+
+
+def thumbnail_path(file_path):
+    """Where file_handlers.create_thumbnail puts a file's thumbnail"""
+    return f"{os.path.splitext(file_path)[0]}_thumb.jpg"
+
+
+def content_version(file):
+    """Short token that changes whenever a File's bytes do, for naming caches"""
+    if file.sha256:
+        return file.sha256[:16]
+    stat = os.stat(file.path)
+    return hashlib.sha1(f'{stat.st_size}-{stat.st_mtime_ns}'.encode()).hexdigest()[:16]
+
+
+def sprite_sheet_path(file_path, sheet, ext):
+    """Where utils.sprites puts scrub sprite sheet number `sheet` of a video"""
+    return f"{os.path.splitext(file_path)[0]}_sprite_{sheet}.{ext}"
+
+
+def sprite_index_path(file_path):
+    """WebVTT index mapping video times to regions of the sprite sheets"""
+    return f"{os.path.splitext(file_path)[0]}_sprites.vtt"
+
+
+def sprite_paths(file_path):
+    """Every scrub sprite file of a video that exists on disk"""
+    sheets = glob.glob(glob.escape(os.path.splitext(file_path)[0]) + '_sprite_*')
+    return [path for path in sheets + [sprite_index_path(file_path)] if os.path.exists(path)]
+
+
+def is_sharded(file_path, user_id):
+    """Whether `file_path` already follows the <user_id>/ab/cd/<token> layout"""
+    pool = get_pool()
+    user_dir = os.path.join(pool.get(pool.volume_for_path(file_path)).path, str(user_id))
+    parts = os.path.relpath(file_path, user_dir).split(os.sep)
+    return len(parts) == 3 and len(parts[0]) == 2 and len(parts[1]) == 2
+
+
+def create_file_record(user, file_path, original_filename, file_size, category=None,
+                       tag_ids=None, ip_address=None, sha256=None, mime_type=None):
+    """Register a file that is already in its final location.
+
+    Adds the File row, the selected tags (plus FOLDER for archives), an
+    ActivityLog entry and the storage accounting in one transaction.
+    With STORAGE_DEDUP the body is moved into the blob store (or dropped
+    if identical content is already there) and the File points at the
+    blob. Files large enough for STORAGE_CHUNK_DEDUP stay plain files
+    here; the job queue splits them into the chunk store afterwards (see
+    chunk_store.chunk_file). The caller commits.
+    """
+    final_filename = secure_filename(original_filename) or 'upload'
+
+    blob_sha256 = None
+    if sha256 and blob_store.dedup_enabled() and not chunk_store.should_chunk(file_size):
+        file_path = blob_store.ingest(file_path, sha256, file_size)
+        blob_sha256 = sha256
+    volume = get_pool().volume_for_path(file_path)
+
+    if not mime_type:
+        mime_type = mimetypes.guess_type(original_filename)[0]
+
+    file_type = category
+    if not file_type:
+        file_type = mime_type.split('/')[0] if mime_type else 'other'
+
+    new_file = File(
+        filename=final_filename,
+        original_filename=original_filename,
+        file_type=file_type,
+        file_size=file_size,
+        category=category or 'other',
+        path=file_path,
+        sha256=sha256,
+        blob_sha256=blob_sha256,
+        volume=volume,
+        mime_type=mime_type,
+        user_id=user.id,
+        uploaded_at=datetime.utcnow(),
+        is_public=False
+    )
+
+    if tag_ids:
+        for tag in Tag.query.filter(Tag.id.in_(tag_ids)).all():
+            new_file.tags.append(tag)
+
+    # Automatically add FOLDER tag to archive files
+    if new_file.is_archive():
+        folder_tag = Tag.query.filter_by(name='FOLDER', is_system=True).first()
+        if folder_tag and folder_tag not in new_file.tags:
+            new_file.tags.append(folder_tag)
+
+    # Quota stays logical: every owner pays for the full size, shared or not
+    adjust_storage_used(user.id, file_size)
+
+    activity = ActivityLog(
+        user_id=user.id,
+        action='file_upload',
+        details=f'Uploaded file: {final_filename}',
+        ip_address=ip_address,
+        timestamp=datetime.utcnow()
+    )
+
+    db.session.add(new_file)
+    db.session.add(activity)
+    return new_file
+
+
+def adjust_storage_used(user_id, delta):
+    """Atomically add `delta` bytes (negative to free) to a user's usage.
+
+    Done as `storage_used = storage_used + delta` in SQL rather than on the
+    loaded User object, so concurrent uploads and deletes in other requests
+    or workers cannot overwrite each other's changes. The caller commits.
+    """
+    updated = func.coalesce(User.storage_used, 0) + delta
+    User.query.filter_by(id=user_id).update(
+        {User.storage_used: case((updated < 0, 0), else_=updated)},
+        synchronize_session=False
+    )
+
+
+def place_upload(user, source_path, original_filename):
+    """Move a finished upload from scratch space into the user's directory.
+
+    Returns the final path, see new_storage_path(). The volume the file
+    already sits on is preferred, so this is normally a rename.
+    """
+    pool = get_pool()
+    file_path = new_storage_path(user.id, original_filename, os.path.getsize(source_path),
+                                 prefer=pool.volume_for_path(source_path))
+    move(source_path, file_path)
+    return file_path
+
+
+def release_file(file):
+    """Release the storage behind a File row that is being deleted.
+
+    Deduplicated files give up their blob or chunk references; private
+    files are removed from disk directly. The caller deletes the row and
+    commits.
+    """
+    if file.is_chunked:
+        chunk_store.release_file_chunks(file.id)
+    elif file.blob_sha256:
+        blob_store.release(file.blob_sha256)
+    elif file.path and os.path.exists(file.path):
+        os.remove(file.path)
+        for path in sprite_paths(file.path):
+            os.remove(path)
+
+
+def release_user_files(user_id):
+    """release_file() for every deduplicated file of a user about to be deleted"""
+    for (sha256,) in db.session.query(File.blob_sha256).filter(
+            File.user_id == user_id, File.blob_sha256.isnot(None)).all():
+        blob_store.release(sha256)
+    for (file_id,) in db.session.query(File.id).filter(
+            File.user_id == user_id, File.is_chunked == True).all():  # noqa: E712
+        chunk_store.release_file_chunks(file_id)
+
+
+def open_stored_file(file):
+    """Binary, seekable file object for a File's contents, wherever they are stored"""
+    if file.is_chunked:
+        return chunk_store.open_chunked(file)
+    return open(file.path, 'rb')
@@ -0,0 +1,170 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import current_app
+from app.utils.disk_cache import DiskCache
+from app.utils.text_extract import PAGE_BREAK
+
+logger = logging.getLogger(__name__)
+
+PARAGRAPH = re.compile(r'\n\s*\n')
+# A line on its own that looks like a heading: numbered, or short without a full stop
+HEADING = re.compile(r'\n(?=(?:\d+(?:\.\d+)*\.?\s+\S|[A-Z][^\n.]{0,80}\n))')
+SENTENCE = re.compile(r'(?<=[.!?])\s+')
+
+PART_INSTRUCTION = 'Summarize part {part} of {parts} of a longer document'
+COMBINE_INSTRUCTION = 'Combine these summaries of consecutive parts of a document into one summary'
+
+
+def _pack(pieces, size):
+    """Join consecutive pieces into chunks of at most `size` characters"""
+    chunks, current = [], ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > size:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n\n{piece}' if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split(text, size, separators):
+    """Pieces of `text` no longer than `size`, cut at the first separator
+    that makes them fit: pages, then sections, paragraphs and sentences."""
+    text = text.strip()
+    if len(text) <= size:
+        return [text] if text else []
+    if not separators:
+        return [text[start:start + size] for start in range(0, len(text), size)]
+    pieces = []
+    for part in separators[0].split(text):
+        pieces.extend(_split(part, size, separators[1:]))
+    return pieces
+
+
+def split_text(text, size):
+    """Chunks of at most `size` characters, cut on page and section
+    boundaries where possible and packed back together up to `size`."""
+    separators = [re.compile(re.escape(PAGE_BREAK)), HEADING, PARAGRAPH, SENTENCE]
+    return _pack(_split(text, size, separators), size)
+
+
+class Summarizer:
+    """Summaries of texts of any length from the AI server.
+
+    Text that fits one request is summarised directly. Longer text is
+    split, the parts summarised concurrently by at most SUMMARY_WORKERS
+    requests, and the part summaries combined level by level until one
+    is left; the user's instruction applies to that last step. Every
+    answer is cached by its request, so a retry after a timeout only
+    sends the requests that did not finish.
+    """
+
+    def __init__(self, config):
+        self.url = config['AI_SUMMARIZE_URL']
+        self.chunk_chars = config['SUMMARY_CHUNK_CHARS']
+        self.timeout = config['SUMMARY_TIMEOUT']
+        self.partial_tokens = config['SUMMARY_PARTIAL_TOKENS']
+        self.root = os.path.join(config['UPLOAD_FOLDER'], 'summary_cache')
+        self.cache = DiskCache(self.root, config['SUMMARY_CACHE_BUDGET'], ('.txt',))
+        self.pool = ThreadPoolExecutor(max_workers=max(1, config['SUMMARY_WORKERS']),
+                                       thread_name_prefix='summarize')
+        self.session = requests.Session()
+
+    def path_for(self, payload):
+        key = hashlib.sha256(repr(sorted(payload.items())).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], f'{key}.txt')
+
+    def request(self, payload):
+        """The AI server's summary for one payload, from the cache when possible"""
+        target = self.path_for(payload)
+        if self.cache.touch(target):
+            with open(target, encoding='utf-8') as f:
+                return f.read()
+        res = self.session.post(self.url, json=payload, timeout=self.timeout)
+        res.raise_for_status()
+        summary = res.json().get('summary')
+        if summary is None:
+            raise ValueError('AI server returned no summary')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f'{target}.part'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(summary)
+        os.replace(tmp_path, target)
+        self.cache.add(target, os.path.getsize(target))
+        return summary
+
+    def payload(self, text, instruction, language, max_tokens):
+        if instruction:
+            text = f'{instruction} in {language}:\n{text}' if language else f'{instruction}:\n{text}'
+        payload = {'text': text}
+        if max_tokens:
+            payload['max_tokens'] = max_tokens
+        if language:
+            payload['language'] = language
+        return payload
+
+    def summarize_all(self, payloads):
+        """Summaries of several payloads, requested concurrently.
+
+        Every request is waited for, so those that succeed are cached even
+        when another fails; the first failure is then raised.
+        """
+        futures = [self.pool.submit(self.request, payload) for payload in payloads]
+        results, failure = [], None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failure = failure or e
+        if failure is not None:
+            raise failure
+        return results
+
+    def summarize(self, text, instruction=None, language=None, max_tokens=None):
+        """Summary of `text`; `instruction` is e.g. "Summarize the following text".
+
+        Empty text gives an empty summary without asking the AI server.
+        """
+        text = text.strip()
+        if not text:
+            return ''
+        if len(text) <= self.chunk_chars:
+            return self.request(self.payload(text, instruction, language, max_tokens))
+
+        chunks = split_text(text, self.chunk_chars)
+        logger.info(f"Summarizing {len(text)} characters in {len(chunks)} parts")
+        summaries = self.summarize_all([
+            self.payload(chunk, PART_INSTRUCTION.format(part=i + 1, parts=len(chunks)), language,
+                         self.partial_tokens)
+            for i, chunk in enumerate(chunks)
+        ])
+        # Combine groups of summaries that fit one request until one group is left
+        while True:
+            groups = _pack(summaries, self.chunk_chars)
+            if len(groups) == 1:
+                break
+            if len(groups) == len(summaries):
+                # Summaries too long to share a request: combine them in pairs anyway
+                groups = ['\n\n'.join(summaries[i:i + 2]) for i in range(0, len(summaries), 2)]
+            summaries = self.summarize_all([
+                self.payload(group, COMBINE_INSTRUCTION, language, self.partial_tokens) for group in groups
+            ])
+        final = f'{instruction or COMBINE_INSTRUCTION} (given as summaries of its parts)'
+        return self.request(self.payload(groups[0], final, language, max_tokens))
+
+
+_summarizer_lock = threading.Lock()
+
+
+def get_summarizer():
+    with _summarizer_lock:
+        summarizer = current_app.extensions.get('summarizer')
+        if summarizer is None:
+            summarizer = current_app.extensions['summarizer'] = Summarizer(current_app.config)
+        return summarizer
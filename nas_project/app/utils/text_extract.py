@@ -0,0 +1,169 @@
+import io
+import os
+import gzip
+import threading
+import docx  # python-docx
+from flask import current_app
+from app.config import Config
+from app.utils.disk_cache import DiskCache
+from app.utils.pdf_pages import get_pdf_pages
+from app.utils.storage import content_version, open_stored_file
+
+# Bump when extraction changes, so text cached by the old code is not reused
+EXTRACTOR_VERSION = 2
+
+# Ends every page of a PDF's text, so later stages can split on pages
+PAGE_BREAK = '\f'
+
+# Source code is read as plain text, like .txt
+PLAIN_TEXT_EXTENSIONS = ('.txt',) + tuple(sorted(f'.{ext}' for ext in Config.FILE_CATEGORIES['code']))
+
+SUPPORTED_EXTENSIONS = PLAIN_TEXT_EXTENSIONS + ('.pdf', '.docx')
+
+CACHE_EXT = '.txt.gz'
+
+
+def file_extension(file):
+    return os.path.splitext(file.original_filename or file.filename)[1].lower()
+
+
+def is_candidate(file):
+    """Whether text can be extracted from a File; PyMuPDF needs a real path"""
+    ext = file_extension(file)
+    return ext in SUPPORTED_EXTENSIONS and not (ext == '.pdf' and file.is_chunked)
+
+
+def _pdf_pages(file):
+    """Text of each page of a PDF.
+
+    Pages are read through the page viewer's document pool, a page per
+    hold of its lock, so a long extraction never stalls page renders and
+    an already open document is not parsed again.
+    """
+    pool = get_pdf_pages().documents
+    version = content_version(file)
+    with pool.lock:
+        pages = pool.get(file.path, version).page_count
+    for number in range(pages):
+        with pool.lock:
+            text = pool.get(file.path, version)[number].get_text()
+        yield text + PAGE_BREAK
+
+
+def _docx_paragraphs(file):
+    with open_stored_file(file) as f:
+        document = docx.Document(f)
+    for paragraph in document.paragraphs:
+        yield paragraph.text + '\n'
+
+
+def _txt_blocks(file, block_size=64 * 1024):
+    with open_stored_file(file) as f:
+        text = io.TextIOWrapper(f, encoding='utf-8', errors='ignore')
+        while True:
+            block = text.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+EXTRACTORS = dict.fromkeys(PLAIN_TEXT_EXTENSIONS, _txt_blocks)
+EXTRACTORS.update({'.pdf': _pdf_pages, '.docx': _docx_paragraphs})
+
+
+class TextCache:
+    """Plain text of documents, extracted once and kept gzipped in a DiskCache.
+
+    Entries are named by content hash and EXTRACTOR_VERSION, so copies of
+    the same document share one entry and a changed file gets a new one.
+    Extraction streams into the cache file piece by piece, stopping at
+    TEXT_EXTRACT_MAX_CHARS, so memory use does not grow with the document.
+    """
+
+    def __init__(self, config):
+        self.root = os.path.join(config['UPLOAD_FOLDER'], 'text_cache')
+        self.max_chars = config['TEXT_EXTRACT_MAX_CHARS']
+        self.cache = DiskCache(self.root, config['TEXT_CACHE_BUDGET'], (CACHE_EXT,))
+        self._inflight = {}  # target path -> Lock held while it is extracted
+        self._lock = threading.Lock()
+
+    def path_for(self, file):
+        version = content_version(file)
+        return os.path.join(self.root, version[:2], f'{version}.v{EXTRACTOR_VERSION}{CACHE_EXT}')
+
+    def lookup(self, file):
+        """Path of the cached text of a File, or None if it is not extracted yet"""
+        target = self.path_for(file)
+        return target if self.cache.touch(target) else None
+
+    def extract(self, file):
+        """Path of the cached text of a File, extracting it first if needed.
+
+        Raises ValueError for unsupported files; parser errors propagate.
+        Concurrent requests for the same document wait for one extraction.
+        """
+        if not is_candidate(file):
+            raise ValueError(f'Unsupported file type: {file_extension(file)}')
+        target = self.path_for(file)
+        if self.cache.touch(target):
+            return target
+        with self._lock:
+            lock = self._inflight.setdefault(target, threading.Lock())
+        try:
+            with lock:
+                if not self.cache.touch(target):
+                    self._extract(file, target)
+        finally:
+            with self._lock:
+                self._inflight.pop(target, None)
+        return target
+
+    def _extract(self, file, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f'{target}.part'
+        remaining = self.max_chars
+        try:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as out:
+                for piece in EXTRACTORS[file_extension(file)](file):
+                    out.write(piece[:remaining])
+                    remaining -= len(piece)
+                    if remaining <= 0:
+                        break
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, target)
+        self.cache.add(target, os.path.getsize(target))
+
+    def open(self, file):
+        """Text stream of a File's extracted text, for callers that read it in pieces"""
+        try:
+            return gzip.open(self.extract(file), 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            # Evicted between the extraction and the open
+            return gzip.open(self.extract(file), 'rt', encoding='utf-8')
+
+    def get_text(self, file):
+        """The extracted text of a File as one string"""
+        with self.open(file) as f:
+            return f.read()
+
+    def stats(self):
+        return self.cache.usage()
+
+
+_text_cache_lock = threading.Lock()
+
+
+def get_text_cache():
+    with _text_cache_lock:
+        text_cache = current_app.extensions.get('text_cache')
+        if text_cache is None:
+            text_cache = current_app.extensions['text_cache'] = TextCache(current_app.config)
+        return text_cache
+
+
+def extract_text(file):
+    """Extracted text of a File, from the shared cache; see TextCache.extract"""
+    return get_text_cache().get_text(file)
@@ -0,0 +1,270 @@
+import os
+import uuid
+import errno
+import shutil
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app.models import db, UploadSession, UploadChunk, StorageReservation, Blob
+from app.utils import blob_store
+from app.utils.storage import get_upload_tmp_dir
+from app.utils.quota import release_reservation
+from app.utils.upload_stream import SNIFF_SIZE, sniff_mime_type
+from app.utils.volumes import move
+
+logger = logging.getLogger(__name__)
+
+# Read size used when copying a chunk body from the request stream
+COPY_BUFFER_SIZE = 256 * 1024
+
+# Read size used when digesting the assembled data file
+DIGEST_BUFFER_SIZE = 1024 * 1024
+
+
+class ChunkError(ValueError):
+    """Raised when a chunk body does not match what the session expects"""
+
+
+def create_session(user, original_filename, total_size, category=None, tag_ids=None,
+                   reservation=None):
+    """Open a new resumable upload session for `user`.
+
+    `reservation` is the storage admitted for it by quota.reserve_storage;
+    it stays with the session until the upload completes or is discarded.
+    """
+    session = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=user.id,
+        original_filename=original_filename,
+        category=category,
+        tag_ids=','.join(str(t) for t in (tag_ids or [])),
+        total_size=total_size,
+        chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+        status='active',
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow()
+    )
+    db.session.add(session)
+    if reservation is not None:
+        reservation.upload_session_id = session.id
+    db.session.commit()
+    try:
+        os.makedirs(get_session_dir(session.id), exist_ok=True)
+        preallocate(get_data_path(session), total_size)
+    except OSError:
+        discard_session(session)
+        db.session.commit()
+        raise
+    return session
+
+
+def preallocate(path, size):
+    """Create `path` at its final size so chunks can be written at any offset.
+
+    posix_fallocate reserves the blocks up front (and fails early when the
+    disk is full); filesystems without it get a sparse file instead.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def get_session_dir(session_id):
+    return os.path.join(get_upload_tmp_dir(), 'sessions', session_id)
+
+
+def get_data_path(session):
+    """The preallocated file every chunk is written into at its own offset"""
+    return os.path.join(get_session_dir(session.id), 'data')
+
+
+def write_chunk(session, index, stream, checksum=None):
+    """Store chunk `index` of `session` from a readable byte stream.
+
+    The body is written with pwrite straight to the chunk's offset in the
+    session's data file, so any number of chunks of the same upload can be
+    received concurrently and in any order, and nothing has to be copied
+    when the upload is finalized. A chunk only counts as received once its
+    length (and checksum, when given) match; a failed or retried PUT just
+    overwrites the same byte range.
+    """
+    if index < 0 or index >= session.total_chunks:
+        raise ChunkError(f'Chunk index {index} out of range')
+
+    expected = session.chunk_length(index)
+    offset = index * session.chunk_size
+    checksum = checksum.lower() if checksum else None
+
+    existing = UploadChunk.query.get((session.id, index))
+    if existing:
+        if checksum and existing.checksum == checksum:
+            # Retransmission of a chunk we already hold
+            return existing
+        # The byte range is about to be overwritten; it no longer counts as
+        # received until the new body has been verified
+        db.session.delete(existing)
+        db.session.commit()
+
+    digest = hashlib.sha256()
+    written = 0
+    fd = os.open(get_data_path(session), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        while True:
+            data = stream.read(min(COPY_BUFFER_SIZE, expected - written + 1))
+            if not data:
+                break
+            if written + len(data) > expected:
+                raise ChunkError(f'Chunk {index} is larger than {expected} bytes')
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(fd, view, offset + written)
+                view = view[n:]
+                written += n
+            digest.update(data)
+    finally:
+        os.close(fd)
+
+    if written != expected:
+        raise ChunkError(f'Chunk {index} has {written} bytes, expected {expected}')
+    if checksum and digest.hexdigest() != checksum:
+        raise ChunkError(f'Checksum mismatch for chunk {index}')
+
+    return record_chunk(session, index, written, digest.hexdigest())
+
+
+def record_chunk(session, index, size, checksum):
+    """Mark a chunk as received; tolerates a concurrent PUT of the same index"""
+    now = datetime.utcnow()
+    chunk = UploadChunk.query.get((session.id, index))
+    if chunk is None:
+        chunk = UploadChunk(session_id=session.id, chunk_index=index, size=size,
+                            checksum=checksum, received_at=now)
+        db.session.add(chunk)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request stored the same chunk first
+            db.session.rollback()
+            chunk = UploadChunk.query.get((session.id, index))
+    chunk.size = size
+    chunk.checksum = checksum
+    chunk.received_at = now
+    UploadSession.query.filter_by(id=session.id).update({'updated_at': now})
+    db.session.commit()
+    return chunk
+
+
+def missing_chunks(session):
+    received = set(session.received_chunks())
+    return [i for i in range(session.total_chunks) if i not in received]
+
+
+def claim_session(session):
+    """Take an active session for finalizing, so only one completion runs.
+
+    A conditional UPDATE, committed straight away: of two concurrent
+    completions of the same session one gets it and the other gets False
+    and must leave its files alone. Reloads `session` either way.
+    """
+    claimed = UploadSession.query.filter_by(id=session.id, status='active').update(
+        {UploadSession.status: 'finalizing', UploadSession.updated_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.session.commit()
+    db.session.refresh(session)
+    return bool(claimed)
+
+
+def finish_data_file(session):
+    """Flush the assembled data file to disk and digest it.
+
+    Chunks arrive in any order, so unlike a streamed upload the SHA-256
+    cannot be kept running as they are written; it is computed here in
+    one sequential read, which also picks up the head for the MIME sniff.
+    Returns (path, sha256, mime_type).
+    """
+    data_path = get_data_path(session)
+    digest = hashlib.sha256()
+    with open(data_path, 'rb') as f:
+        os.fsync(f.fileno())
+        head = f.read(SNIFF_SIZE)
+        digest.update(head)
+        for block in iter(lambda: f.read(DIGEST_BUFFER_SIZE), b''):
+            digest.update(block)
+    return data_path, digest.hexdigest(), sniff_mime_type(head, session.original_filename)
+
+
+def restore_data_file(session, placed_path, sha256=None):
+    """Put the body of a completion that was rolled back where the session keeps it.
+
+    The rollback already returned any blob reference blob_store.ingest
+    took; this undoes what it did on disk. A new blob is renamed back out
+    of the blob store, and a duplicate, whose own bytes ingest dropped, is
+    copied back from the blob it matched. Returns False when the body is
+    gone.
+    """
+    data_path = get_data_path(session)
+    if placed_path and os.path.exists(placed_path):
+        move(placed_path, data_path)
+        return True
+    if not sha256:
+        return False
+    blob = Blob.query.get(sha256)
+    if blob is None:
+        orphan = blob_store.blob_path(sha256)
+        if os.path.exists(orphan):
+            move(orphan, data_path)
+            return True
+    elif os.path.exists(blob.path):
+        shutil.copyfile(blob.path, data_path)
+        return True
+    return False
+
+
+def fail_session(session):
+    """Mark a session whose body was lost as failed; it can only be discarded now.
+
+    Its chunks no longer count as received and its reservation is given
+    back. The caller commits.
+    """
+    UploadChunk.query.filter_by(session_id=session.id).delete(synchronize_session=False)
+    release_reservation(get_reservation(session))
+    session.status = 'failed'
+    session.updated_at = datetime.utcnow()
+
+
+def get_reservation(session):
+    return StorageReservation.query.filter_by(upload_session_id=session.id).first()
+
+
+def discard_session(session):
+    """Remove the session's scratch files, its reservation and its database rows"""
+    shutil.rmtree(get_session_dir(session.id), ignore_errors=True)
+    release_reservation(get_reservation(session))
+    db.session.delete(session)
+
+
+def expire_stale_sessions(user_id=None):
+    """Drop sessions nobody has touched for UPLOAD_SESSION_TTL seconds"""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+    query = UploadSession.query.filter(UploadSession.updated_at < cutoff)
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    stale = query.all()
+    for session in stale:
+        logger.info(f"Discarding stale upload session {session.id}")
+        discard_session(session)
+    if stale:
+        db.session.commit()
+    return len(stale)
@@ -0,0 +1,173 @@
+import os
+import hashlib
+import mimetypes
+import logging
+from flask import current_app
+from werkzeug.datastructures import MultiDict
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NEED_DATA
+from app.utils.storage import new_storage_path
+
+try:
+    import magic
+except ImportError:  # libmagic is optional; fall back to the file extension
+    magic = None
+
+logger = logging.getLogger(__name__)
+
+# Bytes kept from the start of an upload for content sniffing
+SNIFF_SIZE = 2048
+
+# Upper bound for the plain form fields that accompany a multipart upload
+MAX_FORM_FIELDS_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """An upload that has to be refused; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class UploadSink:
+    """Writes an upload straight to its final path in large buffered writes.
+
+    Size, SHA-256 and a MIME sniff of the leading bytes are computed on the
+    fly, so the body is read exactly once and never copied.
+    """
+
+    def __init__(self, path, original_filename):
+        self.path = path
+        self.original_filename = original_filename
+        self.size = 0
+        self.max_size = None  # Set to refuse bodies larger than what was admitted
+        self._hash = hashlib.sha256()
+        self._head = b''
+        buffer_size = current_app.config['UPLOAD_STREAM_BUFFER']
+        # 'x' claims the name atomically; a concurrent upload of the same
+        # name gets FileExistsError and picks the next free one
+        self._file = open(path, 'xb', buffering=buffer_size)
+
+    def write(self, data):
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            raise UploadError('Upload is larger than its declared size', 413)
+        if len(self._head) < SNIFF_SIZE:
+            self._head += data[:SNIFF_SIZE - len(self._head)]
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def abort(self):
+        """Close and remove a partially written upload"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    @property
+    def mime_type(self):
+        return sniff_mime_type(self._head, self.original_filename)
+
+
+def sniff_mime_type(head, original_filename):
+    """MIME type of an upload from its first SNIFF_SIZE bytes, or from its
+    name when libmagic is missing or cannot tell"""
+    if magic is not None and head:
+        try:
+            return magic.from_buffer(head, mime=True)
+        except Exception as e:
+            logger.warning(f"MIME sniffing failed for {original_filename}: {str(e)}")
+    return mimetypes.guess_type(original_filename)[0] or 'application/octet-stream'
+
+
+def open_upload(user_id, original_filename, size=0):
+    """Create the destination file for an upload of `size` bytes at a fresh sharded path"""
+    while True:
+        path = new_storage_path(user_id, original_filename, size)
+        try:
+            return UploadSink(path, original_filename)
+        except FileExistsError:
+            continue
+
+
+def receive_raw(stream, sink):
+    """Copy a raw request body into `sink`"""
+    read_size = current_app.config['UPLOAD_STREAM_BUFFER']
+    try:
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                break
+            sink.write(data)
+        sink.close()
+    except Exception:
+        sink.abort()
+        raise
+    return sink
+
+
+def receive_multipart(stream, boundary, open_sink, file_field='file'):
+    """Parse a multipart/form-data body incrementally.
+
+    Plain fields are collected into a MultiDict; the `file_field` part is
+    handed to the sink returned by `open_sink(filename)` as it arrives,
+    without Werkzeug spooling it to a temporary file first. Other file
+    parts are read and discarded. Returns (fields, sink or None).
+    """
+    if isinstance(boundary, str):
+        boundary = boundary.encode('latin-1')
+
+    read_size = current_app.config['UPLOAD_STREAM_BUFFER']
+    decoder = MultipartDecoder(boundary)
+    fields = MultiDict()
+    fields_size = 0
+    sink = None
+    current = None  # ('field', name, [bytes]) | ('file', None, None) | ('skip', None, None)
+
+    try:
+        while True:
+            try:
+                event = decoder.next_event()
+            except ValueError:
+                raise UploadError('Malformed or incomplete multipart body')
+            if event is NEED_DATA:
+                data = stream.read(read_size)
+                decoder.receive_data(data or None)
+                continue
+            if isinstance(event, Field):
+                current = ('field', event.name, [])
+            elif isinstance(event, File):
+                if event.name == file_field and event.filename and sink is None:
+                    sink = open_sink(event.filename)
+                    current = ('file', None, None)
+                else:
+                    current = ('skip', None, None)
+            elif isinstance(event, Data):
+                kind, name, parts = current
+                if kind == 'field':
+                    fields_size += len(event.data)
+                    if fields_size > MAX_FORM_FIELDS_SIZE:
+                        raise UploadError('Form fields too large', 413)
+                    parts.append(event.data)
+                    if not event.more_data:
+                        fields.add(name, b''.join(parts).decode('utf-8', 'replace'))
+                elif kind == 'file':
+                    sink.write(event.data)
+            elif isinstance(event, Epilogue):
+                break
+        if sink is not None:
+            sink.close()
+    except Exception:
+        if sink is not None:
+            sink.abort()
+        raise
+
+    return fields, sink
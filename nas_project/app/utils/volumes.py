@@ -0,0 +1,186 @@
+import os
+import time
+import errno
+import shutil
+import logging
+import threading
+from flask import current_app
+from sqlalchemy import func
+from app.models import db, File
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VOLUME = 'default'
+
+
+class Volume:
+    """One storage root of the pool, with its last free-space sample"""
+
+    def __init__(self, name, path, capacity=None, weight=1.0):
+        self.name = name
+        self.path = os.path.abspath(path)
+        self.capacity = capacity
+        self.weight = weight if weight and weight > 0 else 1.0
+        self.total = 0
+        self.free = 0
+        self.used = 0  # Bytes of File rows placed here
+        self.online = False
+
+    def headroom(self, margin):
+        """Bytes that can still be placed here, honouring the cap and the free margin"""
+        if not self.online:
+            return 0
+        room = self.free - margin
+        if self.capacity:
+            room = min(room, self.capacity - self.used)
+        return max(room, 0)
+
+    def fill(self):
+        """Fraction of the volume in use: on disk, or of its cap if that is fuller"""
+        if not self.online or not self.total:
+            return 1.0
+        fill = 1 - self.free / self.total
+        if self.capacity:
+            fill = max(fill, self.used / self.capacity)
+        return fill
+
+    def to_dict(self, margin):
+        return {
+            'name': self.name,
+            'path': self.path,
+            'online': self.online,
+            'capacity': self.capacity,
+            'weight': self.weight,
+            'total': self.total,
+            'free': self.free,
+            'used': self.used,
+            'headroom': self.headroom(margin),
+            'fill': round(self.fill(), 4),
+        }
+
+
+class VolumePool:
+    """The configured volumes, with statvfs samples cached for a few seconds.
+
+    Placement reads the cached samples, so choosing a volume costs no
+    syscalls on most requests; bytes placed since the last sample are
+    subtracted locally until the next one.
+    """
+
+    def __init__(self, config):
+        self.volumes = [Volume(DEFAULT_VOLUME, config['UPLOAD_FOLDER'],
+                               config.get('DEFAULT_VOLUME_CAPACITY'),
+                               config.get('DEFAULT_VOLUME_WEIGHT', 1.0))]
+        for entry in config.get('STORAGE_VOLUMES') or []:
+            self.volumes.append(Volume(entry['name'], entry['path'],
+                                       entry.get('capacity'), entry.get('weight', 1.0)))
+        self.config = config
+        self.sampled_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        return self.config.get('VOLUME_SAMPLE_INTERVAL', 15)
+
+    @property
+    def margin(self):
+        return self.config.get('DISK_FREE_MARGIN', 0)
+
+    def get(self, name):
+        for volume in self.volumes:
+            if volume.name == (name or DEFAULT_VOLUME):
+                return volume
+        return None
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and time.monotonic() - self.sampled_at < self.interval:
+                return
+            for volume in self.volumes:
+                try:
+                    st = os.statvfs(volume.path)
+                    volume.total = st.f_blocks * st.f_frsize
+                    volume.free = st.f_bavail * st.f_frsize
+                    volume.online = True
+                except OSError as e:
+                    if volume.online:
+                        logger.error(f"Storage volume {volume.name} is unavailable: {str(e)}")
+                    volume.online = False
+            used = dict(db.session.query(func.coalesce(File.volume, DEFAULT_VOLUME),
+                                         func.coalesce(func.sum(File.file_size), 0))
+                        .filter(File.blob_sha256.is_(None), File.is_chunked.isnot(True))
+                        .group_by(func.coalesce(File.volume, DEFAULT_VOLUME)).all())
+            for volume in self.volumes:
+                volume.used = used.get(volume.name, 0)
+            self.sampled_at = time.monotonic()
+
+    def choose(self, size=0, prefer=None):
+        """Volume for a new file of `size` bytes: the most weighted headroom wins.
+
+        `prefer` is taken when it has room, e.g. the volume the data
+        already sits on, so placing it is a rename instead of a copy.
+        """
+        self.refresh()
+        with self._lock:
+            preferred = self.get(prefer) if prefer else None
+            if preferred is not None and preferred.headroom(self.margin) >= size:
+                chosen = preferred
+            else:
+                chosen = max(self.volumes, key=lambda v: v.headroom(self.margin) * v.weight)
+            chosen.free -= size
+            chosen.used += size
+            return chosen
+
+    def max_headroom(self):
+        self.refresh()
+        return max(v.headroom(self.margin) for v in self.volumes)
+
+    def volume_for_path(self, path):
+        """Name of the volume `path` lives on (the longest matching root)"""
+        path = os.path.abspath(path)
+        matches = [v for v in self.volumes if path == v.path or path.startswith(v.path + os.sep)]
+        if not matches:
+            return DEFAULT_VOLUME
+        return max(matches, key=lambda v: len(v.path)).name
+
+    def stats(self):
+        self.refresh(force=True)
+        return [v.to_dict(self.margin) for v in self.volumes]
+
+
+def get_pool():
+    pool = current_app.extensions.get('volume_pool')
+    if pool is None:
+        pool = current_app.extensions['volume_pool'] = VolumePool(current_app.config)
+    return pool
+
+
+def move(source, target):
+    """os.replace, falling back to a copy when `target` is on another volume"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, target)
+
+
+def remove_paths(paths):
+    """Unlink old file paths and prune the shard directories they leave empty.
+
+    A user's top-level directory on a volume is never removed.
+    """
+    roots = {volume.path for volume in get_pool().volumes}
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        parent = os.path.dirname(os.path.abspath(path))
+        while os.path.dirname(parent) not in roots and parent not in roots:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
@@ -3,6 +3,7 @@ from app import create_app, db
 from app.models import User
 import sqlite3
 import os
+import re
 
 
 app = create_app()
@@ -64,8 +65,51 @@ def add_missing_columns_and_fix_user_groups():
         print("Table 'user_groups' created with cascading deletes.")
         
         conn.commit()
+        
+        # Deduplicated files share their blob's path, so file.path can no longer be UNIQUE
+        if 'file' in tables:
+            drop_unique_file_path(conn)
+        
         conn.close()
         print("Migration complete.")
 
+def drop_unique_file_path(conn):
+    """Rebuild the file table without UNIQUE (path).
+    
+    SQLite cannot drop a table constraint, so the table is recreated from its
+    own DDL minus the constraint and the rows are copied over.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='file';")
+    ddl = cursor.fetchone()[0]
+    stripped = re.sub(r',\s*UNIQUE\s*\(\s*path\s*\)', '', ddl)
+    stripped = re.sub(r'(\bpath\s+VARCHAR\(\d+\)[^,]*?)\s+UNIQUE', r'\1', stripped)
+    if stripped == ddl:
+        print("file.path is not UNIQUE, nothing to rebuild.")
+        return
+    
+    print("Rebuilding 'file' without UNIQUE (path)...")
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='file' AND sql IS NOT NULL;")
+    indexes = [row[0] for row in cursor.fetchall()]
+    
+    cursor.execute("PRAGMA foreign_keys = OFF;")
+    cursor.execute("BEGIN;")
+    cursor.execute(re.sub(r'CREATE TABLE\s+"?file"?', 'CREATE TABLE file_new', stripped, count=1))
+    cursor.execute("INSERT INTO file_new SELECT * FROM file;")
+    cursor.execute("DROP TABLE file;")
+    cursor.execute("ALTER TABLE file_new RENAME TO file;")
+    for index_sql in indexes:
+        cursor.execute(index_sql)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_file_path ON file (path);")
+    cursor.execute("PRAGMA foreign_key_check;")
+    problems = cursor.fetchall()
+    if problems:
+        conn.rollback()
+        print(f"Foreign key check failed, 'file' left unchanged: {problems}")
+    else:
+        conn.commit()
+        print("Table 'file' rebuilt.")
+    cursor.execute("PRAGMA foreign_keys = ON;")
+
 if __name__ == '__main__':
     add_missing_columns_and_fix_user_groups()
@@ -0,0 +1,26 @@
+# migrate_storage.py
+# Moves existing uploads from the flat UPLOAD_FOLDER/<user_id>/<name> layout
+# to UPLOAD_FOLDER/<user_id>/ab/cd/<token><ext>. Can run while the server
+# is up and can be interrupted and restarted at any time.
+import argparse
+from app import create_app
+from app.utils.layout_migration import run
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate uploads to the sharded storage layout')
+    parser.add_argument('--batch-size', type=int, default=200, help='files moved per batch')
+    parser.add_argument('--grace', type=float, default=30,
+                        help='seconds old paths stay readable after a batch is committed')
+    parser.add_argument('--pause', type=float, default=0.5, help='seconds to sleep between batches')
+    parser.add_argument('--max-batches', type=int, default=None, help='stop after this many batches')
+    args = parser.parse_args()
+
+    with app.app_context():
+        print(f"Storage path is: {app.config['UPLOAD_FOLDER']}")
+        state = run(batch_size=args.batch_size, grace=args.grace, pause=args.pause,
+                    max_batches=args.max_batches)
+        print(f"Migration stopped at file {state['last_id']}: {state['moved']} files moved, "
+              f"{len(state['missing'])} missing on disk.")
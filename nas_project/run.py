@@ -32,6 +32,19 @@ if __name__ == '__main__':
     # Cleanup orphaned files
     cleanup_orphaned_files()
     
+    # Periodically recompute storage_used from the file table and the disk
+    from app.utils.reconcile import StorageReconciler
+    StorageReconciler(app).start()
+    
+    # Spread files over the storage pool when volumes fill up unevenly
+    from app.utils.rebalance import Rebalancer
+    Rebalancer(app).start()
+    
+    # Resume preview and media jobs queued before the last shutdown
+    from app.utils.background import get_queue
+    with app.app_context():
+        get_queue()
+    
     app.run(
         host='0.0.0.0',  # Only listen on localhost since Nginx handles external connections
         port=5000,
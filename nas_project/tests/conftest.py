@@ -0,0 +1,105 @@
+import os
+import itertools
+import tempfile
+import threading
+from datetime import datetime
+
+import pytest
+
+# Config reads DATABASE_URL when it is first imported
+WORK_DIR = tempfile.mkdtemp(prefix='nas-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORK_DIR, 'nas.db')}"
+
+from werkzeug.serving import make_server  # noqa: E402
+import ai_server_standin  # noqa: E402
+from app import create_app, db  # noqa: E402
+from app.models import User  # noqa: E402
+from app.utils.background import JobQueue  # noqa: E402
+
+_user_numbers = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def ai_server():
+    """The AI server stand-in, served on a free local port"""
+    server = make_server('127.0.0.1', 0, ai_server_standin.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+@pytest.fixture(scope='session')
+def app(ai_server):
+    app = create_app()
+    app.config.update(
+        TESTING=True,
+        UPLOAD_FOLDER=os.path.join(WORK_DIR, 'storage'),
+        EMBEDDING_API_URL=f'{ai_server}/embed',
+        AI_SUMMARIZE_URL=f'{ai_server}/summarize',
+    )
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Jobs are queued as usual, but only run when a test runs them
+    app.extensions['job_queue'] = JobQueue(app)
+    return app
+
+
+@pytest.fixture
+def config(app):
+    """app.config, restored after the test"""
+    saved = dict(app.config)
+    yield app.config
+    app.config.clear()
+    app.config.update(saved)
+
+
+@pytest.fixture
+def ctx(app):
+    with app.app_context():
+        yield
+        db.session.rollback()
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(storage_limit=10 ** 9):
+        number = next(_user_numbers)
+        with app.app_context():
+            user = User(username=f'user{number}', email=f'user{number}@example.com', is_approved=True,
+                        created_at=datetime.utcnow(), storage_limit=storage_limit, storage_used=0)
+            user.set_password('secret')
+            db.session.add(user)
+            db.session.commit()
+            return user.id
+    return make_user
+
+
+@pytest.fixture
+def make_client(app):
+    def make_client(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
+    return make_client
+
+
+@pytest.fixture
+def user(make_user):
+    return make_user()
+
+
+@pytest.fixture
+def client(make_client, user):
+    return make_client(user)
+
+
+@pytest.fixture
+def upload(client):
+    """Upload bytes through the raw endpoint and return the new File's id"""
+    def upload(filename, data, client=client):
+        res = client.put(f'/files/upload/raw?filename={filename}', data=data)
+        assert res.status_code == 200, res.get_json()
+        return res.get_json()['file_id']
+    return upload
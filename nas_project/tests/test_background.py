@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.models import BackgroundJob
+from app.utils.background import JobQueue
+
+
+@pytest.fixture
+def job(app, upload):
+    """A job more urgent than any other test's, and two queues sharing the database"""
+    file_id = upload('job.txt', b'job')
+    with app.app_context():
+        first, second = JobQueue(app), JobQueue(app)
+        first.enqueue('test', file_id, priority=-1)
+        job_id = BackgroundJob.query.filter_by(kind='test', file_id=file_id).one().id
+        yield first, second, job_id
+        BackgroundJob.query.filter_by(id=job_id).delete()
+        db.session.commit()
+
+
+def age(job_id, seconds):
+    """Pretend the job's worker last checked in `seconds` ago"""
+    then = datetime.utcnow() - timedelta(seconds=seconds)
+    BackgroundJob.query.filter_by(id=job_id).update({'started_at': then, 'heartbeat_at': then})
+    db.session.commit()
+
+
+def test_long_running_job_is_not_claimed_twice(app, job):
+    first, second, job_id = job
+    assert first._claim(True).id == job_id
+    age(job_id, app.config['JOB_STALE_AFTER'] - 1)
+    first.beat()
+    heartbeat = BackgroundJob.query.filter_by(id=job_id).one().heartbeat_at
+    assert datetime.utcnow() - heartbeat < timedelta(seconds=5)
+
+    # Well past JOB_STALE_AFTER since it started, but its worker is alive
+    BackgroundJob.query.filter_by(id=job_id).update(
+        {'started_at': datetime.utcnow() - timedelta(seconds=10 * app.config['JOB_STALE_AFTER'])})
+    db.session.commit()
+    claimed = second._claim(True)
+    assert claimed is None or claimed.id != job_id
+    assert db.session.get(BackgroundJob, job_id).attempts == 1
+
+
+def test_job_of_a_dead_worker_is_claimed_again(app, job):
+    first, second, job_id = job
+    assert first._claim(True).id == job_id
+    # The worker died, so nothing refreshes the heartbeat
+    age(job_id, app.config['JOB_STALE_AFTER'] + 1)
+    claimed = second._claim(True)
+    assert claimed.id == job_id and claimed.attempts == 2
+
+
+def test_finished_job_is_no_longer_beaten(app, job):
+    first, _, job_id = job
+    first._run(first._claim(True))  # No handler for 'test' jobs, so it fails
+    assert first._running == set()
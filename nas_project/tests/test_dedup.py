@@ -0,0 +1,155 @@
+import os
+import random
+
+import pytest
+
+from app import db
+from app.models import BackgroundJob, Blob, Chunk, ChunkPack, File
+from app.utils import blob_store, chunk_store
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+@pytest.fixture
+def small_chunks(config):
+    """Chunk dedup for files from 32 KiB, in chunks of 1 to 16 KiB"""
+    config.update(STORAGE_DEDUP=True, STORAGE_CHUNK_DEDUP=True, CHUNK_DEDUP_MIN_SIZE=32 * 1024,
+                  CDC_MIN_CHUNK=1024, CDC_AVG_CHUNK=4096, CDC_MAX_CHUNK=16 * 1024)
+    return config
+
+
+def read_back(client, file_id):
+    res = client.get(f'/files/download/{file_id}')
+    assert res.status_code == 200
+    return res.data
+
+
+def test_identical_uploads_share_a_blob(app, client, config, upload):
+    config['STORAGE_DEDUP'] = True
+    body = random_bytes(5000, 'blob')
+    first, second = upload('a.bin', body), upload('b.bin', body)
+    with app.app_context():
+        a, b = db.session.get(File, first), db.session.get(File, second)
+        assert a.blob_sha256 == b.blob_sha256 == a.sha256
+        blob = db.session.get(Blob, a.sha256)
+        assert blob.ref_count == 2
+        path = blob.path
+    assert read_back(client, second) == body
+
+    client.post(f'/files/delete/{first}')
+    with app.app_context():
+        assert db.session.get(Blob, blob.sha256).ref_count == 1
+        blob_store.collect_garbage(grace=0)
+    assert os.path.exists(path)
+    assert read_back(client, second) == body
+
+    client.post(f'/files/delete/{second}')
+    with app.app_context():
+        blob_store.collect_garbage(grace=0)
+        assert db.session.get(Blob, blob.sha256) is None
+    assert not os.path.exists(path)
+
+
+def test_chunks_respect_size_limits(ctx, small_chunks):
+    data = random_bytes(200 * 1024, 'limits')
+    chunks = chunk_store.find_chunks(data, len(data))
+    assert chunks[0][0] == 0
+    assert sum(length for _, length in chunks) == len(data)
+    for (offset, length), (next_offset, _) in zip(chunks, chunks[1:]):
+        assert offset + length == next_offset
+        assert 1024 <= length <= 16 * 1024
+    assert len(chunks) > 10
+
+
+def test_numpy_and_python_scans_agree(ctx, small_chunks):
+    data = random_bytes(chunk_store.SCAN_BLOCK + 20000, 'scan')
+    shift = chunk_store._boundary_shift()
+    expected = chunk_store._candidates_python(data, len(data), shift)
+    assert expected
+    assert chunk_store._candidates_numpy(data, len(data), shift) == expected
+
+
+def test_insertion_only_changes_nearby_chunks(ctx, small_chunks):
+    data = random_bytes(200 * 1024, 'insert')
+    edited = data[:100000] + b'inserted bytes' + data[100000:]
+
+    def pieces(data):
+        return {data[offset:offset + length] for offset, length in chunk_store.find_chunks(data, len(data))}
+    before, after = pieces(data), pieces(edited)
+    assert len(before & after) >= len(before) - 3
+
+
+def test_large_upload_is_chunked_by_the_job_queue(app, client, small_chunks, upload):
+    body = random_bytes(120 * 1024, 'job')
+    file_id = upload('big.bin', body)
+    with app.app_context():
+        file = db.session.get(File, file_id)
+        assert not file.is_chunked and os.path.exists(file.path)
+        assert BackgroundJob.query.filter_by(kind='chunk', file_id=file_id).count() == 1
+        path = file.path
+
+        assert chunk_store.chunk_file(file_id)
+        assert db.session.get(File, file_id).is_chunked
+        assert not chunk_store.chunk_file(file_id)
+    assert not os.path.exists(path)
+    assert read_back(client, file_id) == body
+
+    res = client.get(f'/files/download/{file_id}', headers={'Range': 'bytes=50000-50099'})
+    assert res.status_code == 206
+    assert res.data == body[50000:50100]
+
+
+def test_edited_copy_shares_chunks(app, client, user, small_chunks, upload):
+    body = random_bytes(120 * 1024, 'edit')
+    first = upload('v1.bin', body)
+    second = upload('v2.bin', body[:60000] + b'a small edit' + body[60000:])
+    with app.app_context():
+        assert chunk_store.chunk_file(first) and chunk_store.chunk_file(second)
+        stats = chunk_store.dedup_stats(user)
+    assert stats['physical_bytes'] < 0.7 * stats['logical_bytes']
+
+
+def test_rewritten_file_is_not_switched(app, small_chunks, upload):
+    file_id = upload('moving.bin', random_bytes(64 * 1024, 'rewrite'))
+    with app.app_context():
+        path = db.session.get(File, file_id).path
+        real_ingest = chunk_store.ingest
+
+        def ingest_then_rewrite(source_path):
+            result = real_ingest(source_path)
+            with open(path, 'wb') as f:
+                f.write(b'new body')
+            return result
+        chunk_store.ingest = ingest_then_rewrite
+        try:
+            assert not chunk_store.chunk_file(file_id)
+        finally:
+            chunk_store.ingest = real_ingest
+        assert not db.session.get(File, file_id).is_chunked
+    with open(path, 'rb') as f:
+        assert f.read() == b'new body'
+
+
+def test_sparse_pack_is_compacted(app, client, small_chunks, upload):
+    # Seal whatever earlier tests left open, so both files share a new pack
+    with app.app_context():
+        ChunkPack.query.filter(ChunkPack.status == 'open').update({ChunkPack.status: 'sealed'})
+        db.session.commit()
+    doomed = upload('doomed.bin', random_bytes(150 * 1024, 'doomed'))
+    kept_body = random_bytes(40 * 1024, 'kept')
+    kept = upload('kept.bin', kept_body)
+    with app.app_context():
+        assert chunk_store.chunk_file(doomed) and chunk_store.chunk_file(kept)
+        pack = ChunkPack.query.filter_by(status='open').one()
+        pack_id, pack_path = pack.id, pack.path
+
+    client.post(f'/files/delete/{doomed}')
+    with app.app_context():
+        collected, removed = chunk_store.collect_garbage(grace=0)
+        assert collected > 0 and removed >= 1
+        assert db.session.get(ChunkPack, pack_id) is None
+        assert Chunk.query.filter_by(pack_id=pack_id).count() == 0
+    assert not os.path.exists(pack_path)
+    assert read_back(client, kept) == kept_body
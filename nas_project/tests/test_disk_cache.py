@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from app.utils.disk_cache import DiskCache
+
+
+@pytest.fixture
+def root(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+def write(cache, name, size=100):
+    path = os.path.join(cache.root, name[:1], name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    cache.add(path, size)
+    return path
+
+
+def test_least_recently_used_is_evicted(root):
+    cache = DiskCache(root, 300, ('.ts',))
+    first, second, third = (write(cache, f'{name}.ts') for name in 'abc')
+    assert cache.touch(first)
+    write(cache, 'd.ts')
+    assert not os.path.exists(second)
+    assert cache.touch(first) and cache.touch(third)
+    assert cache.usage()['bytes'] == 300
+
+
+def test_file_written_by_another_worker_is_a_hit(root):
+    worker, other = DiskCache(root, 10 ** 6, ('.ts',)), DiskCache(root, 10 ** 6, ('.ts',))
+    assert other.usage()['files'] == 0
+    path = write(worker, 'a.ts')
+    assert other.contains(path)
+    assert other.touch(path)
+    assert other.usage()['files'] == 1
+    assert not other.touch(path + '.missing')
+
+
+def test_budget_covers_every_worker(root):
+    workers = [DiskCache(root, 500, ('.ts',), rescan_interval=0) for _ in range(3)]
+    for i in range(9):
+        write(workers[i % 3], f'{i}.ts')
+    cached = [name for _, _, names in os.walk(root) for name in names]
+    assert len(cached) == 5
+
+
+def test_removed_by_another_worker_is_a_miss(root):
+    worker, other = DiskCache(root, 10 ** 6, ('.ts',)), DiskCache(root, 10 ** 6, ('.ts',))
+    path = write(worker, 'a.ts')
+    assert other.touch(path)
+    os.remove(path)
+    assert not other.touch(path)
+    assert not other.contains(path)
+    assert other.usage()['files'] == 0
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from app.utils.qos import QoS
+
+
+@pytest.fixture
+def workers(app, tmp_path):
+    config = dict(app.config, UPLOAD_FOLDER=str(tmp_path), QOS_ENABLED=True, QOS_WORKER_PROCESSES=2,
+                  QOS_GLOBAL_DOWNLOAD_RATE=0, QOS_USER_DOWNLOAD_RATE=0)
+    return QoS(config), QoS(config)
+
+
+def test_settings_saved_by_one_worker_reach_the_others(workers):
+    admin, other = workers
+    other.shapers['download'].user_limiter(7)
+    admin.update({'QOS_GLOBAL_DOWNLOAD_RATE': 1000}, {7: {'download': 400}})
+
+    other.refresh()
+    shaper = other.shapers['download']
+    assert other.settings['QOS_GLOBAL_DOWNLOAD_RATE'] == 1000
+    assert shaper.global_limiter.all.rate == 500
+    assert shaper.users[7].all.rate == 200
+
+
+def test_update_keeps_changes_from_other_workers(workers):
+    first, second = workers
+    first.update({'QOS_GLOBAL_DOWNLOAD_RATE': 1000})
+    second.update(user_rates={7: {'upload': 400}})
+    first.refresh()
+    for qos in workers:
+        assert qos.settings['QOS_GLOBAL_DOWNLOAD_RATE'] == 1000
+        assert qos.user_rates == {'7': {'upload': 400}}
+
+
+def test_removed_state_file_restores_the_defaults(workers):
+    admin, other = workers
+    admin.update({'QOS_GLOBAL_DOWNLOAD_RATE': 1000})
+    other.refresh()
+    os.remove(admin.state_path)
+    other.refresh()
+    assert other.settings['QOS_GLOBAL_DOWNLOAD_RATE'] == 0
+    assert other.shapers['download'].global_limiter.all.rate == 0
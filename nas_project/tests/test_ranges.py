@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from app import db
+from app.models import File
+from app.utils.ranges import coalesce_ranges, resolve_ranges
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 100)]),
+    ('bytes=900-', [(900, 1000)]),
+    ('bytes=-100', [(900, 1000)]),
+    ('bytes=-5000', [(0, 1000)]),
+    ('bytes=990-5000', [(990, 1000)]),
+    ('bytes=0-9, 5-19, 20-29', [(0, 30)]),
+    ('bytes=500-599,0-99', [(0, 100), (500, 600)]),
+])
+def test_resolve_ranges(header, expected):
+    assert resolve_ranges(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header', [None, '', 'bytes=', 'items=0-9', 'bytes=a-b', 'bytes=9-0', 'bytes=5'])
+def test_resolve_ranges_ignores_malformed_headers(header):
+    assert resolve_ranges(header, SIZE) is None
+
+
+def test_resolve_ranges_unsatisfiable():
+    assert resolve_ranges('bytes=1000-1999', SIZE) == []
+
+
+def test_coalesce_ranges_merges_adjacent():
+    assert coalesce_ranges([(10, 20), (0, 10), (30, 40)]) == [(0, 20), (30, 40)]
+
+
+@pytest.fixture
+def body():
+    return os.urandom(SIZE)
+
+
+@pytest.fixture
+def file_id(upload, body):
+    return upload('data.bin', body)
+
+
+def test_download_single_range(client, file_id, body):
+    res = client.get(f'/files/download/{file_id}', headers={'Range': 'bytes=100-199'})
+    assert res.status_code == 206
+    assert res.headers['Content-Range'] == f'bytes 100-199/{SIZE}'
+    assert res.data == body[100:200]
+
+
+def test_download_whole_file(client, file_id, body):
+    res = client.get(f'/files/download/{file_id}')
+    assert res.status_code == 200
+    assert res.headers['Accept-Ranges'] == 'bytes'
+    assert res.data == body
+
+
+def test_download_unsatisfiable_range(client, file_id):
+    res = client.get(f'/files/download/{file_id}', headers={'Range': f'bytes={SIZE}-'})
+    assert res.status_code == 416
+    assert res.headers['Content-Range'] == f'bytes */{SIZE}'
+
+
+def test_download_multiple_ranges(client, file_id, body):
+    res = client.get(f'/files/download/{file_id}', headers={'Range': 'bytes=0-9,500-509'})
+    assert res.status_code == 206
+    assert res.mimetype == 'multipart/byteranges'
+    assert int(res.headers['Content-Length']) == len(res.data)
+    assert body[:10] in res.data and body[500:510] in res.data
+    assert f'Content-Range: bytes 500-509/{SIZE}'.encode() in res.data
+
+
+def test_if_range_mismatch_sends_whole_file(client, file_id, body):
+    res = client.get(f'/files/download/{file_id}', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert res.status_code == 200
+    assert res.data == body
+
+
+def test_conditional_get(client, file_id):
+    etag = client.get(f'/files/download/{file_id}').headers['ETag']
+    res = client.get(f'/files/download/{file_id}', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+
+
+def test_session_of_file_deleted_by_another_worker_is_dropped(app, client, config, upload, body):
+    config['STORAGE_DEDUP'] = True
+    file_id = upload('shared.bin', body)
+    assert client.get(f'/files/download/{file_id}', headers={'Range': 'bytes=0-9'}).status_code == 206
+    with app.app_context():
+        # Deleted without this worker's forget_file(); the blob stays on disk
+        db.session.delete(db.session.get(File, file_id))
+        db.session.commit()
+    assert client.get(f'/files/download/{file_id}', headers={'Range': 'bytes=10-19'}).status_code == 404
+
+
+def test_download_of_missing_body_is_not_found(app, client, file_id):
+    with app.app_context():
+        os.remove(db.session.get(File, file_id).path)
+    assert client.get(f'/files/download/{file_id}').status_code == 404
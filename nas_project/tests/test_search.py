@@ -0,0 +1,82 @@
+from app import db
+from app.models import File
+from app.utils import media_jobs
+from app.utils.embeddings import get_embeddings
+
+DOCUMENTS = {
+    'garden.txt': 'Tomatoes and courgettes need watering every evening in a dry summer.',
+    'invoice.txt': 'Invoice for the replacement boiler, payable within thirty days.',
+    'trip.txt': 'Train times and hotel booking for the autumn trip to the mountains.',
+}
+
+
+def upload_documents(app, upload, client=None):
+    ids = {}
+    for name, text in DOCUMENTS.items():
+        ids[name] = upload(name, text.encode('utf-8'), **({'client': client} if client else {}))
+    with app.app_context():
+        for file_id in ids.values():
+            media_jobs.index_for_search(file_id)
+    return ids
+
+
+def found(client, path, query):
+    res = client.get(path, query_string={'q': query})
+    assert res.status_code == 200, res.get_json()
+    return [result['id'] for result in res.get_json()['results']]
+
+
+def test_full_text_search_finds_content(app, client, upload):
+    ids = upload_documents(app, upload)
+    assert found(client, '/search/files', 'boiler') == [ids['invoice.txt']]
+    assert found(client, '/search/files', 'watering') == [ids['garden.txt']]
+    assert found(client, '/search/files', 'spaceship') == []
+
+    res = client.get('/search/files', query_string={'q': 'hotel'}).get_json()
+    assert '<mark>hotel</mark>' in res['results'][0]['snippet']
+
+
+def test_search_only_sees_own_files(app, client, upload, make_user, make_client):
+    upload_documents(app, upload)
+    other = make_client(make_user())
+    assert found(other, '/search/files', 'boiler') == []
+    assert found(other, '/search/names', 'invoice') == []
+
+
+def test_name_suggestions(app, client, upload):
+    ids = upload_documents(app, upload)
+    # Substring, short prefix and misspelling
+    assert found(client, '/search/names', 'voic') == [ids['invoice.txt']]
+    assert found(client, '/search/names', 'tr') == [ids['trip.txt']]
+    assert found(client, '/search/names', 'gardne') == [ids['garden.txt']]
+
+
+def test_name_is_searchable_before_content_is_indexed(client, upload):
+    file_id = upload('holiday-photos.txt', b'nothing to see')
+    assert found(client, '/search/names', 'holiday') == [file_id]
+    assert found(client, '/search/files', 'nothing') == []
+
+
+def test_semantic_search_ranks_closest_document_first(app, client, upload):
+    ids = upload_documents(app, upload)
+    with app.app_context():
+        for file_id in ids.values():
+            assert get_embeddings().embed_file(db.session.get(File, file_id)) == 1
+        # Already current: nothing is sent again
+        assert get_embeddings().embed_file(db.session.get(File, ids['trip.txt'])) == 0
+
+    res = client.get('/search/semantic', query_string={'q': 'hotel booking for a trip'})
+    assert res.status_code == 200
+    results = res.get_json()['results']
+    assert results[0]['id'] == ids['trip.txt']
+    assert results[0]['excerpt'].startswith('Train times')
+
+
+def test_semantic_search_reports_unreachable_server(app, client, upload, monkeypatch):
+    file_id = upload('notes.txt', b'Minutes of the residents meeting about parking.')
+    with app.app_context():
+        media_jobs.index_for_search(file_id)
+        get_embeddings().embed_file(db.session.get(File, file_id))
+        monkeypatch.setattr(get_embeddings().client, 'url', 'http://127.0.0.1:9/embed')
+    res = client.get('/search/semantic', query_string={'q': 'where can I park'})
+    assert res.status_code == 503
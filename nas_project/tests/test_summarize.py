@@ -0,0 +1,47 @@
+import pytest
+import requests
+
+from app.utils.summarize import Summarizer, split_text
+from app.utils.text_extract import PAGE_BREAK
+
+SENTENCES = [f'Sentence number {i} of the report says something new.' for i in range(60)]
+
+
+@pytest.fixture
+def summarizer(app):
+    return Summarizer(dict(app.config, SUMMARY_CHUNK_CHARS=400, SUMMARY_WORKERS=2))
+
+
+def test_split_text_prefers_page_breaks():
+    pages = [' '.join(SENTENCES[i:i + 5]) for i in range(0, 20, 5)]
+    chunks = split_text(PAGE_BREAK.join(pages), 300)
+    assert [chunk.strip() for chunk in chunks] == pages
+
+
+def test_split_text_respects_size():
+    chunks = split_text(' '.join(SENTENCES), 400)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 400 for chunk in chunks)
+
+
+def test_long_text_is_summarised_in_parts(summarizer):
+    summary = summarizer.summarize(' '.join(SENTENCES), 'Summarize the following text', max_tokens=30)
+    assert summary
+    assert len(summary.split()) <= 40
+
+
+def test_retry_reuses_cached_parts(summarizer, monkeypatch):
+    text = '\n\n'.join(SENTENCES[::-1])
+    first = summarizer.summarize(text)
+
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError('AI server is down')
+    monkeypatch.setattr(summarizer.session, 'post', offline)
+    assert summarizer.summarize(text) == first
+
+
+def test_empty_text_is_not_sent(summarizer, monkeypatch):
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError('AI server is down')
+    monkeypatch.setattr(summarizer.session, 'post', offline)
+    assert summarizer.summarize(' \n ') == ''
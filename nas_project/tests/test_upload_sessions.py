@@ -0,0 +1,168 @@
+import os
+import hashlib
+
+import pytest
+
+from app import db
+from app.models import Blob, File, UploadSession, User
+import app.routes.uploads as uploads
+
+CHUNK = 1024
+
+
+@pytest.fixture
+def body():
+    return b'%PDF-1.4\n' + os.urandom(3 * CHUNK)
+
+
+@pytest.fixture
+def start(client, config):
+    config['UPLOAD_CHUNK_SIZE'] = CHUNK
+
+    def start(body, filename='scan.pdf'):
+        res = client.post('/files/uploads', json={'filename': filename, 'size': len(body)})
+        assert res.status_code == 201, res.get_json()
+        return res.get_json()
+    return start
+
+
+def send(client, upload_id, body, index, **headers):
+    return client.put(f'/files/uploads/{upload_id}/chunks/{index}',
+                      data=body[index * CHUNK:(index + 1) * CHUNK], headers=headers)
+
+
+def test_chunks_in_any_order(app, client, start, body):
+    session = start(body)
+    assert session['total_chunks'] == 4
+    for index in (3, 1, 0):
+        assert send(client, session['upload_id'], body, index).status_code == 200
+
+    status = client.get(f"/files/uploads/{session['upload_id']}").get_json()
+    assert status['received'] == [0, 1, 3]
+    res = client.post(f"/files/uploads/{session['upload_id']}/complete")
+    assert res.status_code == 409
+    assert res.get_json()['missing'] == [2]
+
+    send(client, session['upload_id'], body, 2)
+    res = client.post(f"/files/uploads/{session['upload_id']}/complete")
+    assert res.status_code == 200
+    with app.app_context():
+        file = db.session.get(File, res.get_json()['file_id'])
+        assert file.sha256 == hashlib.sha256(body).hexdigest()
+        assert file.mime_type == 'application/pdf'
+        with open(file.path, 'rb') as f:
+            assert f.read() == body
+
+
+def test_completion_is_idempotent(client, start, body):
+    session = start(body)
+    for index in range(session['total_chunks']):
+        send(client, session['upload_id'], body, index)
+    first = client.post(f"/files/uploads/{session['upload_id']}/complete").get_json()
+    again = client.post(f"/files/uploads/{session['upload_id']}/complete")
+    assert again.status_code == 200
+    assert again.get_json()['file_id'] == first['file_id']
+
+
+def test_chunk_checksum_is_verified(client, start, body):
+    session = start(body)
+    res = send(client, session['upload_id'], body, 0, **{'X-Chunk-SHA256': '0' * 64})
+    assert res.status_code == 400
+    status = client.get(f"/files/uploads/{session['upload_id']}").get_json()
+    assert status['received'] == []
+
+
+def test_cancel_discards_the_session(client, start, body):
+    session = start(body)
+    send(client, session['upload_id'], body, 0)
+    assert client.delete(f"/files/uploads/{session['upload_id']}").status_code == 200
+    assert client.get(f"/files/uploads/{session['upload_id']}").status_code == 404
+
+
+def test_session_reserves_quota_up_front(app, make_user, make_client, config):
+    config['UPLOAD_CHUNK_SIZE'] = CHUNK
+    user_id = make_user(storage_limit=2 * CHUNK)
+    client = make_client(user_id)
+    res = client.post('/files/uploads', json={'filename': 'a.bin', 'size': 3 * CHUNK})
+    assert res.status_code == 400
+    res = client.post('/files/uploads', json={'filename': 'a.bin', 'size': CHUNK})
+    assert res.status_code == 201
+    with app.app_context():
+        assert db.session.get(User, user_id).storage_reserved == CHUNK
+
+
+@pytest.mark.parametrize('dedup, duplicate', [(False, False), (True, False), (True, True)])
+def test_failed_completion_can_be_retried(app, client, start, body, config, monkeypatch, upload,
+                                          dedup, duplicate):
+    config['STORAGE_DEDUP'] = dedup
+    if duplicate:
+        upload('first.pdf', body)
+    session = start(body)
+    for index in range(session['total_chunks']):
+        send(client, session['upload_id'], body, index)
+
+    def fail(reservation):
+        raise RuntimeError('database went away')
+    with monkeypatch.context() as patch:
+        patch.setattr(uploads, 'release_reservation', fail)
+        res = client.post(f"/files/uploads/{session['upload_id']}/complete")
+    assert res.status_code == 500
+
+    status = client.get(f"/files/uploads/{session['upload_id']}").get_json()
+    assert status['status'] == 'active'
+    res = client.post(f"/files/uploads/{session['upload_id']}/complete")
+    assert res.status_code == 200
+    with app.app_context():
+        file = db.session.get(File, res.get_json()['file_id'])
+        with open(file.path, 'rb') as f:
+            assert f.read() == body
+        if dedup:
+            assert db.session.get(Blob, file.sha256).ref_count == (2 if duplicate else 1)
+
+
+def test_completion_that_lost_its_data_fails_the_session(app, client, start, body, config, monkeypatch):
+    config['STORAGE_DEDUP'] = False
+    session = start(body)
+    for index in range(session['total_chunks']):
+        send(client, session['upload_id'], body, index)
+
+    def lose(user, placed_path, *args, **kwargs):
+        os.remove(placed_path)
+        raise RuntimeError('disk error')
+    monkeypatch.setattr(uploads, 'create_file_record', lose)
+    assert client.post(f"/files/uploads/{session['upload_id']}/complete").status_code == 500
+
+    with app.app_context():
+        upload = db.session.get(UploadSession, session['upload_id'])
+        assert upload.status == 'failed'
+        assert upload.received_chunks() == []
+    res = client.post(f"/files/uploads/{session['upload_id']}/complete")
+    assert res.status_code == 409
+    assert client.delete(f"/files/uploads/{session['upload_id']}").status_code == 200
+
+
+def test_concurrent_completion_is_refused(app, client, user, start, body, monkeypatch):
+    session = start(body)
+    for index in range(session['total_chunks']):
+        send(client, session['upload_id'], body, index)
+    complete = f"/files/uploads/{session['upload_id']}/complete"
+
+    racing = []
+    finish_data_file = uploads.finish_data_file
+
+    def finish_while_another_completes(upload):
+        racing.append(client.post(complete))
+        racing.append(client.delete(f"/files/uploads/{session['upload_id']}"))
+        return finish_data_file(upload)
+    monkeypatch.setattr(uploads, 'finish_data_file', finish_while_another_completes)
+    res = client.post(complete)
+    assert res.status_code == 200
+    assert [r.status_code for r in racing] == [409, 409]
+    assert client.post(complete).get_json()['file_id'] == res.get_json()['file_id']
+
+    with app.app_context():
+        upload = db.session.get(UploadSession, session['upload_id'])
+        assert upload.status == 'completed'
+        assert not db.session.get(User, user).storage_reserved
+        with open(db.session.get(File, upload.file_id).path, 'rb') as f:
+            assert f.read() == body
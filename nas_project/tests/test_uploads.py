@@ -0,0 +1,111 @@
+import io
+import hashlib
+
+from app import db
+from app.models import File, User
+
+PDF = b'%PDF-1.4\n' + b'0' * 4000
+
+
+def multipart(client, data, filename='report.pdf', headers=None, **kwargs):
+    return client.post('/files/upload', data={'file': (io.BytesIO(data), filename), 'category': 'documents'},
+                       content_type='multipart/form-data', headers={'X-Requested-With': 'XMLHttpRequest',
+                                                                     **(headers or {})}, **kwargs)
+
+
+def test_raw_upload_records_hash_and_sniffed_type(app, upload):
+    file_id = upload('notes.txt', PDF)
+    with app.app_context():
+        file = db.session.get(File, file_id)
+        assert file.file_size == len(PDF)
+        assert file.sha256 == hashlib.sha256(PDF).hexdigest()
+        assert file.mime_type == 'application/pdf'
+
+
+def test_multipart_upload(app, client, user):
+    res = multipart(client, PDF)
+    assert res.status_code == 200, res.get_json()
+    with app.app_context():
+        file = db.session.get(File, res.get_json()['file_id'])
+        assert file.sha256 == hashlib.sha256(PDF).hexdigest()
+        assert file.category == 'documents'
+        assert db.session.get(User, user).storage_used == len(PDF)
+
+
+def test_multipart_upload_cannot_declare_its_way_under_the_quota(app, make_user, make_client):
+    user_id = make_user(storage_limit=1000)
+    res = multipart(make_client(user_id), PDF, headers={'X-File-Size': '10'})
+    assert res.status_code == 400
+    assert res.get_json()['error'] == 'Storage limit exceeded'
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        assert not user.storage_used and not user.storage_reserved
+        assert File.query.filter_by(user_id=user_id).count() == 0
+
+
+def test_multipart_upload_needs_content_length(client):
+    body = (b'--b\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\n\r\n'
+            b'hello\r\n--b--\r\n')
+    res = client.post('/files/upload', input_stream=io.BytesIO(body),
+                      headers={'Content-Type': 'multipart/form-data; boundary=b',
+                               'X-Requested-With': 'XMLHttpRequest', 'X-File-Size': '5'},
+                      environ_overrides={'CONTENT_LENGTH': ''})
+    assert res.status_code == 411
+
+
+def test_raw_upload_over_quota(app, make_user, make_client):
+    user_id = make_user(storage_limit=1000)
+    res = make_client(user_id).put('/files/upload/raw?filename=big.bin', data=b'x' * 2000)
+    assert res.status_code == 400
+    with app.app_context():
+        assert not db.session.get(User, user_id).storage_reserved
+
+
+def test_raw_upload_longer_than_declared(app, client, user):
+    res = client.put('/files/upload/raw?filename=a.bin', data=b'x' * 2000, headers={'X-File-Size': '100'})
+    assert res.status_code == 413
+    with app.app_context():
+        user = db.session.get(User, user)
+        assert not user.storage_used and not user.storage_reserved
+
+
+class Unread(io.RawIOBase):
+    """A request body that fails the test if the app reads it"""
+
+    def readinto(self, buffer):
+        raise AssertionError('the body was read')
+
+
+def test_expect_continue_over_quota_is_refused_from_headers(app, make_user, make_client):
+    user_id = make_user(storage_limit=1000)
+    res = make_client(user_id).put('/files/upload/raw?filename=big.bin', headers={'Expect': '100-continue'},
+                                   environ_overrides={'wsgi.input': Unread(), 'CONTENT_LENGTH': '2000'})
+    assert res.status_code == 400
+    with app.app_context():
+        assert not db.session.get(User, user_id).storage_reserved
+
+
+def admit(client, uri, **headers):
+    return client.get('/files/upload/admit', headers={'X-Original-URI': uri, 'Expect': '100-continue',
+                                                       **headers})
+
+
+def test_admission_refuses_over_quota_upload(app, make_user, make_client):
+    user_id = make_user(storage_limit=1000)
+    client = make_client(user_id)
+    res = admit(client, '/files/upload/raw?filename=big.bin', **{'X-File-Size': '2000'})
+    assert res.status_code == 403
+    assert res.headers['X-Upload-Status'] == '400'
+    assert res.headers['X-Upload-Error'] == 'Storage limit exceeded'
+    # Multipart bodies are judged by their length, whatever X-File-Size says
+    res = admit(client, '/files/upload', **{'X-Upload-Length': '2000', 'X-File-Size': '10'})
+    assert res.headers['X-Upload-Status'] == '400'
+    assert admit(client, '/files/upload').headers['X-Upload-Status'] == '411'
+    with app.app_context():
+        assert not db.session.get(User, user_id).storage_reserved
+
+
+def test_admission_lets_uploads_within_quota_through(app, make_user, make_client):
+    client = make_client(make_user(storage_limit=1000))
+    assert admit(client, '/files/upload', **{'X-Upload-Length': '900'}).status_code == 204
+    assert admit(app.test_client(), '/files/upload', **{'X-Upload-Length': '900'}).status_code == 204